@@ -0,0 +1,122 @@
+import asyncio
+import logging
+import time
+from collections import deque
+
+logger = logging.getLogger(__name__)
+
+
+class QueueFull(Exception):
+    """キューがいっぱいで積めなかったとき（call() 用）"""
+
+
+class ActorQueue:
+    """キー（ユーザー）ごとに1本ずつ順番に処理するキュー
+
+    同じキーの仕事は届いた順に1つずつ実行し、別のキー同士は並行して動く。
+    同時に動かす数は全体で max_workers まで。
+    1つのキーに max_depth 件、全体で max_pending 件溜まっていたら submit() は
+    False を返すので、呼び出し側で「混んでるよ」と返せばよい。
+    """
+
+    def __init__(self, max_workers=4, max_depth=3, max_pending=50):
+        self.max_depth = max_depth
+        self.max_pending = max_pending
+        self._semaphore = asyncio.Semaphore(max_workers)
+        self._queues = {}   # key -> deque[(積んだ時刻, job)]
+        self._workers = {}  # key -> Task
+        self._pending = 0
+        self.metrics = {
+            "submitted": 0,
+            "completed": 0,
+            "rejected": 0,
+            "failures": 0,
+            "running": 0,
+            "queued": 0,
+            "wait_ms_total": 0.0,
+            "last_wait_ms": 0.0,
+            "max_wait_ms": 0.0,
+        }
+
+    def __len__(self):
+        return self._pending
+
+    def depth(self, key):
+        """そのキーでまだ終わっていない仕事の数（実行中を含む）"""
+        return len(self._queues.get(key, ()))
+
+    def submit(self, key, job):
+        """job（引数なしで呼ぶとコルーチンを返すもの）を積む。いっぱいなら積まずに False"""
+        if self.depth(key) >= self.max_depth or self._pending >= self.max_pending:
+            self.metrics["rejected"] += 1
+            return False
+        self._queues.setdefault(key, deque()).append((time.monotonic(), job))
+        self._pending += 1
+        self.metrics["submitted"] += 1
+        self.metrics["queued"] = self._pending
+        if key not in self._workers:
+            self._workers[key] = asyncio.create_task(self._work(key))
+        return True
+
+    async def call(self, key, job):
+        """submit() して順番が来るまで待ち、job の戻り値を返す。積めなければ QueueFull"""
+        future = asyncio.get_running_loop().create_future()
+
+        async def run():
+            try:
+                result = await job()
+            except Exception as e:
+                if not future.done():
+                    future.set_exception(e)
+                raise
+            else:
+                if not future.done():
+                    future.set_result(result)
+            finally:
+                if not future.done():
+                    future.cancel()  # stop() で打ち切られたとき
+
+        if not self.submit(key, run):
+            raise QueueFull(key)
+        return await future
+
+    async def _work(self, key):
+        queue = self._queues[key]
+        try:
+            while queue:
+                queued_at, job = queue[0]
+                async with self._semaphore:
+                    wait_ms = (time.monotonic() - queued_at) * 1000
+                    self.metrics["wait_ms_total"] += wait_ms
+                    self.metrics["last_wait_ms"] = round(wait_ms, 1)
+                    self.metrics["max_wait_ms"] = max(self.metrics["max_wait_ms"], round(wait_ms, 1))
+                    self.metrics["running"] += 1
+                    try:
+                        await job()
+                        self.metrics["completed"] += 1
+                    except Exception as e:
+                        self.metrics["failures"] += 1
+                        logger.error(f"❌ {key} の処理でエラー: {e}")
+                    finally:
+                        self.metrics["running"] -= 1
+                # 終わってから外すので、実行中の分も depth() に数える
+                queue.popleft()
+                self._pending -= 1
+                self.metrics["queued"] = self._pending
+        finally:
+            self._workers.pop(key, None)
+            if not queue:
+                self._queues.pop(key, None)
+
+    async def join(self, timeout=None):
+        """今積まれている仕事が終わるまで待つ"""
+        if self._workers:
+            await asyncio.wait(list(self._workers.values()), timeout=timeout)
+
+    async def stop(self, timeout=10.0):
+        """少し待ってから、残っている仕事を打ち切る"""
+        await self.join(timeout)
+        for task in list(self._workers.values()):
+            task.cancel()
+        if self._workers:
+            await asyncio.gather(*self._workers.values(), return_exceptions=True)
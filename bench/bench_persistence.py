@@ -0,0 +1,232 @@
+"""永続化まわりのベンチマーク
+
+ローカルの PostgREST もどき（fake_postgrest.py）に大量のデータを入れて、
+ボットと同じ使い方で各操作を実行し、リクエスト数・転送量・所要時間を出す。
+操作ごとのリクエスト数と、ローカルキャッシュ（SQLite）で使った時間に上限を決めてあり、
+どちらかを超えたら終了コード 1 で終わるので、O(N) に戻ってしまった変更を出荷前に見つけられる。
+
+    python bench/bench_persistence.py --users 10000 --reminders 100000 --latency 0.005
+"""
+import argparse
+import asyncio
+import json
+import math
+import os
+import sys
+import tempfile
+import time
+import uuid
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from fake_postgrest import FakePostgrest, start_server  # noqa: E402
+from supabase_client import SupabaseClient  # noqa: E402
+from local_cache import LocalCache, CachedSupabase  # noqa: E402
+from repositories import TableRepository, ConversationStore, WriteBehindQueue  # noqa: E402
+
+# bot.py と同じ設定（bot.py は import すると起動してしまうので写してある）
+CACHED_TABLES = {
+    "notifications": ("id",),
+    "daily_notifications": ("user_id",),
+    "sleep_check_times": ("user_id",),
+    "chat_targets": ("user_id",),
+    "conversation_logs": ("id",),
+}
+OWNER_COLUMNS = {
+    "notifications": "user_id",
+    "conversation_logs": "user_id",
+}
+TABLE_COLUMNS = {
+    "notifications": "id,user_id,date,time,message,repeat,recurrence",
+    "daily_notifications": "user_id,todos,hour,minute",
+    "sleep_check_times": "user_id,hour,minute",
+    "chat_targets": "user_id",
+    "conversation_logs": "id,user_id,role,content,created_at",
+}
+
+
+def seed(fake, users, reminders, turns):
+    user_ids = [str(100000000000000000 + i) for i in range(users)]
+    fake.seed("notifications", (
+        {
+            "id": str(uuid.uuid4()),
+            "user_id": user_ids[i % users],
+            "date": f"{(i % 12) + 1:02d}-{(i % 28) + 1:02d}",
+            "time": f"{i % 24:02d}:{i % 60:02d}",
+            "message": f"リマインダー {i}",
+            "repeat": i % 5 == 0,
+            "recurrence": "yearly" if i % 5 == 0 else None
+        }
+        for i in range(reminders)
+    ))
+    fake.seed("daily_notifications", (
+        {"user_id": uid, "todos": json.dumps(["水をのむ", "ストレッチ"], ensure_ascii=False), "hour": 8, "minute": 0}
+        for uid in user_ids
+    ))
+    fake.seed("sleep_check_times", ({"user_id": uid, "hour": 1, "minute": 0} for uid in user_ids))
+    fake.seed("chat_targets", ({"user_id": uid} for uid in user_ids[:100]))
+    fake.seed("conversation_logs", (
+        {
+            "id": u * turns + t + 1,
+            "user_id": uid,
+            "role": "user" if t % 2 == 0 else "model",
+            "content": f"こんにちは {t}",
+            "created_at": f"2026-01-01T00:00:{t:02d}+00:00"
+        }
+        for u, uid in enumerate(user_ids[:1000]) for t in range(turns)
+    ))
+    return user_ids
+
+
+async def run(args):
+    fake = FakePostgrest(latency=args.latency, max_rows=args.page_size)
+    user_ids = seed(fake, args.users, args.reminders, args.turns)
+    runner, url = await start_server(fake)
+    tmp = tempfile.mkdtemp()
+    client = SupabaseClient(url, "bench-key")
+    store = CachedSupabase(client, LocalCache(os.path.join(tmp, "bench.sqlite3"), CACHED_TABLES, TABLE_COLUMNS, OWNER_COLUMNS))
+    notification_repo = TableRepository(store, "notifications", key="id")
+    daily_repo = TableRepository(store, "daily_notifications", key="user_id")
+    conversation_store = ConversationStore(store)
+    queue = WriteBehindQueue([notification_repo, daily_repo, conversation_store])
+
+    results = []
+
+    async def measure(name, operation, budget=None, local_budget_ms=None):
+        fake.stats.reset()
+        local_before = store.metrics["local_ms_total"]
+        started = time.perf_counter()
+        await operation()
+        wall = time.perf_counter() - started
+        stats = fake.stats.snapshot()
+        results.append({
+            "operation": name,
+            "wall_ms": round(wall * 1000, 1),
+            "local_ms": round(store.metrics["local_ms_total"] - local_before, 1),
+            "budget": budget,
+            "local_budget_ms": local_budget_ms,
+            **stats
+        })
+
+    uid = user_ids[0]
+    new_id = str(uuid.uuid4())
+    new_row = {"id": new_id, "user_id": uid, "date": "12-24", "time": "20:00", "message": "プレゼント", "repeat": False, "recurrence": None}
+    pages = math.ceil(args.reminders / args.page_size) + 1
+
+    async def cold_hydrate():
+        await asyncio.gather(*(store.refresh(t) for t in CACHED_TABLES))
+
+    async def load_notifications_local():
+        count = 0
+        async for rows in store.select_pages("notifications", columns=TABLE_COLUMNS["notifications"]):
+            count += len(rows)
+        assert count == args.reminders, count
+
+    async def add_notification():
+        notification_repo.mark_upsert(new_row)
+        await queue.flush_all()
+
+    async def fire_repeat_notification():
+        # 繰り返し通知は次回の時刻をメモリ上で進めるだけで、DBには書かない
+        await queue.flush_all()
+
+    async def remove_notification():
+        notification_repo.mark_delete(new_id)
+        await queue.flush_all()
+
+    async def daily_todo_burst():
+        todos = []
+        for i in range(10):
+            todos.append(f"todo {i}")
+            daily_repo.mark_upsert({"user_id": uid, "todos": json.dumps(todos), "hour": 8, "minute": 0})
+            queue.touch()
+        await queue.flush_all()
+
+    async def conversation_turn():
+        now = time.time()
+        conversation_store.append(uid, {"role": "user", "parts": [{"text": "やあ"}], "created_at": f"2026-06-01T00:00:{now:.6f}"})
+        conversation_store.append(uid, {"role": "model", "parts": [{"text": "やっほー"}], "created_at": f"2026-06-01T00:01:{now:.6f}"})
+        await queue.flush_all()
+
+    trim_users = user_ids[:100]
+
+    async def conversation_trim():
+        logs = {}
+        for u in trim_users:
+            conversation_store.mark_trim(u)
+            logs[u] = [{"created_at": f"2026-01-01T00:00:{args.turns - 2:02d}+00:00"}]
+        await conversation_store.trim(logs)
+
+    await measure("cold hydrate (all tables)", cold_hydrate)
+    await measure("refresh notifications", lambda: store.refresh("notifications"), budget=pages)
+    await measure("load_notifications (local)", load_notifications_local, budget=0)
+    # 1件ずつの操作はテーブルの件数に関係なく、ローカルでも数ミリ秒で終わるはず
+    await measure("add notification", add_notification, budget=1, local_budget_ms=args.local_budget)
+    await measure("fire repeat notification", fire_repeat_notification, budget=0, local_budget_ms=args.local_budget)
+    await measure("remove notification", remove_notification, budget=1, local_budget_ms=args.local_budget)
+    await measure("daily todo burst x10", daily_todo_burst, budget=1, local_budget_ms=args.local_budget)
+    await measure("conversation turn", conversation_turn, budget=1, local_budget_ms=args.local_budget)
+    await measure(
+        f"conversation trim ({len(trim_users)} users)",
+        conversation_trim,
+        budget=len(trim_users),
+        local_budget_ms=args.local_budget * len(trim_users)
+    )
+
+    await client.close()
+    await runner.cleanup()
+    return results
+
+
+def over_budget(r):
+    if r["budget"] is not None and r["requests"] > r["budget"]:
+        return True
+    return r["local_budget_ms"] is not None and r["local_ms"] > r["local_budget_ms"]
+
+
+def report(results):
+    header = (
+        f"{'operation':<36}{'requests':>10}{'budget':>8}{'bytes in':>12}{'bytes out':>12}"
+        f"{'wall ms':>10}{'local ms':>10}{'budget':>8}"
+    )
+    print(header)
+    print("-" * len(header))
+    failed = []
+    for r in results:
+        budget = "-" if r["budget"] is None else str(r["budget"])
+        local_budget = "-" if r["local_budget_ms"] is None else str(r["local_budget_ms"])
+        mark = ""
+        if over_budget(r):
+            mark = "  ✗"
+            failed.append(r["operation"])
+        print(
+            f"{r['operation']:<36}{r['requests']:>10}{budget:>8}{r['bytes_in']:>12}{r['bytes_out']:>12}"
+            f"{r['wall_ms']:>10}{r['local_ms']:>10}{local_budget:>8}{mark}"
+        )
+    return failed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="永続化まわりのベンチマーク")
+    parser.add_argument("--users", type=int, default=10000)
+    parser.add_argument("--reminders", type=int, default=100000)
+    parser.add_argument("--turns", type=int, default=7, help="ユーザーごとの会話ログ件数（先頭1000人分）")
+    parser.add_argument("--latency", type=float, default=0.0, help="リクエストごとの遅延（秒）")
+    parser.add_argument("--page-size", type=int, default=1000)
+    parser.add_argument("--local-budget", type=float, default=20.0, help="1件の操作（trim は1人分）でローカルキャッシュに使ってよい時間（ミリ秒）")
+    parser.add_argument("--json", action="store_true", help="結果を JSON で出す")
+    args = parser.parse_args()
+
+    results = asyncio.run(run(args))
+    if args.json:
+        print(json.dumps(results, ensure_ascii=False, indent=2))
+        failed = [r["operation"] for r in results if over_budget(r)]
+    else:
+        failed = report(results)
+    if failed:
+        print(f"\nリクエスト数かローカルの時間が上限を超えた操作: {', '.join(failed)}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
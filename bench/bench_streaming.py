@@ -0,0 +1,75 @@
+"""ストリーミング返信のベンチマーク
+
+ローカルの Gemini もどき（fake_gemini.py）に対して、
+generateContent で全部待つ場合と streamGenerateContent で1文ずつ受け取る場合の
+「最初の1文が届くまで」と「全部届くまで」の時間を比べる。
+ストリーミングの方が最初の1文が遅かったら終了コード 1 で終わる。
+
+    python bench/bench_streaming.py --chunk-delay 0.2
+"""
+import argparse
+import asyncio
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from fake_gemini import FakeGemini, start_server  # noqa: E402
+from gemini_client import GeminiClient  # noqa: E402
+
+CONTENTS = [{"role": "user", "parts": [{"text": "ただいま！"}]}]
+
+
+async def run(args):
+    fake = FakeGemini(chunk_size=args.chunk_size, chunk_delay=args.chunk_delay, first_delay=args.first_delay, fail_first=args.fail_first)
+    runner, url = await start_server(fake)
+    client = GeminiClient("bench-key", base_url=url, backoff=0.05)
+
+    started = time.perf_counter()
+    response = await client.generate(CONTENTS)
+    blocking = time.perf_counter() - started
+    assert response.ok, response.status
+
+    first = None
+    sentences = []
+    started = time.perf_counter()
+    async for sentence in client.stream_sentences(CONTENTS):
+        if first is None:
+            first = time.perf_counter() - started
+        sentences.append(sentence)
+    streaming = time.perf_counter() - started
+    assert "".join(sentences) == fake.reply, sentences
+
+    await client.close()
+    await runner.cleanup()
+    return {
+        "blocking_first_ms": round(blocking * 1000, 1),
+        "blocking_total_ms": round(blocking * 1000, 1),
+        "streaming_first_ms": round(first * 1000, 1),
+        "streaming_total_ms": round(streaming * 1000, 1),
+        "sentences": len(sentences),
+        "retries": client.metrics["retries"],
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="ストリーミング返信のベンチマーク")
+    parser.add_argument("--chunk-size", type=int, default=8)
+    parser.add_argument("--chunk-delay", type=float, default=0.05)
+    parser.add_argument("--first-delay", type=float, default=0.0)
+    parser.add_argument("--fail-first", type=int, default=0, help="最初の何回かを 429 にする")
+    args = parser.parse_args()
+
+    result = asyncio.run(run(args))
+    print(f"{'mode':<12}{'first ms':>12}{'total ms':>12}")
+    print(f"{'blocking':<12}{result['blocking_first_ms']:>12}{result['blocking_total_ms']:>12}")
+    print(f"{'streaming':<12}{result['streaming_first_ms']:>12}{result['streaming_total_ms']:>12}")
+    print(f"\n{result['sentences']} 文 / リトライ {result['retries']} 回")
+    if result["streaming_first_ms"] >= result["blocking_first_ms"]:
+        print("\nストリーミングの方が最初の1文が遅くなっています")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,113 @@
+"""stop() の確認
+
+起こした直後（schedule() / touch() のすぐ後）に stop() しても、
+ReminderDispatcher と WriteBehindQueue がちゃんと止まるかを確かめる。
+どのタイミングで重なるかで結果が変わるので、起こす前と stop() の前に
+イベントループを回す回数を変えながら試す。
+Python 3.11 の asyncio.wait_for は、待っていたものが終わるのと同時に来た
+cancel() を握りつぶすことがあり、そうなると stop() が返ってこない。
+止まらなかったら終了コード 1 で終わる。
+
+    python bench/check_stop.py --spins 4 --timeout 1
+"""
+import argparse
+import asyncio
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from reminder_dispatcher import ReminderDispatcher  # noqa: E402
+from repositories import WriteBehindQueue  # noqa: E402
+
+
+class IdleStore:
+    """書き込むものが無いリポジトリ"""
+    pending = 0
+
+    async def flush(self):
+        return True
+
+
+async def spin(times):
+    for _ in range(times):
+        await asyncio.sleep(0)
+
+
+async def wake_then_stop(target, wake, before, between, timeout):
+    """start() → before 回まわす → wake() → between 回まわす → stop()。止まれば True"""
+    target.start()
+    await spin(before)
+    wake()
+    stopping = asyncio.ensure_future(target.stop())
+    await spin(between)
+    done, _ = await asyncio.wait([stopping], timeout=timeout)
+    if not done:
+        stopping.cancel()
+        target._task.cancel()  # 次の回に持ち越さないように
+        return False
+    return True
+
+
+def dispatcher_schedule():
+    async def callback(*payload):
+        pass
+
+    dispatcher = ReminderDispatcher(callback)
+    return dispatcher, lambda: dispatcher.schedule("key", time.time() + 3600)
+
+
+def dispatcher_grouped_schedule():
+    async def callback(group, items):
+        pass
+
+    dispatcher = ReminderDispatcher(callback, group_by=lambda payload: payload[0], group_window=5.0)
+    return dispatcher, lambda: dispatcher.schedule("key", time.time() + 3600, ("user",))
+
+
+def queue_touch():
+    queue = WriteBehindQueue([IdleStore()], interval=60.0, max_pending=0)
+    return queue, queue.touch
+
+
+CHECKS = (
+    ("ReminderDispatcher schedule() → stop()", dispatcher_schedule),
+    ("ReminderDispatcher (group) schedule() → stop()", dispatcher_grouped_schedule),
+    ("WriteBehindQueue touch() → stop()", queue_touch),
+)
+
+
+async def run(args):
+    results = []
+    for name, make in CHECKS:
+        hung = 0
+        tried = 0
+        for before in range(args.spins):
+            for between in range(args.spins):
+                target, wake = make()
+                tried += 1
+                if not await wake_then_stop(target, wake, before, between, args.timeout):
+                    hung += 1
+        results.append((name, hung, tried))
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="stop() の確認")
+    parser.add_argument("--spins", type=int, default=4, help="起こす前・stop() の前にループを回す回数の上限")
+    parser.add_argument("--timeout", type=float, default=1.0, help="stop() が返るまで待つ秒数")
+    args = parser.parse_args()
+
+    results = asyncio.run(run(args))
+    failed = []
+    for name, hung, tried in results:
+        print(f"{name:<50}{hung:>6} / {tried} 回止まらず")
+        if hung:
+            failed.append(name)
+    if failed:
+        print(f"\nstop() が返ってこなかった: {', '.join(failed)}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
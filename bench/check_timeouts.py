@@ -0,0 +1,70 @@
+"""タイムアウトの確認
+
+返事をしないサーバーに SupabaseClient で問い合わせて、
+設定したタイムアウトで諦めるかを確かめる。
+諦めずに待ち続けたら終了コード 1 で終わる。
+
+    python bench/check_timeouts.py --timeout 0.5 --hang 5
+"""
+import argparse
+import asyncio
+import os
+import sys
+import time
+
+from aiohttp import web
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from supabase_client import SupabaseClient  # noqa: E402
+
+
+async def start_hanging_server(hang):
+    """hang 秒たつまで何も返さないサーバーを起動して (runner, base_url) を返す"""
+    async def handle(request):
+        await asyncio.sleep(hang)
+        return web.json_response([])
+
+    app = web.Application()
+    app.router.add_route("*", "/rest/v1/{table}", handle)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    return runner, f"http://127.0.0.1:{runner.addresses[0][1]}"
+
+
+async def run(args):
+    runner, url = await start_hanging_server(args.hang)
+    client = SupabaseClient(url, "check-key", timeout=args.timeout)
+    results = []
+    for name, call in (
+        ("select", lambda: client.select("notifications")),
+        ("upsert", lambda: client.upsert("notifications", [{"id": "x"}])),
+    ):
+        started = time.perf_counter()
+        await call()
+        results.append((name, time.perf_counter() - started))
+    await client.close()
+    await runner.cleanup()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="タイムアウトの確認")
+    parser.add_argument("--timeout", type=float, default=0.5, help="SupabaseClient のタイムアウト（秒）")
+    parser.add_argument("--hang", type=float, default=5.0, help="サーバーが黙っている時間（秒）")
+    args = parser.parse_args()
+
+    results = asyncio.run(run(args))
+    failed = []
+    for name, elapsed in results:
+        print(f"{name:<10}{elapsed * 1000:>10.0f} ms")
+        if elapsed > args.timeout + 1.0:
+            failed.append(name)
+    if failed:
+        print(f"\nタイムアウトで諦めなかった操作: {', '.join(failed)}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
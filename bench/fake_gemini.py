@@ -0,0 +1,93 @@
+"""Gemini API のローカル代用サーバー
+
+generateContent（全部できてから返す）と streamGenerateContent?alt=sse
+（チャンクごとに data: 行で返す）だけを実装したサーバー。
+決まった返事を chunk_delay 秒ごとに少しずつ流すので、
+ストリーミングで最初の1文が届くまでの時間を測れる。
+
+    python bench/fake_gemini.py --port 8081 --chunk-delay 0.2
+"""
+import argparse
+import asyncio
+import json
+
+from aiohttp import web
+
+DEFAULT_REPLY = "やっほーハニー！今日も来てくれてうれしいな。お仕事おつかれさまだよ～！ちゃんとごはん食べた？\n無理しすぎないでね。ドロシーはいつでもここにいるよ！"
+
+
+def chunk_payload(text):
+    return {"candidates": [{"content": {"role": "model", "parts": [{"text": text}]}}]}
+
+
+class FakeGemini:
+    """返事を少しずつ流す Gemini もどき"""
+
+    def __init__(self, reply=DEFAULT_REPLY, chunk_size=8, chunk_delay=0.1, first_delay=0.0, fail_first=0, fail_status=429):
+        self.reply = reply
+        self.chunk_size = chunk_size
+        self.chunk_delay = chunk_delay
+        self.first_delay = first_delay
+        self.fail_first = fail_first    # 最初の何回かをエラーで返す（リトライの確認用）
+        self.fail_status = fail_status
+        self.requests = 0
+
+    def chunks(self):
+        return [self.reply[i:i + self.chunk_size] for i in range(0, len(self.reply), self.chunk_size)]
+
+    def app(self):
+        app = web.Application()
+        app.router.add_post("/v1beta/models/{target}", self.handle)
+        return app
+
+    async def handle(self, request):
+        self.requests += 1
+        await request.read()
+        if self.requests <= self.fail_first:
+            return web.Response(status=self.fail_status, headers={"Retry-After": "0"}, text="fake error")
+
+        _, _, method = request.match_info["target"].partition(":")
+        if method == "streamGenerateContent":
+            return await self.handle_stream(request)
+        if method == "generateContent":
+            await asyncio.sleep(self.first_delay + self.chunk_delay * len(self.chunks()))
+            return web.json_response(chunk_payload(self.reply))
+        return web.Response(status=404)
+
+    async def handle_stream(self, request):
+        response = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+        await response.prepare(request)
+        await asyncio.sleep(self.first_delay)
+        for chunk in self.chunks():
+            await asyncio.sleep(self.chunk_delay)
+            line = "data: " + json.dumps(chunk_payload(chunk), ensure_ascii=False) + "\r\n\r\n"
+            await response.write(line.encode())
+        await response.write_eof()
+        return response
+
+
+async def start_server(fake, host="127.0.0.1", port=0):
+    """サーバーを起動して (runner, base_url) を返す（GeminiClient の base_url に渡す）"""
+    runner = web.AppRunner(fake.app())
+    await runner.setup()
+    site = web.TCPSite(runner, host, port)
+    await site.start()
+    port = runner.addresses[0][1]
+    return runner, f"http://{host}:{port}/v1beta/models"
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Gemini API のローカル代用サーバー")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8081)
+    parser.add_argument("--chunk-size", type=int, default=8, help="1チャンクの文字数")
+    parser.add_argument("--chunk-delay", type=float, default=0.1, help="チャンクの間隔（秒）")
+    parser.add_argument("--first-delay", type=float, default=0.0, help="最初のチャンクまでの遅延（秒）")
+    args = parser.parse_args()
+
+    fake = FakeGemini(chunk_size=args.chunk_size, chunk_delay=args.chunk_delay, first_delay=args.first_delay)
+    web.run_app(fake.app(), host=args.host, port=args.port)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,249 @@
+"""Supabase(PostgREST) のローカル代用サーバー
+
+ボットが使うフィルタとヘッダ（eq. / in. / lt. など、order、Range、
+Prefer: resolution=merge-duplicates、on_conflict）だけを実装した
+インメモリのサーバー。遅延を入れたり、リクエスト数と転送量を数えたりできる。
+書き込みは Realtime 風の websocket（/realtime/v1/websocket）にも流す。
+
+    python bench/fake_postgrest.py --port 54321 --latency 0.02
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import sys
+
+from aiohttp import web
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from local_cache import row_matches, apply_order  # noqa: E402
+
+# テーブルごとの主キー（on_conflict を省略したときに使う）
+DEFAULT_KEYS = {
+    "notifications": "id",
+    "daily_notifications": "user_id",
+    "sleep_check_times": "user_id",
+    "chat_targets": "user_id",
+    "random_chat_schedule": "id",
+    "resin_notify_count": "id",
+    "conversation_logs": "id",
+}
+
+RESERVED_PARAMS = {"select", "order", "limit", "offset", "on_conflict"}
+
+
+class Stats:
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.requests = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.by_method = {}
+
+    def snapshot(self):
+        return {
+            "requests": self.requests,
+            "bytes_in": self.bytes_in,
+            "bytes_out": self.bytes_out,
+            "by_method": dict(self.by_method),
+        }
+
+
+class FakePostgrest:
+    """インメモリの PostgREST もどき"""
+
+    def __init__(self, latency=0.0, jitter=0.0, max_rows=1000, keys=None):
+        self.latency = latency
+        self.jitter = jitter
+        self.max_rows = max_rows
+        self.keys = dict(DEFAULT_KEYS, **(keys or {}))
+        self.tables = {}
+        self.stats = Stats()
+        self._sockets = set()
+        self._serial = 0
+        self._version = 0
+        self._query_cache = {}  # ページ送りのたびに全件を並べ直さないように
+
+    def rows(self, table):
+        return self.tables.setdefault(table, [])
+
+    def seed(self, table, rows):
+        self.rows(table).extend(dict(r) for r in rows)
+        self._version += 1
+
+    def app(self):
+        app = web.Application(middlewares=[self._middleware])
+        app.router.add_get("/realtime/v1/websocket", self._websocket)
+        app.router.add_route("*", "/rest/v1/{table}", self._handle)
+        return app
+
+    @web.middleware
+    async def _middleware(self, request, handler):
+        if request.path.startswith("/realtime"):
+            return await handler(request)
+        body = await request.read()
+        if self.latency or self.jitter:
+            await asyncio.sleep(self.latency + random.uniform(0, self.jitter))
+        response = await handler(request)
+        self.stats.requests += 1
+        self.stats.bytes_in += len(body) + len(request.raw_path)
+        self.stats.bytes_out += len(response.body or b"")
+        self.stats.by_method[request.method] = self.stats.by_method.get(request.method, 0) + 1
+        return response
+
+    def _filters(self, request):
+        return {k: v for k, v in request.query.items() if k not in RESERVED_PARAMS}
+
+    async def _handle(self, request):
+        table = request.match_info["table"]
+        method = request.method
+        if method == "GET":
+            return self._select(request, table)
+        if method == "POST":
+            return await self._insert(request, table)
+        if method == "PATCH":
+            return await self._update(request, table)
+        if method == "DELETE":
+            return self._delete(request, table)
+        return web.json_response({"message": "method not allowed"}, status=405)
+
+    def _select(self, request, table):
+        filters = self._filters(request)
+        cache_key = (table, request.query.get("order"), tuple(sorted(filters.items())))
+        cached = self._query_cache.get(cache_key)
+        if cached and cached[0] == self._version:
+            rows = cached[1]
+        else:
+            rows = [r for r in self.rows(table) if row_matches(r, filters)] if filters else list(self.rows(table))
+            rows = apply_order(rows, request.query.get("order"))
+            if len(self._query_cache) >= 16:
+                self._query_cache.clear()
+            self._query_cache[cache_key] = (self._version, rows)
+        start = int(request.query.get("offset", 0))
+        end = start + int(request.query.get("limit", self.max_rows)) - 1
+        if "Range" in request.headers:
+            first, _, last = request.headers["Range"].partition("-")
+            start, end = int(first), int(last) if last else start + self.max_rows - 1
+        end = min(end, start + self.max_rows - 1)
+        if start > 0 and start >= len(rows):
+            return web.json_response({"message": "Requested range not satisfiable"}, status=416)
+        page = rows[start:end + 1]
+        columns = request.query.get("select", "*")
+        if columns != "*":
+            names = [c.strip() for c in columns.split(",")]
+            page = [{c: r.get(c) for c in names} for r in page]
+        status = 206 if len(page) < len(rows) else 200
+        last = start + len(page) - 1 if page else start
+        headers = {"Content-Range": f"{start}-{last}/*"}
+        return web.Response(
+            text=json.dumps(page, ensure_ascii=False),
+            status=status,
+            content_type="application/json",
+            headers=headers
+        )
+
+    async def _insert(self, request, table):
+        payload = await request.json()
+        rows = payload if isinstance(payload, list) else [payload]
+        prefer = request.headers.get("Prefer", "")
+        merge = "resolution=merge-duplicates" in prefer
+        key = request.query.get("on_conflict", self.keys.get(table))
+        existing = self.rows(table)
+        index = {r.get(key): r for r in existing} if key else {}
+        for row in rows:
+            row = dict(row)
+            found = index.get(row.get(key)) if key and row.get(key) is not None else None
+            if found is not None:
+                if not merge:
+                    return web.json_response({"code": "23505", "message": "duplicate key"}, status=409)
+                found.update(row)
+                self._emit(table, "UPDATE", found)
+                continue
+            if key and row.get(key) is None and key == "id":
+                self._serial += 1
+                row[key] = self._serial
+            existing.append(row)
+            if key:
+                index[row.get(key)] = row
+            self._emit(table, "INSERT", row)
+        return web.Response(status=201)
+
+    async def _update(self, request, table):
+        values = await request.json()
+        filters = self._filters(request)
+        for row in self.rows(table):
+            if row_matches(row, filters):
+                row.update(values)
+                self._emit(table, "UPDATE", row)
+        return web.Response(status=204)
+
+    def _delete(self, request, table):
+        filters = self._filters(request)
+        kept = []
+        for row in self.rows(table):
+            if row_matches(row, filters):
+                self._emit(table, "DELETE", None, row)
+            else:
+                kept.append(row)
+        self.tables[table] = kept
+        return web.Response(status=204)
+
+    # --- Realtime もどき ---
+    async def _websocket(self, request):
+        ws = web.WebSocketResponse()
+        await ws.prepare(request)
+        self._sockets.add(ws)
+        try:
+            async for _ in ws:
+                pass  # join / heartbeat は読み捨てる
+        finally:
+            self._sockets.discard(ws)
+        return ws
+
+    def _emit(self, table, type, record, old_record=None):
+        self._version += 1
+        if not self._sockets:
+            return
+        message = {
+            "topic": "realtime:dorothy-sync",
+            "event": "postgres_changes",
+            "payload": {"data": {
+                "type": type,
+                "table": table,
+                "record": dict(record) if record else None,
+                "old_record": dict(old_record) if old_record else None,
+            }},
+            "ref": None
+        }
+        for ws in list(self._sockets):
+            asyncio.ensure_future(ws.send_json(message))
+
+
+async def start_server(fake, host="127.0.0.1", port=0):
+    """サーバーを起動して (runner, base_url) を返す"""
+    runner = web.AppRunner(fake.app())
+    await runner.setup()
+    site = web.TCPSite(runner, host, port)
+    await site.start()
+    port = runner.addresses[0][1]
+    return runner, f"http://{host}:{port}"
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Supabase(PostgREST) のローカル代用サーバー")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=54321)
+    parser.add_argument("--latency", type=float, default=0.0, help="リクエストごとの遅延（秒）")
+    parser.add_argument("--jitter", type=float, default=0.0, help="遅延に足すランダム幅（秒）")
+    parser.add_argument("--max-rows", type=int, default=1000, help="1回で返す最大件数")
+    args = parser.parse_args()
+
+    fake = FakePostgrest(latency=args.latency, jitter=args.jitter, max_rows=args.max_rows)
+    web.run_app(fake.app(), host=args.host, port=args.port)
+
+
+if __name__ == "__main__":
+    main()
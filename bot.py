@@ -1,30 +1,53 @@
-import discord
-import requests
-import aiohttp
-import json
 import time
-import uuid
-import datetime
-import pytz
-import base64
-import asyncio
-import logging
-import tweepy
-import random
-from flask import Flask, request, jsonify
-import threading
-import os
-import re
-from discord import app_commands
-from discord.ext import commands
-from apscheduler.schedulers.asyncio import AsyncIOScheduler
-from collections import deque  # メッセージ履歴の管理に使用
-from dotenv import load_dotenv
-import boto3
-import subprocess
-import stat
-import paramiko
-import io
+from contextlib import contextmanager
+
+# 起動時間のプロファイル（区間名 -> 秒）。コールドスタートが遅くなったら見えるように
+startup_profile = {}
+_process_started = time.perf_counter()
+
+@contextmanager
+def profile_startup(name):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        startup_profile[name] = time.perf_counter() - started
+
+with profile_startup("import:stdlib"):
+    import json
+    import uuid
+    import datetime
+    import base64
+    import asyncio
+    import logging
+    import random
+    import threading
+    import os
+    import re
+    import signal
+    from collections import deque  # メッセージ履歴の管理に使用
+with profile_startup("import:discord"):
+    import discord
+    from discord import app_commands
+    from discord.ext import commands
+with profile_startup("import:aiohttp"):
+    import aiohttp
+with profile_startup("import:apscheduler"):
+    import pytz
+    from apscheduler.schedulers.asyncio import AsyncIOScheduler
+with profile_startup("import:dotenv"):
+    from dotenv import load_dotenv
+with profile_startup("import:storage"):
+    from supabase_client import SupabaseClient
+    from local_cache import LocalCache, CachedSupabase
+    from repositories import TableRepository, ConversationStore, WriteBehindQueue
+    from change_feed import Change, RealtimeChangeFeed, realtime_url
+    from reminder_dispatcher import ReminderDispatcher, ReminderStore
+    import recurrence
+    from gemini_client import GeminiClient, GeminiError, SystemInstruction
+    from rephrase_cache import RephraseCache
+    from debounce import BurstDebouncer
+    from actor_queue import ActorQueue, QueueFull
 
 session = None 
 
@@ -55,41 +78,67 @@ SSH_HOST = os.getenv('SSH_HOST')
 SSH_PORT = int(os.getenv('SSH_PORT', 22))
 SSH_USER = os.getenv('SSH_USER')
 SSH_PRIVATE_KEY = os.getenv('SSH_PRIVATE_KEY')
+# 重いライブラリは機能を有効にしたときだけ読み込む
+ENABLE_HTTP_SERVER = os.getenv("ENABLE_HTTP_SERVER", "true").lower() == "true"
+ENABLE_TWITTER_BOT = os.getenv("ENABLE_TWITTER_BOT", "false").lower() == "true"
+
+def create_app():
+    from flask import Flask, request, jsonify
+
+    app = Flask(__name__)
+
+    @app.route("/")
+    def home():
+        return "Bot is alive!"
+
+    @app.route("/set_notification", methods=["POST"])
+    def set_notification_api():
+        data = request.json
+
+        if data.get("api_key") != API_KEY:
+            return jsonify({"error": "unauthorized"}), 401
+
+        asyncio.run_coroutine_threadsafe(
+            register_notification(
+                user_id=data["user_id"],
+                date=data["date"],
+                time=data["time"],
+                message=data["message"],
+                repeat=data.get("repeat", False),
+                recurrence_kind=data.get("recurrence"),
+                interval_days=int(data.get("interval_days", 1))
+            ),
+            bot.loop
+        )
 
-app = Flask(__name__)
+        return jsonify({"ok": True})
 
-@app.route("/")
-def home():
-    return "Bot is alive!"
+    @app.route("/shutdown", methods=["POST"])
+    def shutdown_notify():
+        # 止められる前に溜まっている変更を書き込んでおく
+        flush = asyncio.run_coroutine_threadsafe(write_queue.flush_all(), bot.loop)
+        try:
+            flush.result(timeout=15)
+        except Exception as e:
+            logger.error(f"⚠️ シャットダウン前の保存に失敗: {e}")
+        asyncio.run_coroutine_threadsafe(send_shutdown_message(), bot.loop)
+        return "ok"
 
-# Flask を別スレッドで実行
-def run():
-    app.run(host="0.0.0.0", port=int(os.getenv("PORT", 8000)))
+    @app.route("/metrics")
+    def metrics_api():
+        return jsonify({"todo": todo_metrics, "gemini": gemini.metrics, "persona": persona.metrics, "rephrase": rephrase_cache.stats(), "prefetch": prefetch_metrics, "dm_debounce": dm_debouncer.metrics, "chat": chat_actors.metrics, "supabase": supabase.stats()})
 
-@app.route("/set_notification", methods=["POST"])
-def set_notification_api():
-    data = request.json
-
-    if data.get("api_key") != API_KEY:
-        return jsonify({"error": "unauthorized"}), 401
-
-    asyncio.run_coroutine_threadsafe(
-        register_notification(
-            user_id=data["user_id"],
-            date=data["date"],
-            time=data["time"],
-            message=data["message"],
-            repeat=data.get("repeat", False)
-        ),
-        bot.loop
-    )
+    @app.route("/startup_profile")
+    def startup_profile_api():
+        return jsonify({name: round(sec * 1000, 1) for name, sec in startup_profile.items()})
 
-    return jsonify({"ok": True})
+    return app
 
-@app.route("/shutdown", methods=["POST"])
-def shutdown_notify():
-    asyncio.run_coroutine_threadsafe(send_shutdown_message(), bot.loop)
-    return "ok"
+# Flask を別スレッドで実行
+def run():
+    with profile_startup("init:flask"):
+        app = create_app()
+    app.run(host="0.0.0.0", port=int(os.getenv("PORT", 8000)))
 
 async def send_shutdown_message():
     channel_id = 1484875044223193168
@@ -102,19 +151,151 @@ async def send_shutdown_message():
     if channel:
         await channel.send("インスタンスをとめたよ！")
 
-thread = threading.Thread(target=run)
-thread.start()
+if ENABLE_HTTP_SERVER:
+    thread = threading.Thread(target=run)
+    thread.start()
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 # 設定
 
-SUPABASE_HEADERS = {
-    "apikey": SUPABASE_KEY,
-    "Authorization": f"Bearer {SUPABASE_KEY}",
-    "Content-Type": "application/json"
+# Supabase へのアクセスはすべてこのクライアント経由（イベントループを止めない）
+supabase_remote = SupabaseClient(
+    SUPABASE_URL,
+    SUPABASE_KEY,
+    max_concurrency=int(os.getenv("SUPABASE_MAX_CONCURRENCY", 10)),
+    timeout=float(os.getenv("SUPABASE_TIMEOUT", 10))
+)
+
+# テーブルごとの主キー（ローカルキャッシュで行を見分けるのに使う）
+CACHED_TABLES = {
+    "notifications": ("id",),
+    "daily_notifications": ("user_id",),
+    "sleep_check_times": ("user_id",),
+    "chat_targets": ("user_id",),
+    "conversation_logs": ("id",),
+    "random_chat_schedule": ("id",),
+    "resin_notify_count": ("id",),
+}
+# ローカルキャッシュで主キー以外に索引を張る列（ユーザーごとの削除・読み込み用）
+OWNER_COLUMNS = {
+    "notifications": "user_id",
+    "conversation_logs": "user_id",
+}
+# Supabase から取り直すときに取得する列（select=* にしない）
+TABLE_COLUMNS = {
+    "notifications": "id,user_id,date,time,message,repeat,recurrence",
+    "daily_notifications": "user_id,todos,hour,minute",
+    "sleep_check_times": "user_id,hour,minute",
+    "chat_targets": "user_id",
+    "conversation_logs": "id,user_id,role,content,created_at",
+    "random_chat_schedule": "id,run_time",
+    "resin_notify_count": "id,date,count",
+}
+# 後から足した列。Supabase にまだ無ければ外して読み書きする（migrations/ を参照）
+OPTIONAL_COLUMNS = {"notifications": ("recurrence",)}
+LOCAL_CACHE_PATH = os.getenv("LOCAL_CACHE_PATH", "local_cache.sqlite3")
+OUTBOX_REPLAY_SECONDS = int(os.getenv("OUTBOX_REPLAY_SECONDS", 30))
+
+# 読み込みはローカル(SQLite)から、書き込みは outbox を通して Supabase へ
+with profile_startup("init:local_cache"):
+    supabase = CachedSupabase(
+        supabase_remote,
+        LocalCache(LOCAL_CACHE_PATH, CACHED_TABLES, TABLE_COLUMNS, OWNER_COLUMNS),
+        optional_columns=OPTIONAL_COLUMNS
+    )
+
+# テーブルごとに変更された行だけを書き込む
+notification_repo = TableRepository(supabase, "notifications", key="id")
+daily_repo = TableRepository(supabase, "daily_notifications", key="user_id")
+sleep_check_repo = TableRepository(supabase, "sleep_check_times", key="user_id")
+chat_target_repo = TableRepository(supabase, "chat_targets", key="user_id")
+# 会話ログは追記のみ（古いターンは定期的にまとめて削除）
+conversation_store = ConversationStore(supabase)
+CONVERSATION_TRIM_MINUTES = int(os.getenv("CONVERSATION_TRIM_MINUTES", 30))
+
+# 変更はキューに溜めて、一定間隔か一定件数ごとにまとめて書き込む
+write_queue = WriteBehindQueue(
+    [notification_repo, daily_repo, sleep_check_repo, chat_target_repo, conversation_store],
+    interval=float(os.getenv("WRITE_BEHIND_INTERVAL", 5)),
+    max_pending=int(os.getenv("WRITE_BEHIND_MAX_PENDING", 50))
+)
+
+def schedule_save():
+    """変更を書き込みキューに載せる（DBへの書き込みは待たない）"""
+    write_queue.touch()
+
+# 他からの変更は Supabase Realtime で受け取る（1時間ごとの全件読み直しの代わり）
+ENABLE_REALTIME_SYNC = os.getenv("ENABLE_REALTIME_SYNC", "true").lower() == "true"
+SYNC_REPOS = {
+    "notifications": notification_repo,
+    "daily_notifications": daily_repo,
+    "sleep_check_times": sleep_check_repo,
+    "chat_targets": chat_target_repo,
 }
+change_feed = None
+if ENABLE_REALTIME_SYNC:
+    change_feed = RealtimeChangeFeed(
+        os.getenv("SUPABASE_REALTIME_URL") or realtime_url(SUPABASE_URL, SUPABASE_KEY),
+        SUPABASE_KEY,
+        list(SYNC_REPOS),
+        on_change=lambda change: apply_remote_change(change),
+        on_resync=lambda: resync_remote_changes()  # 切断中の取りこぼしを埋める
+    )
+
+# Gemini へのリクエストはすべてこのクライアント経由（接続の使い回し・同時数の上限・リトライ）
+gemini = GeminiClient(
+    GEMINI_API_KEY,
+    max_concurrency=int(os.getenv("GEMINI_MAX_CONCURRENCY", 4)),
+    timeout=float(os.getenv("GEMINI_TIMEOUT", 60)),
+    max_retries=int(os.getenv("GEMINI_MAX_RETRIES", 3)),
+    base_url=os.getenv("GEMINI_BASE_URL")
+)
+# 通知の言い換えはプロンプトごとにキャッシュして、同じ通知では Gemini を呼ばない
+rephrase_cache = RephraseCache(
+    max_entries=int(os.getenv("REPHRASE_CACHE_SIZE", 1000)),
+    ttl=float(os.getenv("REPHRASE_CACHE_TTL", 7 * 24 * 3600)),
+    variants=int(os.getenv("REPHRASE_CACHE_VARIANTS", 3)),
+    path=os.getenv("REPHRASE_CACHE_PATH", LOCAL_CACHE_PATH) or None
+)
+# 通知の言い換えは時刻の少し前に用意しておき、送るときは Discord に1回送るだけにする
+NOTIFICATION_PREFETCH_MINUTES = int(os.getenv("NOTIFICATION_PREFETCH_MINUTES", 15))
+NOTIFICATION_PREFETCH_INTERVAL = int(os.getenv("NOTIFICATION_PREFETCH_INTERVAL", 60))
+prefetch_metrics = {"runs": 0, "generated": 0, "already_cached": 0, "failed": 0, "fallbacks": 0}
+# 返事を streamGenerateContent で受け取り、1文できるたびに送る
+GEMINI_STREAMING = os.getenv("GEMINI_STREAMING", "true").lower() == "true"
+# 性格設定は systemInstruction で送る。true なら cachedContents に1回だけ登録して名前で参照する
+GEMINI_PERSONA_CACHE = os.getenv("GEMINI_PERSONA_CACHE", "false").lower() == "true"
+GEMINI_PERSONA_CACHE_TTL = int(os.getenv("GEMINI_PERSONA_CACHE_TTL", 3600))
+# DM を続けて送られたら、DM_DEBOUNCE_SECONDS 秒静かになるまで待って1回で返事する（0 で無効）
+DM_DEBOUNCE_SECONDS = float(os.getenv("DM_DEBOUNCE_SECONDS", 1.5))
+DM_DEBOUNCE_MAX_WAIT = float(os.getenv("DM_DEBOUNCE_MAX_WAIT", 6))
+# 会話はユーザーごとに1本のキューで順番に処理し、全体で CHAT_WORKERS 件まで同時に動かす
+CHAT_WORKERS = int(os.getenv("CHAT_WORKERS", 4))
+CHAT_QUEUE_DEPTH = int(os.getenv("CHAT_QUEUE_DEPTH", 3))
+CHAT_QUEUE_MAX = int(os.getenv("CHAT_QUEUE_MAX", 50))
+chat_actors = ActorQueue(max_workers=CHAT_WORKERS, max_depth=CHAT_QUEUE_DEPTH, max_pending=CHAT_QUEUE_MAX)
+
+# 単発の通知は APScheduler ではなく専用のタイマー（ヒープ1本）で送る。
+# 積んだ通知は SQLite に残し、止まっている間に過ぎたものは猶予内なら遅れて送る
+REMINDER_MISFIRE_GRACE = int(os.getenv("REMINDER_MISFIRE_GRACE", 3600))
+# 1回だけの通知が送れなかったら、この秒数ごとに猶予内で送り直す
+REMINDER_RETRY_SECONDS = int(os.getenv("REMINDER_RETRY_SECONDS", 60))
+# 同じユーザーの通知が数秒以内に重なったら、DMもGeminiへの問い合わせも1回にまとめる
+reminders = ReminderDispatcher(
+    lambda user_id, payloads: send_notification_message(user_id, [(fire_at, info) for fire_at, (_, info) in payloads]),
+    store=ReminderStore(os.getenv("REMINDER_STORE_PATH", LOCAL_CACHE_PATH)),
+    misfire_grace=REMINDER_MISFIRE_GRACE,
+    group_by=lambda payload: str(payload[0]),
+    group_window=float(os.getenv("REMINDER_GROUP_WINDOW", 5))
+)
+
+# 毎日のTodoは (時, 分) ごとに1ジョブ。その時刻のユーザーへ同時送信数を絞って配る
+TODO_SEND_CONCURRENCY = int(os.getenv("TODO_SEND_CONCURRENCY", 5))
+todo_buckets = {}     # (hour, minute) -> {user_id, ...}
+todo_bucket_of = {}   # user_id -> (hour, minute)
+todo_metrics = {}     # "HH:MM" -> 直近の配信結果
 
 # メッセージ履歴を管理（最大5件）
 conversation_logs = {}
@@ -122,6 +303,16 @@ conversation_logs = {}
  # user_idごとの時間設定 {"hour": int, "minute": int}
 sleep_check_times = {}
 
+# 睡眠チェックは1分ごとのタイマー1本で、その分に登録しているユーザーだけを見る
+sleep_buckets = {}    # (hour, minute) -> {user_id, ...}
+sleep_bucket_of = {}  # user_id -> (hour, minute)
+# 1分ごとのジョブが遅れたり飛ばされたりしたら、最後に見た分の次からこの分数までさかのぼって見る
+SLEEP_CHECK_CATCHUP_MINUTES = int(os.getenv("SLEEP_CHECK_CATCHUP_MINUTES", 10))
+sleep_check_last_minute = None  # 最後に見た分（JST、秒以下は切り捨て）
+# 睡眠チェックを登録しているユーザーのオンライン状態（on_presence_update で更新）
+PRESENCE_GUILD_IDS = set(GUILD_IDS) | {GUILD_ID}
+presence_status = {}  # user_id -> discord.Status
+
 # インテント設定
 intents = discord.Intents.default()
 intents.dm_messages = True
@@ -129,8 +320,34 @@ intents.message_content = True
 intents.presences = True
 intents.members = True 
 
-bot = commands.Bot(command_prefix="!", intents=intents)
-scheduler = AsyncIOScheduler(timezone=JST)
+class DorothyBot(commands.Bot):
+    async def setup_hook(self):
+        write_queue.start()
+        reminders.start()
+        # コンテナ停止(SIGTERM)でも close() を通して保存してから終わる
+        try:
+            self.loop.add_signal_handler(signal.SIGTERM, lambda: asyncio.create_task(self.close()))
+        except NotImplementedError:
+            pass
+
+    async def close(self):
+        await dm_debouncer.flush_all()
+        await chat_actors.stop()
+        if change_feed is not None:
+            await change_feed.stop()
+        await reminders.stop()
+        await write_queue.stop()
+        await supabase.close()
+        await gemini.close()
+        await super().close()
+
+with profile_startup("init:bot"):
+    bot = DorothyBot(command_prefix="!", intents=intents)
+    # 止まっていて過ぎたジョブは猶予内なら1回だけ実行する
+    scheduler = AsyncIOScheduler(
+        timezone=JST,
+        job_defaults={"coalesce": True, "misfire_grace_time": REMINDER_MISFIRE_GRACE}
+    )
 
 logger.info(f"使用中のAPIキー: {GEMINI_API_KEY[:10]}****")
 
@@ -147,104 +364,89 @@ async def send_dm(user_id: str, message: str):
     except Exception as e:
         logger.error(f"DM送信失敗: {e}")
 
-async def register_notification(user_id, date, time, message, repeat):
+async def register_notification(user_id, date, time, message, repeat, recurrence_kind=None, interval_days=1):
+    """通知を登録する。recurrence_kind は yearly / monthly / weekly / weekdays / every（repeat=True は毎年）"""
     if user_id not in notifications:
         notifications[user_id] = []
 
-    notifications[user_id].append({
+    info = {
         "id": str(uuid.uuid4()),
         "date": date,
         "time": time,
-        "message": message,
-        "repeat": repeat
-    })
+        "message": message
+    }
+    kind = recurrence_kind or (recurrence.YEARLY if repeat else None)
+    now = datetime.datetime.now(JST)
+    # 曜日（weekly）や開始日（every）は今日以降で次に来る date の日から決め、
+    # 初回は読み直したときと同じく、決まったルールで計算する
+    anchor = recurrence.next_occurrence(info, now.replace(hour=0, minute=0), JST)
+    info["recurrence"] = recurrence.make_rule(kind, anchor, interval_days)
+    info["repeat"] = info["recurrence"] is not None
+    info["next_fire_at"] = recurrence.next_occurrence(info, now, JST).timestamp()
+    notifications[user_id].append(info)
+    notification_repo.mark_upsert(notification_row(user_id, info))
 
-    save_notifications(notifications)
-    schedule_notifications()
+    schedule_save()
+    schedule_notification(user_id, info)
+    return info
     
 # --- ランダム会話ターゲット管理 ---
-def load_chat_targets():
-    url = f"{SUPABASE_URL}/rest/v1/chat_targets?select=*"
-    response = requests.get(url, headers=SUPABASE_HEADERS)
-    if response.status_code == 200:
-        return [str(row["user_id"]) for row in response.json()]
-    return []
-
-def save_chat_targets(targets):
-    """一括でUPSERT（上書き保存）する"""
-    if not targets:
-        return
-    insert_data = [{"user_id": uid} for uid in targets]
-    headers = SUPABASE_HEADERS.copy()
-    headers["Prefer"] = "resolution=merge-duplicates" # 重複があれば更新
-    requests.post(f"{SUPABASE_URL}/rest/v1/chat_targets", headers=headers, json=insert_data)
-
-chat_targets = load_chat_targets()
-
-def load_sleep_check_times():
-    url = f"{SUPABASE_URL}/rest/v1/sleep_check_times?select=*"
-    response = requests.get(url, headers=SUPABASE_HEADERS)
-    if response.status_code == 200:
-        return {row["user_id"]: {"hour": row["hour"], "minute": row["minute"]} for row in response.json()}
-    return {}
-
-def save_sleep_check_times(data):
-    """全ユーザー分を1回のリクエストで保存"""
-    all_rows = []
-    for user_id, time_data in data.items():
-        all_rows.append({
-            "user_id": user_id,
-            "hour": time_data["hour"],
-            "minute": time_data["minute"]
-        })
-    if all_rows:
-        headers = SUPABASE_HEADERS.copy()
-        headers["Prefer"] = "resolution=merge-duplicates"
-        requests.post(f"{SUPABASE_URL}/rest/v1/sleep_check_times", headers=headers, json=all_rows)
+async def load_chat_targets():
+    targets = []
+    async for rows in supabase.select_pages("chat_targets", columns="user_id"):
+        targets.extend(str(row["user_id"]) for row in rows)
+    return targets
+
+chat_targets = []
+
+async def load_sleep_check_times():
+    result = {}
+    async for rows in supabase.select_pages("sleep_check_times", columns="user_id,hour,minute"):
+        for row in rows:
+            result[row["user_id"]] = {"hour": row["hour"], "minute": row["minute"]}
+    return result
+
+def sleep_check_row(user_id, time_data):
+    return {
+        "user_id": user_id,
+        "hour": time_data["hour"],
+        "minute": time_data["minute"]
+    }
 
 # 会話ログの読み書き
-def load_conversation_logs():
-    url = f"{SUPABASE_URL}/rest/v1/conversation_logs?select=*"
-    response = requests.get(url, headers=SUPABASE_HEADERS)
-    if response.status_code == 200:
-        data = response.json()
-        logs = {}
-        for item in data:
+def utc_now_iso():
+    return datetime.datetime.now(datetime.timezone.utc).isoformat()
+
+async def load_conversation_logs():
+    logs = {}
+    pages = supabase.select_pages(
+        "conversation_logs",
+        {"order": "created_at.asc"},
+        columns="user_id,role,content,created_at"
+    )
+    async for rows in pages:
+        for item in rows:
             logs.setdefault(item["user_id"], []).append({
                 "role": item["role"],
-                "parts": [{"text": item["content"]}]
+                "parts": [{"text": item["content"]}],
+                "created_at": item.get("created_at")
             })
-        return logs
-    return {}
-
-def save_conversation_logs(logs):
-    for user_id, messages in logs.items():
-        # そのユーザーの会話ログだけ削除
-        url = f"{SUPABASE_URL}/rest/v1/conversation_logs?user_id=eq.{user_id}"
-        requests.delete(url, headers=SUPABASE_HEADERS)
-
-        # そのユーザーの会話ログを保存
-        insert_data = []
-        for m in messages:
-            insert_data.append({
-                "user_id": user_id,
-                "role": m["role"],
-                "content": m["parts"][0]["text"]
-            })
-        if insert_data:
-            requests.post(f"{SUPABASE_URL}/rest/v1/conversation_logs", headers=SUPABASE_HEADERS, json=insert_data)
+    return logs
+
+async def trim_conversation_logs():
+    """メモリに残っていない古い会話ログをDBから削除"""
+    await conversation_store.trim(conversation_logs)
 
 # ← 通知データ
-def load_notifications():
-    url = f"{SUPABASE_URL}/rest/v1/notifications?select=*"
-    response = requests.get(url, headers=SUPABASE_HEADERS)
-    if response.status_code == 200:
-        result = {}
-        seen_ids = set() 
-        
-        for row in response.json():
+async def load_notifications():
+    result = {}
+    seen_ids = set() 
+    
+    async for rows in supabase.select_pages("notifications", columns=TABLE_COLUMNS["notifications"]):
+        for row in rows:
 
-            if row.get("id") is None:
+            missing_id = row.get("id") is None
+            if missing_id:
                 row["id"] = str(uuid.uuid4())
 
             if row["id"] in seen_ids:
@@ -252,154 +454,171 @@ def load_notifications():
                 
             seen_ids.add(row["id"])
 
-            result.setdefault(row['user_id'], []).append({
-                "id": row["id"],
-                "date": row["date"],
-                "time": row["time"],
-                "message": row["message"],
-                "repeat": row.get("repeat", False)
-            })
-        return result
-    return {}
+            item = notification_from_row(row)
+            result.setdefault(row['user_id'], []).append(item)
+            if missing_id:
+                # 採番したIDは次回の保存で書き戻す
+                notification_repo.mark_upsert(notification_row(row['user_id'], item))
+    return result
+
+def notification_row(user_id, item):
+    return {
+        "id": item["id"],
+        "user_id": user_id, 
+        "date": item["date"],
+        "time": item["time"],
+        "message": item["message"],
+        "repeat": item.get("repeat", False),
+        "recurrence": item.get("recurrence")
+    }
 
-def save_notifications(notifications):
-    """削除ループを1回のリクエストに統合"""
-    python_ids = {item["id"] for items in notifications.values() for item in items if item.get("id") is not None}
-    
-    # 既存IDの取得
-    url = f"{SUPABASE_URL}/rest/v1/notifications?select=id"
-    existing = requests.get(url, headers=SUPABASE_HEADERS).json()
-    supabase_ids = {row["id"] for row in existing if row.get("id") is not None}
-
-    # 削除対象を一括で削除 (in演算子を使用)
-    delete_ids = supabase_ids - python_ids
-    if delete_ids:
-        ids_str = ",".join([f'"{id}"' for id in delete_ids])
-        del_url = f"{SUPABASE_URL}/rest/v1/notifications?id=in.({ids_str})"
-        requests.delete(del_url, headers=SUPABASE_HEADERS)
-
-    # 一括挿入/更新
-    all_rows = []
-    for user_id, items in notifications.items():
-        for item in items:
-            if item.get("id") is None:
-                item["id"] = str(uuid.uuid4())
-            all_rows.append({
-                "id": item["id"],
-                "user_id": user_id, 
-                "date": item["date"],
-                "time": item["time"],
-                "message": item["message"],
-                "repeat": item.get("repeat", False)
-            })
+def notification_from_row(row):
+    """DBの行からメモリ上の通知を作る（次回の通知時刻もここで1回だけ計算）"""
+    item = {
+        "id": row["id"],
+        "date": row["date"],
+        "time": row["time"],
+        "message": row["message"],
+        "repeat": row.get("repeat", False),
+        "recurrence": row.get("recurrence")
+    }
+    refresh_next_fire(item)
+    return item
+
+def refresh_next_fire(info, now=None):
+    """次回の通知時刻（UNIX秒）を計算して info["next_fire_at"] に入れる。形式がおかしければ None"""
+    try:
+        fire = recurrence.next_occurrence(info, now or datetime.datetime.now(JST), JST)
+    except ValueError:
+        info.pop("next_fire_at", None)
+        return None
+    info["next_fire_at"] = fire.timestamp()
+    return info["next_fire_at"]
+
+def sorted_notifications(user_id):
+    """次に来る順に並べた通知（一覧と削除の番号はこの順）"""
+    return sorted(
+        notifications.get(user_id, []),
+        key=lambda n: (n.get("next_fire_at", float("inf")), n["id"])
+    )
+
+notifications = {}
+
+def daily_from_row(row):
+    todos = row.get("todos") or []
+    if isinstance(todos, str):
+        try:
+            todos = json.loads(todos)
+        except:
+            todos = []
+    return {
+        "todos": todos,
+        "time": {
+            "hour": row.get("hour", 8),
+            "minute": row.get("minute", 0)
+        }
+    }
+
+async def load_daily_notifications():
+    result = {}
+    async for rows in supabase.select_pages("daily_notifications", columns="user_id,todos,hour,minute"):
+        for row in rows:
+            result[row["user_id"]] = daily_from_row(row)
+    return result
+
+def daily_row(user_id, val):
+    return {
+        "user_id": user_id,
+        "todos": json.dumps(val["todos"], ensure_ascii=False),
+        "hour": val["time"]["hour"],
+        "minute": val["time"]["minute"]
+    }
 
-    if all_rows:
-        upsert_headers = SUPABASE_HEADERS.copy()
-        upsert_headers["Prefer"] = "resolution=merge-duplicates"
-        requests.post(f"{SUPABASE_URL}/rest/v1/notifications", headers=upsert_headers, json=all_rows)
-    
-notifications = load_notifications()
-
-def load_daily_notifications():
-    url = f"{SUPABASE_URL}/rest/v1/daily_notifications?select=*"
-    response = requests.get(url, headers=SUPABASE_HEADERS)
-    if response.status_code == 200:
-        result = {}
-        for row in response.json():
-            todos = row.get("todos") or []
-            if isinstance(todos, str):
-                try:
-                    todos = json.loads(todos)
-                except:
-                    todos = []
-            result[row["user_id"]] = {
-                "todos": todos,
-                "time": {
-                    "hour": row.get("hour", 8),
-                    "minute": row.get("minute", 0)
-                }
-            }
-        return result
-    return {}
-
-def save_daily_notifications(daily_notifications):
-    """ループを排除し一括保存"""
-    all_rows = []
-    for user_id, val in daily_notifications.items():
-        all_rows.append({
-            "user_id": user_id,
-            "todos": json.dumps(val["todos"], ensure_ascii=False),
-            "hour": val["time"]["hour"],
-            "minute": val["time"]["minute"]
-        })
-    if all_rows:
-        headers = SUPABASE_HEADERS.copy()
-        headers["Prefer"] = "resolution=merge-duplicates"
-        requests.post(f"{SUPABASE_URL}/rest/v1/daily_notifications", headers=headers, json=all_rows)
 
 
 def schedule_sleep_check():
-    """睡眠チェックのスケジュールを設定"""
+    """睡眠チェックのバケットを作り直す（メモリ上の sleep_check_times から）"""
     logger.info("🌙 sleep_check_times をスケジューリングします...")
-    
-    # 既存の睡眠チェック関連ジョブを削除
-    for job in scheduler.get_jobs():
-        if "sleep_check_" in job.id:
-            scheduler.remove_job(job.id)
-    
-    # sleep_check_times を再読み込み
-    global sleep_check_times
-    sleep_check_times = load_sleep_check_times()
-    
-    # 各ユーザーの睡眠チェック時間をスケジュール
-    for user_id, time_data in sleep_check_times.items():
-        hour = time_data.get("hour", 1)
-        minute = time_data.get("minute", 0)
-        logger.info(f"🛌 スケジュール設定: ユーザー {user_id} → {hour}:{minute}")
-        
-        scheduler.add_job(
-            check_user_sleep_status,
-            'cron',
-            hour=hour,
-            minute=minute,
-            args=[user_id],
-            id=f"sleep_check_{user_id}",
-            replace_existing=True,
-            timezone=JST
-        )
+    sleep_buckets.clear()
+    sleep_bucket_of.clear()
+    presence_status.clear()  # 手元のメンバー情報から取り直す
+    for user_id in sleep_check_times:
+        schedule_user_sleep_check(user_id)
 
-def get_schedule(job_id: str):
-    url = f"{SUPABASE_URL}/rest/v1/random_chat_schedule?id=eq.{job_id}"
-    res = requests.get(url, headers=SUPABASE_HEADERS)
-    data = res.json()
+    add_sleep_check_tick()
+
+def add_sleep_check_tick():
+    # 1分ごとに、その分のバケットだけを見るジョブを1本
+    scheduler.add_job(
+        check_sleep_bucket,
+        'cron',
+        minute='*',
+        id="sleep_check_tick",
+        replace_existing=True,
+        timezone=JST
+    )
+
+def schedule_user_sleep_check(user_id):
+    """1ユーザー分の睡眠チェックだけを、その時刻のバケットに出し入れする"""
+    old_bucket = sleep_bucket_of.pop(user_id, None)
+    if old_bucket is not None:
+        users = sleep_buckets.get(old_bucket, set())
+        users.discard(user_id)
+        if not users:
+            sleep_buckets.pop(old_bucket, None)
+
+    time_data = sleep_check_times.get(user_id)
+    if time_data is None:
+        presence_status.pop(user_id, None)
+        return
+
+    hour = time_data.get("hour", 1)
+    minute = time_data.get("minute", 0)
+    logger.info(f"🛌 スケジュール設定: ユーザー {user_id} → {hour}:{minute}")
+    sleep_bucket_of[user_id] = (hour, minute)
+    sleep_buckets.setdefault((hour, minute), set()).add(user_id)
+    seed_presence(user_id)
+
+def seed_presence(user_id):
+    """イベントがまだ来ていないユーザーのオンライン状態を、手元のメンバー情報から埋める"""
+    if user_id in presence_status:
+        return
+    for guild_id in PRESENCE_GUILD_IDS:
+        guild = bot.get_guild(guild_id)
+        member = guild.get_member(int(user_id)) if guild else None
+        if member is not None:
+            presence_status[user_id] = member.status
+            return
+
+async def get_schedule(job_id: str):
+    data = await supabase.select("random_chat_schedule", {"id": f"eq.{job_id}"})
     if data:
         # UTC→JSTに変換
         return datetime.datetime.fromisoformat(data[0]["run_time"]).astimezone(JST)
     return None
 
 # スケジュールを保存/更新
-def save_schedule(job_id: str, run_time: datetime.datetime):
-    url = f"{SUPABASE_URL}/rest/v1/random_chat_schedule"
+async def save_schedule(job_id: str, run_time: datetime.datetime):
     payload = {
         "id": job_id,
         "run_time": run_time.astimezone(datetime.timezone.utc).isoformat()
     }
-    res = requests.post(url, headers=SUPABASE_HEADERS, data=json.dumps(payload))
-    if res.status_code not in (200, 201):
-        # 既存なら upsert
-        url = f"{SUPABASE_URL}/rest/v1/random_chat_schedule?id=eq.{job_id}"
-        requests.patch(url, headers=SUPABASE_HEADERS, data=json.dumps(payload))
+    # 既存なら上書き
+    await supabase.upsert("random_chat_schedule", payload, on_conflict="id")
 
 # スケジュールを削除
-def delete_schedule(job_id: str):
-    url = f"{SUPABASE_URL}/rest/v1/random_chat_schedule?id=eq.{job_id}"
-    requests.delete(url, headers=SUPABASE_HEADERS)
+async def delete_schedule(job_id: str):
+    await supabase.delete("random_chat_schedule", {"id": f"eq.{job_id}"})
 
 def start_twitter_bot():
-    logger.warning("🚫 Twitter Botは現在無効化されています。ENABLE_TWITTER_BOT=trueで有効化できます。")
-    return
+    if not ENABLE_TWITTER_BOT:
+        logger.warning("🚫 Twitter Botは現在無効化されています。ENABLE_TWITTER_BOT=trueで有効化できます。")
+        return
     
     try:
+        with profile_startup("import:tweepy"):
+            import tweepy
+
         auth = tweepy.OAuth1UserHandler(
             os.getenv("TWITTER_CONSUMER_KEY"),
             os.getenv("TWITTER_CONSUMER_SECRET"),
@@ -419,7 +638,10 @@ def start_twitter_bot():
                         continue  # 自分自身は無視
 
                     logger.info(f"📨 メンション受信: {tweet.full_text}")
-                    response_text = asyncio.run(get_gemini_response(str(tweet.user.id), tweet.full_text))
+                    # Bot のイベントループ上で実行する（セッションを共有しているため）
+                    response_text = asyncio.run_coroutine_threadsafe(
+                        get_gemini_response(str(tweet.user.id), tweet.full_text), bot.loop
+                    ).result()
 
                     api.update_status(
                         status=f"@{tweet.user.screen_name} {response_text}",
@@ -437,24 +659,46 @@ def start_twitter_bot():
     except Exception as e:
         logger.error(f"❌ TwitterBot起動エラー: {e}")
 
+def log_startup_profile():
+    """起動プロファイルを時間のかかった順にログに出す"""
+    logger.info("⏱️ 起動プロファイル:")
+    for name, sec in sorted(startup_profile.items(), key=lambda item: item[1], reverse=True):
+        logger.info(f"  {name}: {sec * 1000:.1f}ms")
+    try:
+        import resource
+        peak_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+        logger.info(f"  peak RSS: {peak_mb:.1f}MB")
+    except ImportError:
+        pass
+
 @bot.event
 async def on_ready():
-    global session, sleep_check_times
+    global session
     try:
         if session is None:
             session = aiohttp.ClientSession()
             
         await bot.change_presence(activity=discord.Game(name="ハニーとおしゃべり"))
         logger.error(f"Logged in as {bot.user}")
+        if scheduler.running:
+            # 2回目以降の on_ready（セッションの張り直し）は差分だけ確認する
+            ensure_schedules()
+            return
         await bot.tree.sync()
 
         # スケジューラーを開始
         scheduler.start()
         
-        # データを再読み込み
-        global daily_notifications
-        daily_notifications = load_daily_notifications()
-        sleep_check_times = load_sleep_check_times() 
+        # 全テーブルを並行して1回だけ読み込む
+        await hydrate_all_data()
+        if "ready" not in startup_profile:
+            startup_profile["init:hydration"] = hydration_timings["total"]
+            startup_profile["ready"] = time.perf_counter() - _process_started
+            log_startup_profile()
+
+        # 前回積んでいた通知を読み戻してから、足りない分だけ積む
+        if not reminders.restored:
+            restore_reminders()
 
         # すべてのジョブをクリアして再設定
         scheduler.remove_all_jobs()
@@ -462,9 +706,13 @@ async def on_ready():
         schedule_notifications()
         schedule_daily_todos()
         schedule_sleep_check() 
-        schedule_random_chats()
+        await schedule_random_chats()
         # schedule_resin_check()
 
+        # 今読み込んだばかりなので、最初の接続では取り直さない（繋ぎ直したときだけ差分を取る）
+        if change_feed is not None:
+            change_feed.start(resync_first=False)
+
         logger.error("スケジュールを設定しました。")
         logger.error("🗓️ sleep_check_times:", sleep_check_times)
         logger.error("スケジュールされたジョブ:")
@@ -478,37 +726,35 @@ async def on_ready():
 async def fix_content_duplicates(interaction: discord.Interaction):
     await interaction.response.defer(ephemeral=True)
 
-    # 1. DBから全データを取得
-    url = f"{SUPABASE_URL}/rest/v1/notifications?select=*"
-    response = requests.get(url, headers=SUPABASE_HEADERS)
-    if response.status_code != 200:
-        await interaction.followup.send("⚠️ データベースからのデータ取得に失敗したよ。", ephemeral=True)
-        return
-
-    all_rows = response.json()
+    # 1. DBから全データを取得（未保存の変更は先に書き込む）
+    await write_queue.flush_all()
     
     # 2. 内容をキーとして、ユニークなデータ（残すデータ）を決定
-    # キー: (user_id, date, time, message, repeat)
+    # キー: (user_id, date, time, message, repeat, recurrence)
     unique_data = {} 
+    total_rows = 0
     
-    for row in all_rows:
-        # IDがNULLの場合は、念のためここでUUIDを生成しておく（ガードレール）
-        if row.get("id") is None:
-            row["id"] = str(uuid.uuid4())
+    async for rows in supabase.select_pages("notifications", columns=TABLE_COLUMNS["notifications"]):
+        total_rows += len(rows)
+        for row in rows:
+            # IDがNULLの場合は、念のためここでUUIDを生成しておく（ガードレール）
+            if row.get("id") is None:
+                row["id"] = str(uuid.uuid4())
+                
+            # 通知内容でユニークキーを作成
+            key = (
+                row["user_id"],
+                row["date"],
+                row["time"],
+                row["message"],
+                row.get("repeat", False),
+                row.get("recurrence")
+            )
             
-        # 通知内容でユニークキーを作成
-        key = (
-            row["user_id"],
-            row["date"],
-            row["time"],
-            row["message"],
-            row.get("repeat", False)
-        )
-        
-        # 最初のデータ（=残すデータ）を格納
-        # 2つ目以降のデータは無視され、削除対象となる
-        if key not in unique_data:
-            unique_data[key] = row 
+            # 最初のデータ（=残すデータ）を格納
+            # 2つ目以降のデータは無視され、削除対象となる
+            if key not in unique_data:
+                unique_data[key] = row 
 
     
     # 3. データベースの全削除と再登録
@@ -518,20 +764,19 @@ async def fix_content_duplicates(interaction: discord.Interaction):
         await interaction.followup.send("データベースに通知データがないよ～！", ephemeral=True)
         return
         
-    deleted_count = len(all_rows) - len(clean_data_list)
+    deleted_count = total_rows - len(clean_data_list)
     
     await interaction.followup.send(f"🧹データベースのお掃除を始めるよ！内容が重複してるデータ **{deleted_count} 件**を削除して整理するね…", ephemeral=True)
     
     # Supabase上の全データを一旦削除
-    requests.delete(f"{SUPABASE_URL}/rest/v1/notifications", headers=SUPABASE_HEADERS)
+    await supabase.delete("notifications")
     
     # 重複のないきれいなデータだけを一括で再登録
-    save_url = f"{SUPABASE_URL}/rest/v1/notifications"
-    requests.post(save_url, headers=SUPABASE_HEADERS, json=clean_data_list)
+    await supabase.insert("notifications", clean_data_list)
     
     # 4. グローバル変数とスケジュールを更新
     global notifications
-    notifications = load_notifications() 
+    notifications = await load_notifications() 
     schedule_notifications()
 
     await interaction.followup.send(
@@ -546,41 +791,93 @@ async def delete_all_notifications(interaction: discord.Interaction):
     user_id = str(interaction.user.id)
     
     # Supabaseから当該ユーザーの全通知を削除
-    del_url = f"{SUPABASE_URL}/rest/v1/notifications?user_id=eq.{user_id}"
-    response = requests.delete(del_url, headers=SUPABASE_HEADERS)
+    response = await supabase.delete("notifications", {"user_id": f"eq.{user_id}"})
     
-    if response.status_code == 204:
+    if response.ok:
         # メモリからも削除
-        deleted_count = len(notifications.pop(user_id, []))
+        removed = notifications.pop(user_id, [])
+        notification_repo.discard(n["id"] for n in removed)
+        deleted_count = len(removed)
         
-        # スケジュールを更新
-        schedule_notifications()
+        # 消した通知のジョブだけ取り消す
+        for n in removed:
+            cancel_notification(n["id"])
 
         await interaction.followup.send(
             f"ハニーの通知を全部削除したよ！ ({deleted_count} 件)\n",
             ephemeral=True
         )
     else:
-        await interaction.followup.send(f"⚠️ データベースからの削除中にエラーが発生したよ！ (Status Code: {response.status_code})", ephemeral=True)
+        await interaction.followup.send(f"⚠️ データベースからの削除中にエラーが発生したよ！ (Status Code: {response.status})", ephemeral=True)
+
+@bot.event
+async def on_presence_update(before, after):
+    # 睡眠チェックを登録しているユーザーの状態だけを覚えておく
+    user_id = str(after.id)
+    if user_id in sleep_bucket_of and after.guild.id in PRESENCE_GUILD_IDS:
+        presence_status[user_id] = after.status
+
+def ensure_schedules():
+    """メモリ上の状態とジョブを突き合わせて、足りないものだけ足す
+
+    通信はしないし、ジョブが揃っていれば何も変えない（何度呼んでも同じ）。
+    再接続のたびに全部作り直すと、その間ジョブが抜けるのでこちらを使う。
+    """
+    if not scheduler.running:
+        scheduler.start()
+    reminders.start()
+    write_queue.start()
+
+    jobs = {job.id for job in scheduler.get_jobs()}
+    added = []
+    if not periodic_job_ids() <= jobs:
+        setup_periodic_reload()
+        added.append("periodic")
+
+    wanted_todos = {todo_job_id(hour, minute): (hour, minute) for hour, minute in todo_buckets}
+    for job_id in jobs:
+        if job_id.startswith("todo_") and job_id not in wanted_todos:
+            scheduler.remove_job(job_id)
+    for job_id, (hour, minute) in wanted_todos.items():
+        if job_id not in jobs:
+            add_todo_job(hour, minute)
+            added.append(job_id)
+
+    if sleep_buckets and "sleep_check_tick" not in jobs:
+        add_sleep_check_tick()
+        added.append("sleep_check_tick")
+    if "reset_random_chats" not in jobs:
+        # 午前のランダム会話は、実行済みなら翌日0時のリセットで積み直される
+        add_reset_random_chats_job()
+        added.append("reset_random_chats")
+
+    schedule_notifications()  # メモリとタイマーの差分だけ
+    if added:
+        logger.warning(f"🩹 抜けていたジョブを足しました: {', '.join(added)}")
+    else:
+        logger.info("✅ スケジュールはそのままで大丈夫だよ")
 
 @bot.event
 async def on_resumed():
-    logger.error("⚡ Botが再接続したよ！スケジュールを立て直すね！")
-    scheduler.remove_all_jobs()
-    setup_periodic_reload()
-    schedule_notifications()
-    schedule_daily_todos()
-    schedule_sleep_check()
-    schedule_random_chats()
-    # schedule_resin_check()
+    logger.error("⚡ Botが再接続したよ！スケジュールを確認するね！")
+    ensure_schedules()
 
 @bot.tree.command(name="set_notification", description="通知を設定するよ～！")
+@app_commands.choices(every=[
+    app_commands.Choice(name="毎年", value=recurrence.YEARLY),
+    app_commands.Choice(name="毎月", value=recurrence.MONTHLY),
+    app_commands.Choice(name="毎週", value=recurrence.WEEKLY),
+    app_commands.Choice(name="平日", value=recurrence.WEEKDAYS),
+    app_commands.Choice(name="○日ごと", value=recurrence.EVERY),
+])
 async def set_notification(
     interaction: discord.Interaction,
     date: str,
     time: str,
     message: str,
-    repeat: bool = False
+    repeat: bool = False,
+    every: str = None,
+    interval_days: int = 1
 ):
     
     await interaction.response.defer(ephemeral=True)
@@ -592,21 +889,27 @@ async def set_notification(
         await interaction.followup.send("日付か時刻の形式が正しくないよ～！", ephemeral=True)
         return
 
+    if interval_days < 1:
+        await interaction.followup.send("○日ごとは1日以上にしてね～！", ephemeral=True)
+        return
+
     await interaction.followup.send(
         f"⏳ 通知を登録中…ちょっと待ってね！", ephemeral=True
     )
 
     async def background_task():
-        await register_notification(
+        info = await register_notification(
             user_id=str(interaction.user.id),
             date=date,
             time=time,
             message=message,
-            repeat=repeat
+            repeat=repeat,
+            recurrence_kind=every,
+            interval_days=interval_days
         )
 
         await interaction.followup.send(
-            f'✅ {date} の {time} に "{message}" を登録したよ！リピート: {"あり" if repeat else "なし"}',
+            f'✅ {format_next_fire(info)} に "{message}" を登録したよ！リピート: {recurrence.describe(info["recurrence"])}',
             ephemeral=True
         )
         
@@ -631,16 +934,19 @@ async def add_anniversary(interaction: discord.Interaction, date: str, time: str
     if user_id not in notifications:
         notifications[user_id] = []
 
-    notifications[user_id].append({
+    info = {
         "id": str(uuid.uuid4()),
         "date": date,
         "time": time,
         "message": message,
-        "repeat": True  # 毎年リピート
-    })
+        "repeat": True,  # 毎年リピート
+        "recurrence": recurrence.YEARLY
+    }
+    notifications[user_id].append(info)
+    notification_repo.mark_upsert(notification_row(user_id, info))
 
-    save_notifications(notifications)
-    schedule_notifications()
+    schedule_save()
+    schedule_notification(user_id, info)
 
     await interaction.followup.send(
         f"🎉 {date} の {time} に毎年「{message}」を通知するように登録したよ！",
@@ -666,21 +972,17 @@ async def set_notification_after(interaction: discord.Interaction, hours: int, m
         "date": future_time.strftime("%m-%d"),
         "time": future_time.strftime("%H:%M"),
         "message": message,
-        "repeat": False
+        "repeat": False,
+        "recurrence": None,
+        "next_fire_at": future_time.timestamp()
     }
 
     if user_id not in notifications:
         notifications[user_id] = []
     notifications[user_id].append(info)
-    save_notifications(notifications)
-
-    scheduler.add_job(
-        send_notification_message,
-        'date',
-        run_date=future_time,
-        args=[user_id, info.copy()],
-        id=f"after_notification_{user_id}_{int(future_time.timestamp())}"
-    )
+    notification_repo.mark_upsert(notification_row(user_id, info))
+    schedule_save()
+    schedule_notification(user_id, info)
 
     await interaction.followup.send(
         f"⏰ {hours}時間{minutes}分後（{future_time.strftime('%H:%M')}）に「{message}」を通知するよ～！",
@@ -698,13 +1000,10 @@ async def list_notifications(interaction: discord.Interaction):
         await interaction.followup.send("登録されてる通知はないよ～", ephemeral=True)
         return
 
-    sorted_list = sorted(
-        notifications[user_id],
-        key=lambda n: (n["date"], n["time"], n["id"])
-    )
+    sorted_list = sorted_notifications(user_id)
 
     notif_texts = [
-        f"{i+1} : {n['date']} / {n['time']} - {n['message']}"
+        f"{i+1} : {format_next_fire(n)} ({recurrence.describe(recurrence.rule_of(n))}) - {n['message']}"
         for i, n in enumerate(sorted_list)
     ]
 
@@ -730,10 +1029,7 @@ async def remove_notification(interaction: discord.Interaction, index: int):
         await interaction.followup.send("登録されてる通知はないよ～", ephemeral=True)
         return
 
-    sorted_list = sorted(
-        notifications[user_id],
-        key=lambda n: (n["date"], n["time"], n["id"])
-    )
+    sorted_list = sorted_notifications(user_id)
 
     if index < 1 or index > len(sorted_list):
         await interaction.followup.send("指定された番号の通知が見つからないよ～", ephemeral=True)
@@ -749,69 +1045,149 @@ async def remove_notification(interaction: discord.Interaction, index: int):
 
     removed = target_notification
     removed_id = removed["id"]
-    del_url = f"{SUPABASE_URL}/rest/v1/notifications?id=eq.{removed_id}"
-    requests.delete(del_url, headers=SUPABASE_HEADERS)
+    notification_repo.mark_delete(removed_id)
 
-    save_notifications(notifications)
-    schedule_notifications()
+    schedule_save()
+    cancel_notification(removed_id)
 
     await interaction.followup.send(
         f"🗑️ 「{removed['message']}」の通知を削除したよ～！",
         ephemeral=True
     )
 
-async def send_notification_message(user_id, info):
+def notification_prompt(base_messages):
+    """通知を言い換えてもらうプロンプト（同じ通知なら並び順によらず同じ文字列になる）"""
+    base_messages = sorted(base_messages)
+    if len(base_messages) == 1:
+        target = f"メッセージ: {base_messages[0]}"
+        length = "・短く、1〜2文以内で\n"
+    else:
+        target = "予定:\n" + "\n".join(f"- {m}" for m in base_messages)
+        length = "・全部の予定にまとめて触れる一言にして、2〜3文以内で\n"
+
+    return (
+        f"あなたはDiscordでハニーに通知を送る可愛いAI「ドロシー」です。\n"
+        f"次の文章はハニーが登録した予定や行動（例：お風呂に入る、勉強する、寝るなど）です。\n"
+        f"その内容をもとに、ハニーに自然に声をかけるような一言メッセージを作ってください。\n\n"
+        f"条件:\n"
+        f"・語尾をやわらかく（〜だよ、〜ね、〜よ〜）などにする\n"
+        f"・少しテンション高めで、優しい雰囲気\n"
+        f"・できるだけ自然に通知として成立するようにする\n"
+        f"{length}"
+        f"・文章の意味を変えず、自然に言い換える\n\n"
+        f"{target}"
+    )
+
+async def generate_rephrase(prompt):
+    """Gemini に言い換えてもらい、うまくいったらキャッシュに足す"""
+    response = await gemini.generate([{"role": "user", "parts": [{"text": prompt}]}], **await persona_body())
+    if not response.ok:
+        persona_failed(response.status)
+        return None
+    text = response.text().strip()
+    if text:
+        rephrase_cache.add(prompt, text)
+    return text
+
+rephrase_tasks = {}  # 裏で言い換えを作っているプロンプト -> Task（途中で回収されないように持っておく）
+
+def prepared_rephrase(prompt, recurring=False):
+    """先に用意しておいた言い換えを返す（無ければ None）。ここでは Gemini を待たない
+
+    繰り返しの通知なら、次回のために裏で言い換えを足しておく。
+    1回だけの通知は同じプロンプトがもう来ないので作らない。
+    """
+    cached = rephrase_cache.get(prompt)
+    if recurring and prompt not in rephrase_tasks and (cached is None or rephrase_cache.needs_variant(prompt)):
+        task = asyncio.create_task(generate_rephrase(prompt))
+        rephrase_tasks[prompt] = task
+        task.add_done_callback(lambda _: rephrase_tasks.pop(prompt, None))
+    return cached
+
+async def prefetch_notification_phrasing():
+    """NOTIFICATION_PREFETCH_MINUTES 分以内に送る通知の言い換えを、先に作っておく"""
+    prefetch_metrics["runs"] += 1
+    until = time.time() + NOTIFICATION_PREFETCH_MINUTES * 60
+    # 送るときと同じく、同じユーザーで REMINDER_GROUP_WINDOW 秒以内の通知は1つにまとめる
+    for _, items in reminders.upcoming_groups(until):
+        prompt = notification_prompt([info["message"] for _, _, (_, info) in items])
+        if rephrase_cache.contains(prompt):
+            prefetch_metrics["already_cached"] += 1
+            continue
+        if await generate_rephrase(prompt) is None:
+            prefetch_metrics["failed"] += 1
+        else:
+            prefetch_metrics["generated"] += 1
+
+async def send_notification_message(user_id, fired):
+    """同じタイミングの通知をまとめて DM 1通で送る（言い換えは先に用意したもの）
+
+    fired は [(実際に積んでいた発火時刻, info), ...]。繰り返しの通知は、
+    送れなかったときも含めて、その時刻の次の回を積み直す。
+    """
+    infos = [info for _, info in fired]
+    sent = False
     try:
-        user = await bot.fetch_user(int(user_id))
+        user = bot.get_user(int(user_id)) or await bot.fetch_user(int(user_id))
         if not user:
             return
 
-        base_message = info["message"]
-
-        prompt = (
-            f"{CHARACTER_PERSONALITY}\n\n"
-            f"あなたはDiscordでハニーに通知を送る可愛いAI「ドロシー」です。\n"
-            f"次の文章はハニーが登録した予定や行動（例：お風呂に入る、勉強する、寝るなど）です。\n"
-            f"その内容をもとに、ハニーに自然に声をかけるような一言メッセージを作ってください。\n\n"
-            f"条件:\n"
-            f"・語尾をやわらかく（〜だよ、〜ね、〜よ〜）などにする\n"
-            f"・少しテンション高めで、優しい雰囲気\n"
-            f"・できるだけ自然に通知として成立するようにする\n"
-            f"・短く、1〜2文以内で\n"
-            f"・文章の意味を変えず、自然に言い換える\n\n"
-            f"メッセージ: {base_message}"
+        base_messages = [info["message"] for info in infos]
+        natural_text = prepared_rephrase(
+            notification_prompt(base_messages),
+            recurring=any(recurrence.rule_of(info) for info in infos)
         )
+        if natural_text is None:
+            # 用意が間に合わなかったら、言い換えずにそのまま送る
+            prefetch_metrics["fallbacks"] += 1
+            natural_text = "ハニー、時間だよ～！"
 
-        natural_text = await get_gemini_response_no_history(prompt)
-
-        final_message = f"{natural_text}\n\n予定：{base_message}"
+        if len(base_messages) == 1:
+            final_message = f"{natural_text}\n\n予定：{base_messages[0]}"
+        else:
+            final_message = f"{natural_text}\n\n予定：\n" + "\n".join(f"- {m}" for m in base_messages)
 
         await user.send(final_message)
-
-        uid = str(user_id)
-        if uid in notifications:
-
-            for notif in notifications[uid]:
-                if notif.get("id") == info.get("id"):
-
-                    if notif.get("repeat", False):
-                        now = datetime.datetime.now(JST)
-                        next_year_date = datetime.datetime.strptime(
-                            f"{now.year}-{notif['date']}", "%Y-%m-%d"
-                        ) + datetime.timedelta(days=365)
-                        notif["date"] = next_year_date.strftime("%m-%d")
-
-                    else:
-                        notifications[uid].remove(notif)
-
-                    save_notifications(notifications)
-                    schedule_notifications()
-                    break
+        sent = True
 
     except discord.NotFound:
         logger.error(f"Error: User with ID {user_id} not found.")
     except Exception as e:
         logger.error(f"通知送信中にエラー: {e}")
+    finally:
+        rearm_fired_notifications(str(user_id), fired, sent)
+
+def rearm_fired_notifications(uid, fired, sent):
+    """送った（送ろうとした）通知の後片付け。繰り返しは次回を積み、1回だけのものは送れたら消す。
+    送れなかった1回だけの通知は、元の時刻から猶予内のあいだ少し後に積み直す"""
+    fired_at_of = {info.get("id"): fire_at for fire_at, info in fired}
+    for notif in list(notifications.get(uid, [])):
+        if notif.get("id") not in fired_at_of:
+            continue
+
+        # 読み直しで next_fire_at が先に進んでいても、実際に鳴った回の次を求める
+        fired_at = datetime.datetime.fromtimestamp(fired_at_of[notif["id"]], JST)
+        next_fire = recurrence.following_occurrence(notif, fired_at, JST)
+        if next_fire is not None:
+            # 繰り返しは date を基準日のまま残し、次回の時刻だけ進める（DBへの書き込みは無し）
+            notif["next_fire_at"] = next_fire.timestamp()
+            schedule_notification(uid, notif)
+
+        elif sent:
+            notifications[uid].remove(notif)
+            notification_repo.mark_delete(notif["id"])
+            cancel_notification(notif["id"])
+
+        else:
+            due = notif.get("next_fire_at") or fired_at_of[notif["id"]]
+            retry_at = time.time() + REMINDER_RETRY_SECONDS
+            if retry_at - due > REMINDER_MISFIRE_GRACE:
+                drop_missed_notification(uid, notif["id"])
+            else:
+                logger.warning(f"🔁 通知 {notif['id']} を送れなかったので {REMINDER_RETRY_SECONDS} 秒後に送り直します")
+                reminders.schedule(notif["id"], retry_at, (uid, notif))
+
+    schedule_save()
 
 @bot.tree.command(name="add_daily_todo", description="毎日送信する通知を追加するよ！")
 async def add_daily_todo(interaction: discord.Interaction, message: str):
@@ -822,7 +1198,8 @@ async def add_daily_todo(interaction: discord.Interaction, message: str):
         daily_notifications[user_id] = {"todos": [], "time": {"hour": 8, "minute": 0}}  # デフォルト8:00
 
     daily_notifications[user_id]["todos"].append(message)
-    save_daily_notifications(daily_notifications)
+    daily_repo.mark_upsert(daily_row(user_id, daily_notifications[user_id]))
+    schedule_save()
     await interaction.followup.send(f'✅ "{message}" って毎日通知するね～！', ephemeral=True)
 
 
@@ -854,7 +1231,8 @@ async def remove_daily_todo(interaction: discord.Interaction, index: int):
         return
 
     removed = user_data["todos"].pop(index - 1)
-    save_daily_notifications(daily_notifications)
+    daily_repo.mark_upsert(daily_row(user_id, user_data))
+    schedule_save()
     await interaction.followup.send(f"✅ 「{removed}」を削除したよ～！", ephemeral=True)
 
 
@@ -872,8 +1250,9 @@ async def set_daily_time(interaction: discord.Interaction, hour: int, minute: in
     else:
         daily_notifications[user_id]["time"] = {"hour": hour, "minute": minute}
 
-    save_daily_notifications(daily_notifications)
-    schedule_daily_todos()
+    daily_repo.mark_upsert(daily_row(user_id, daily_notifications[user_id]))
+    schedule_save()
+    schedule_daily_todo(user_id)
 
     await interaction.followup.send(f"✅ 毎日 {hour:02d}:{minute:02d} に通知するように設定したよ！", ephemeral=True)
 
@@ -997,8 +1376,9 @@ async def set_sleep_check_time(interaction: discord.Interaction, hour: int, minu
 
     user_id = str(interaction.user.id)
     sleep_check_times[user_id] = {"hour": hour, "minute": minute}
-    save_sleep_check_times(sleep_check_times)
-    schedule_sleep_check()
+    sleep_check_repo.mark_upsert(sleep_check_row(user_id, sleep_check_times[user_id]))
+    schedule_save()
+    schedule_user_sleep_check(user_id)
 
     await interaction.followup.send(f"✅ 毎日 {hour:02d}:{minute:02d} に寝たほうがいいよ～メッセージを送るようにしたよ！", ephemeral=True)
 
@@ -1029,91 +1409,116 @@ CHARACTER_PERSONALITY = """
 ・全体として、会話しているようなリアルなテンポで話してください。
 ・長文や説明口調にならないようにしてください。
 """
-async def get_gemini_response(user_id, user_input):
-    global session
+persona = SystemInstruction(
+    gemini,
+    CHARACTER_PERSONALITY,
+    use_cache=GEMINI_PERSONA_CACHE,
+    ttl=GEMINI_PERSONA_CACHE_TTL
+)
+
+async def persona_body():
+    """性格設定を付けるための generate() / stream() の追加フィールド"""
+    return await persona.body()
+
+def persona_failed(status):
+    # キャッシュの期限切れなどで断られたら、次から作り直す
+    if persona.name and status in (400, 403, 404):
+        persona.invalidate()
+
+def begin_chat_turn(user_id, user_input):
+    """ユーザーの発言を履歴に足して、Gemini に送る messages を作る"""
     if user_id not in conversation_logs:
         conversation_logs[user_id] = []
 
     now = datetime.datetime.now(JST)
     current_time = now.strftime("%Y-%m-%d %H:%M:%S")
-    conversation_logs[user_id].append({
+    user_entry = {
         "role": "user",
         "parts": [{"text": user_input}],
-        "timestamp": current_time
-    })
+        "timestamp": current_time,
+        "created_at": utc_now_iso()
+    }
+    conversation_logs[user_id].append(user_entry)
     conversation_logs[user_id] = conversation_logs[user_id][-20:]  # トークン節約のため10件に減らす
 
-    messages = [{"role": "user", "parts": [{"text": CHARACTER_PERSONALITY}]}]
+    messages = []
     for m in conversation_logs[user_id]:
         messages.append({
             "role": m["role"],
             "parts": m["parts"]
         })
-
-    url = "https://generativelanguage.googleapis.com/v1beta/models/gemini-2.5-flash:generateContent"  # ← 修正
-    headers = {"Content-Type": "application/json"}
-    params = {"key": GEMINI_API_KEY}
-    data = {"contents": messages}
-
-    async with session.post(url, headers=headers, params=params, json=data) as response:
-        logger.error(f"Gemini API status: {response.status}")
-        if response.status == 200:
-            response_json = await response.json()
-            reply_text = response_json.get("candidates", [{}])[0].get("content", {}).get("parts", [{}])[0].get("text", "エラー: 応答が取得できませんでした。")
-            sentences = reply_text.split("。")
-            reply_text = "。".join(sentences[:4]).strip()
-
-            conversation_logs[user_id].append({
-                "role": "model",
-                "parts": [{"text": reply_text}],
-                "timestamp": current_time
-            })
-            conversation_logs[user_id] = conversation_logs[user_id][-7:]
-            save_conversation_logs(conversation_logs)
-            return reply_text
-        else:
-            if response.status == 429:
-                return "⚠️ 今はおしゃべりの回数が上限に達しちゃったみたい！明日また話そうね～！"
-            else:
-                return f"⚠️ ごめんね、うまくお返事できなかったよ～！（{response.status}）"
-
-async def get_gemini_response_no_history(prompt):
-    global session
-
-    url = "https://generativelanguage.googleapis.com/v1beta/models/gemini-2.5-flash:generateContent"
-    headers = {"Content-Type": "application/json"}
-    params = {"key": GEMINI_API_KEY}
-
-    data = {
-        "contents": [
-            {"role": "user", "parts": [{"text": prompt}]}
-        ]
+    return messages, user_entry
+
+def finish_chat_turn(user_id, user_entry, reply_text):
+    """返事を履歴に足して、発言と返事をまとめて保存キューに載せる"""
+    model_entry = {
+        "role": "model",
+        "parts": [{"text": reply_text}],
+        "timestamp": user_entry["timestamp"],
+        "created_at": utc_now_iso()
     }
+    conversation_logs[user_id].append(model_entry)
+    conversation_logs[user_id] = conversation_logs[user_id][-7:]
+    conversation_store.append(user_id, user_entry)
+    conversation_store.append(user_id, model_entry)
+    schedule_save()
 
-    async with session.post(url, headers=headers, params=params, json=data) as response:
-        if response.status == 200:
-            response_json = await response.json()
-            reply_text = response_json.get("candidates", [{}])[0].get("content", {}).get("parts", [{}])[0].get("text", "")
-            return reply_text
-        else:
-            return f"エラー: {response.status}"
+def gemini_error_message(status):
+    if status == 429:
+        return "⚠️ 今はおしゃべりの回数が上限に達しちゃったみたい！明日また話そうね～！"
+    return f"⚠️ ごめんね、うまくお返事できなかったよ～！（{status}）"
 
-async def get_gemini_response_with_image(user_id, user_input, image_bytes=None, image_mime_type="image/png"):
-    global session
-    if user_id not in conversation_logs:
-        conversation_logs[user_id] = []
+async def get_gemini_response(user_id, user_input):
+    messages, user_entry = begin_chat_turn(user_id, user_input)
+
+    response = await gemini.generate(messages, **await persona_body())
+    logger.info(f"Gemini API status: {response.status}（リトライ {response.retries} 回 / {response.latency * 1000:.0f}ms）")
+    if response.ok:
+        reply_text = response.text("エラー: 応答が取得できませんでした。")
+        sentences = reply_text.split("。")
+        reply_text = "。".join(sentences[:4]).strip()
+        finish_chat_turn(user_id, user_entry, reply_text)
+        return reply_text
+    else:
+        persona_failed(response.status)
+        return gemini_error_message(response.status)
 
-    # 1. 最初に性格設定を入れる
-    messages = [{"role": "user", "parts": [{"text": CHARACTER_PERSONALITY}]}]
+async def stream_gemini_response(user_id, user_input):
+    """get_gemini_response のストリーミング版。できた文から1つずつ返す（「。」4つまで）"""
+    messages, user_entry = begin_chat_turn(user_id, user_input)
+    sentences = []
+    try:
+        async for sentence in gemini.stream_sentences(messages, max_sentences=4, **await persona_body()):
+            sentences.append(sentence)
+            yield sentence.strip().rstrip("。")  # 今までどおり「。」は付けずに送る
+    except GeminiError as e:
+        persona_failed(e.status)
+        raise
+    if sentences:
+        finish_chat_turn(user_id, user_entry, "".join(sentences).strip())
+
+async def send_streaming_reply(message, mention=None, content=None):
+    """入力中を出しながら、Gemini の返事を1文ずつチャンネルに送る（content で発言を差し替えられる）"""
+    user_id = str(message.author.id)
+    if content is None:
+        content = message.content
+    first = True
+    async with message.channel.typing():
+        try:
+            async for sentence in stream_gemini_response(user_id, content):
+                if not sentence:
+                    continue
+                await message.channel.send(f"{mention} {sentence}" if first and mention else sentence)
+                first = False
+        except GeminiError as e:
+            await message.channel.send(gemini_error_message(e.status))
+    logger.info(f"Gemini ストリーミング: 最初のチャンクまで {gemini.metrics['last_first_chunk_ms']}ms / 全体 {gemini.metrics['last_latency_ms']}ms")
 
-    # 2. 過去の履歴を追加する
-    for m in conversation_logs[user_id]:
-        messages.append({
-            "role": m["role"],
-            "parts": m["parts"]
-        })
+async def get_gemini_response_with_image(user_id, user_input, image_bytes=None, image_mime_type="image/png"):
+    # 履歴には文字だけ残す（画像だけのときは「画像を送ったよ」）
+    messages, user_entry = begin_chat_turn(user_id, user_input or "画像を送ったよ")
 
-    # 3. 今回の入力（テキストと画像）を組み立てる
+    # 今回の入力（テキストと画像）を組み立てる
     parts = []
     if user_input:
         parts.append({"text": user_input})
@@ -1125,72 +1530,56 @@ async def get_gemini_response_with_image(user_id, user_input, image_bytes=None,
                 "data": base64_image
             }
         })
+    messages[-1] = {"role": "user", "parts": parts}
 
-    # 4. 今回分を messages に追加
-    messages.append({"role": "user", "parts": parts})
-
-    url = "https://generativelanguage.googleapis.com/v1beta/models/gemini-2.5-flash:generateContent"
-    headers = {"Content-Type": "application/json"}
-    params = {"key": GEMINI_API_KEY}
-    data = {"contents": messages}
-
-    async with session.post(url, headers=headers, params=params, json=data) as response:
-        if response.status == 200:
-            response_json = await response.json()
-            reply_text = response_json.get("candidates", [{}])[0].get("content", {}).get("parts", [{}])[0].get("text", "エラー: 応答が取得できませんでした。")
-            
-            # --- ここに履歴を保存する処理を追加しておくと、次回の会話に繋がります ---
-            now = datetime.datetime.now(JST)
-            current_time = now.strftime("%Y-%m-%d %H:%M:%S")
-            
-            # ユーザーの入力を保存 (parts の中身をリストにする)
-            user_text = user_input if user_input else "画像を送ったよ"
-            conversation_logs[user_id].append({
-                "role": "user", 
-                "parts": [{"text": user_text}], # ここをリスト形式に
-                "timestamp": current_time
-            })
-            
-            # AIの返答を保存
-            conversation_logs[user_id].append({
-                "role": "model", 
-                "parts": [{"text": reply_text}], # ここをリスト形式に
-                "timestamp": current_time
-            })
-            
-            return reply_text
-        else:
-            return f"エラー: {response.status} - {await response.text()}"
-
-# ユーザーごとの「今回メッセージでメンション済み」フラグ
-user_mentioned_this_msg = {}
-
-@bot.event
-async def on_message(message):
-    if message.author == bot.user:
+    response = await gemini.generate(messages, **await persona_body())
+    if response.ok:
+        reply_text = response.text("エラー: 応答が取得できませんでした。")
+        finish_chat_turn(user_id, user_entry, reply_text)
+        return reply_text
+    else:
+        persona_failed(response.status)
+        return f"エラー: {response.status} - {response.body}"
+
+async def reply_to_dm_burst(user_id, messages):
+    """続けて届いた DM を1つの発言にまとめて、1回だけ返事する"""
+    last = messages[-1]
+    content = "\n".join(m.content for m in messages if m.content)
+    if len(messages) > 1:
+        logger.info(f"📨 {user_id} の DM {len(messages)} 件をまとめて返事します")
+    if GEMINI_STREAMING:
+        await send_streaming_reply(last, content=content)
+        return
+    response = await get_gemini_response(user_id, content)
+    sentences = [s.strip() for s in re.split(r'[。\n]+', response) if s.strip()]
+    for s in sentences:
+        await last.channel.send(s)
+        await asyncio.sleep(1.2)
+
+async def submit_chat(message, job):
+    """会話の処理をそのユーザーのキューに積む。混んでいたら断りの返事だけする"""
+    if chat_actors.submit(str(message.author.id), job):
         return
+    logger.warning(f"⚠️ {message.author} の会話キューがいっぱいなので断りました")
+    await message.channel.send("ごめんね、今ちょっとお返事がいっぱいなの！少し待ってからもう一回話しかけてね～")
 
-    logger.info(f"📩 受信: guild={message.guild.id if message.guild else 'DM'} "
-                f"author={message.author} content={message.content}")
+async def queue_dm_burst(user_id, messages):
+    await submit_chat(messages[-1], lambda: reply_to_dm_burst(user_id, messages))
 
-    # 添付画像の読み込み
-    image_bytes = None
-    image_mime_type = "image/png"
-    if message.attachments:
-        attachment = message.attachments[0]
-        if attachment.content_type and attachment.content_type.startswith("image/"):
-            image_bytes = await attachment.read()
-            image_mime_type = attachment.content_type
+dm_debouncer = BurstDebouncer(queue_dm_burst, quiet=DM_DEBOUNCE_SECONDS, max_wait=DM_DEBOUNCE_MAX_WAIT)
 
-    # --- サーバーでメンションされた場合だけ ---
-    if message.guild and message.guild.id in GUILD_IDS and bot.user.mentioned_in(message):
-        try:
+async def reply_to_mention(message, image_bytes=None, image_mime_type="image/png"):
+    """サーバーでメンションされたときの返事（ユーザーごとのキューから呼ばれる）"""
+    try:
+        if GEMINI_STREAMING and not image_bytes:
+            # 文ができるたびに送る（最初の1文だけメンション付き）
+            await send_streaming_reply(message, mention=message.author.mention)
+        else:
             if image_bytes:
                 response = await get_gemini_response_with_image(str(message.author.id), message.content, image_bytes, image_mime_type)
             else:
                 response = await get_gemini_response(str(message.author.id), message.content)
 
-            import re
             sentences = [s.strip() for s in re.split(r'[。\n]+', response) if s.strip()]
 
             # このメッセージでのユーザーへのメンションフラグ
@@ -1204,141 +1593,490 @@ async def on_message(message):
                     await message.channel.send(s)
                 await asyncio.sleep(1.2)
 
-        except Exception as e:
-            logger.error(f"❌ メッセージ送信エラー: {e}")
+    except Exception as e:
+        logger.error(f"❌ メッセージ送信エラー: {e}")
 
-    # --- DMの場合 ---
-    elif message.guild is None:
-        try:
+async def reply_to_dm(message, image_bytes=None, image_mime_type="image/png"):
+    """DM への返事（ユーザーごとのキューから呼ばれる）"""
+    try:
+        if GEMINI_STREAMING and not image_bytes:
+            await send_streaming_reply(message)
+        else:
             if image_bytes:
                 response = await get_gemini_response_with_image(str(message.author.id), message.content, image_bytes, image_mime_type)
                 conversation_logs[str(message.author.id)] = []
+                conversation_store.mark_trim(str(message.author.id))
             else:
                 response = await get_gemini_response(str(message.author.id), message.content)
 
-            import re
             sentences = [s.strip() for s in re.split(r'[。\n]+', response) if s.strip()]
 
             for s in sentences:
                 await message.channel.send(s)
                 await asyncio.sleep(1.2)
 
-        except Exception as e:
-            logger.error(f"❌ DM送信エラー: {e}")
+    except Exception as e:
+        logger.error(f"❌ DM送信エラー: {e}")
+
+# ユーザーごとの「今回メッセージでメンション済み」フラグ
+user_mentioned_this_msg = {}
+
+@bot.event
+async def on_message(message):
+    if message.author == bot.user:
+        return
+
+    logger.info(f"📩 受信: guild={message.guild.id if message.guild else 'DM'} "
+                f"author={message.author} content={message.content}")
+
+    # 添付画像の読み込み
+    image_bytes = None
+    image_mime_type = "image/png"
+    if message.attachments:
+        attachment = message.attachments[0]
+        if attachment.content_type and attachment.content_type.startswith("image/"):
+            image_bytes = await attachment.read()
+            image_mime_type = attachment.content_type
+
+    # --- サーバーでメンションされた場合だけ ---
+    if message.guild and message.guild.id in GUILD_IDS and bot.user.mentioned_in(message):
+        await submit_chat(message, lambda: reply_to_mention(message, image_bytes, image_mime_type))
+
+    # --- DMの場合 ---
+    elif message.guild is None:
+        user_id = str(message.author.id)
+        if DM_DEBOUNCE_SECONDS > 0 and not image_bytes:
+            # 返事は静かになってから reply_to_dm_burst でまとめて
+            dm_debouncer.add(user_id, message)
+        else:
+            await dm_debouncer.flush(user_id)  # 先に届いた文字だけの DM を追い越さない
+            await submit_chat(message, lambda: reply_to_dm(message, image_bytes, image_mime_type))
 
     await bot.process_commands(message)
 
+def format_next_fire(info):
+    fire_at = info.get("next_fire_at")
+    if fire_at is None:
+        return f"{info['date']} / {info['time']}"
+    return datetime.datetime.fromtimestamp(fire_at, JST).strftime("%m-%d / %H:%M")
+
+def schedule_notification(user_id, info):
+    """1件の通知だけをタイマーに追加・置き換える（通知のUUIDがキー）"""
+    fire_at = info.get("next_fire_at")
+    if fire_at is None:
+        fire_at = refresh_next_fire(info)
+    if fire_at is None:
+        cancel_notification(info["id"])
+        return
+    reminders.schedule(info["id"], fire_at, (user_id, info))
+
+def cancel_notification(notif_id):
+    """1件の通知だけをタイマーから取り消す"""
+    reminders.cancel(notif_id)
+
 def schedule_notifications():
-    for job in scheduler.get_jobs():
-        if "notification_" in job.id:
-            scheduler.remove_job(job.id)
-            
+    """メモリ上の通知とタイマーを突き合わせて、足りない・ずれている分だけ積み直す"""
     now = datetime.datetime.now(JST)
+    this_minute = now.replace(second=0, microsecond=0).timestamp()
+    live = set()
+    changed = []
+    missed = []
     for user_id, notif_list in notifications.items():
-        for i, info in enumerate(notif_list):
-            date_time_str = f"{now.year}-{info['date']} {info['time']}"
-            try:
-                notification_time = JST.localize(datetime.datetime.strptime(date_time_str, "%Y-%m-%d %H:%M"))
-                if notification_time < now:
-                    notification_time = notification_time.replace(year=now.year + 1)
-                scheduler.add_job(
-                    send_notification_message, 
-                    'date', 
-                    run_date=notification_time, 
-                    args=[user_id, info.copy()],
-                    id=f"notification_{user_id}_{i}" 
-                )
-            except ValueError:
-                pass
+        for info in notif_list:
+            live.add(info["id"])
+            current = reminders.get(info["id"])
+            if current is not None and current[0] <= now.timestamp():
+                continue  # 止まっている間に過ぎた分は、そのまま遅れて送る
+            fire_at = info.get("next_fire_at")
+            if fire_at is not None and fire_at < this_minute and not recurrence.rule_of(info):
+                # 1回だけの通知は来年に回さない。猶予内ならすぐ送り、過ぎていれば片付ける
+                if current is not None:
+                    continue  # 送り直しを待っている
+                if now.timestamp() - fire_at > REMINDER_MISFIRE_GRACE:
+                    missed.append((user_id, info))
+                else:
+                    changed.append((info["id"], now.timestamp(), (user_id, info)))
+                continue
+            if fire_at is None or fire_at < this_minute:
+                fire_at = refresh_next_fire(info, now)
+            if fire_at is None:
+                continue
+            if current is not None and current[0] == fire_at and list(current[1]) == [user_id, info]:
+                continue  # 同じ時刻・同じ内容ならそのまま
+            changed.append((info["id"], fire_at, (user_id, info)))
+
+    stale = [key for key in reminders.keys() if key not in live]
+    for key in stale:
+        reminders.cancel(key)
+    reminders.schedule_many(changed)
+    for user_id, info in missed:
+        drop_missed_notification(user_id, info["id"])
+    logger.info(
+        f"⏰ 通知タイマー: {len(reminders)} 件（積み直し {len(changed)} 件 / 取り消し {len(stale)} 件 / 猶予切れ {len(missed)} 件）"
+    )
+
+def drop_missed_notification(user_id, key):
+    """猶予を過ぎても送れなかった1回だけの通知を、送らずに片付ける"""
+    logger.warning(f"⌛ 通知 {key} は時刻を {REMINDER_MISFIRE_GRACE} 秒以上過ぎていたので送りませんでした")
+    cancel_notification(key)
+    items = notifications.get(user_id, [])
+    if any(n["id"] == key for n in items):
+        items[:] = [n for n in items if n["id"] != key]
+        notification_repo.mark_delete(key)
+        schedule_save()
+
+def restore_reminders():
+    """前回の起動で積んでいた通知を読み戻す。猶予を過ぎたものは送らずに片付ける"""
+    for key, fire_at, (user_id, info) in reminders.restore():
+        if recurrence.rule_of(info):
+            logger.warning(f"⌛ 通知 {key} は時刻を {REMINDER_MISFIRE_GRACE} 秒以上過ぎていたので、次の回から送ります")
+            continue  # 繰り返しは schedule_notifications で次回分が積まれる
+        drop_missed_notification(user_id, key)
+
+def todo_job_id(hour, minute):
+    return f"todo_{hour:02d}{minute:02d}"
 
 def schedule_daily_todos():
     logger.error("毎日のTodoスケジュールを設定します...")
-    for user_id, data in daily_notifications.items():
-        hour = data.get("time", {}).get("hour", 8)
-        minute = data.get("time", {}).get("minute", 0)
+    for job in scheduler.get_jobs():
+        if job.id.startswith("todo_"):
+            scheduler.remove_job(job.id)
+    todo_buckets.clear()
+    todo_bucket_of.clear()
+    for user_id in daily_notifications:
+        schedule_daily_todo(user_id)
+    logger.error(f"Todo通知: {len(todo_bucket_of)} 人を {len(todo_buckets)} 個の時刻にまとめました")
 
-        job_id = f"todo_{user_id}"
-        scheduler.add_job(
-            send_user_todo,
-            'cron',
-            hour=hour,
-            minute=minute,
-            args=[int(user_id)],
-            id=job_id, 
-            replace_existing=True, 
-            timezone=JST 
-        )
-        logger.error(f"ユーザー {user_id} のTodo通知を {hour}:{minute} (JST) に設定しました")
+def add_todo_job(hour, minute):
+    scheduler.add_job(
+        send_todo_bucket,
+        'cron',
+        hour=hour,
+        minute=minute,
+        args=[hour, minute],
+        id=todo_job_id(hour, minute),
+        replace_existing=True,
+        timezone=JST
+    )
+
+def schedule_daily_todo(user_id):
+    """1ユーザー分のTodo通知だけを、その時刻のまとまり（バケット）に出し入れする"""
+    old_bucket = todo_bucket_of.pop(user_id, None)
+    if old_bucket is not None:
+        users = todo_buckets.get(old_bucket, set())
+        users.discard(user_id)
+        if not users:
+            # 誰もいなくなった時刻のジョブは消す
+            todo_buckets.pop(old_bucket, None)
+            if scheduler.get_job(todo_job_id(*old_bucket)):
+                scheduler.remove_job(todo_job_id(*old_bucket))
+
+    data = daily_notifications.get(user_id)
+    if data is None:
+        return
+
+    hour = data.get("time", {}).get("hour", 8)
+    minute = data.get("time", {}).get("minute", 0)
+    bucket = (hour, minute)
+    todo_bucket_of[user_id] = bucket
+    todo_buckets.setdefault(bucket, set()).add(user_id)
+
+    if not scheduler.get_job(todo_job_id(hour, minute)):
+        add_todo_job(hour, minute)
+    logger.info(f"ユーザー {user_id} のTodo通知を {hour}:{minute} (JST) に設定しました")
+
+def periodic_job_ids():
+    ids = {"conversation_trim", "outbox_replay", "notification_prefetch"}
+    if change_feed is None:
+        ids.add("periodic_reload")
+    return ids
 
 def setup_periodic_reload():
+    if change_feed is None:
+        # Realtime を使わないときだけ1時間ごとに全部読み直す
+        scheduler.add_job(
+            reload_all_data,
+            'interval', 
+            hours=1,
+            id="periodic_reload",
+            replace_existing=True
+        )
     scheduler.add_job(
-        reload_all_data,
-        'interval', 
-        hours=1,
-        id="periodic_reload",
+        trim_conversation_logs,
+        'interval',
+        minutes=CONVERSATION_TRIM_MINUTES,
+        id="conversation_trim",
         replace_existing=True
     )
+    scheduler.add_job(
+        supabase.replay,
+        'interval',
+        seconds=OUTBOX_REPLAY_SECONDS,
+        id="outbox_replay",
+        replace_existing=True
+    )
+    scheduler.add_job(
+        prefetch_notification_phrasing,
+        'interval',
+        seconds=NOTIFICATION_PREFETCH_INTERVAL,
+        id="notification_prefetch",
+        next_run_time=datetime.datetime.now(JST),
+        replace_existing=True
+    )
+
+# テーブルごとの読み込み時間（秒）
+hydration_timings = {}
+
+async def hydrate_all_data():
+    """全テーブルを並行して読み込む。かかる時間は一番遅いテーブルの分だけ"""
+    global notifications, daily_notifications, conversation_logs, sleep_check_times, chat_targets
+
+    async def timed(name, loader):
+        started = time.perf_counter()
+        result = await loader()
+        hydration_timings[name] = time.perf_counter() - started
+        return result
+
+    started = time.perf_counter()
+    (
+        chat_targets,
+        notifications,
+        daily_notifications,
+        sleep_check_times,
+        conversation_logs,
+        _,
+    ) = await asyncio.gather(
+        timed("chat_targets", load_chat_targets),
+        timed("notifications", load_notifications),
+        timed("daily_notifications", load_daily_notifications),
+        timed("sleep_check_times", load_sleep_check_times),
+        timed("conversation_logs", load_conversation_logs),
+        timed("random_chat_schedule", lambda: supabase.select("random_chat_schedule")),
+    )
+    hydration_timings["total"] = time.perf_counter() - started
+
+    for name, elapsed in hydration_timings.items():
+        logger.info(f"📥 {name}: {elapsed * 1000:.0f}ms")
+
+async def apply_remote_change(change):
+    """Realtime の変更をメモリとキャッシュに反映し、関係するジョブだけ組み直す"""
+    repo = SYNC_REPOS[change.table]
+    row = change.old_record if change.type == "DELETE" else change.record
+    key = row.get(repo.key)
+    if key is None or repo.is_pending(key):
+        # 手元に未保存の変更がある行は、手元の方が新しい
+        return
+    await supabase.apply_change(change)
+    reflect_change(change, key, row)
+
+def reflect_change(change, key, row):
+    """1行分の変更をメモリに反映して、その行に関係するジョブだけ組み直す"""
+    deleted = change.type == "DELETE"
+
+    if change.table == "notifications":
+        for items in notifications.values():
+            items[:] = [n for n in items if n["id"] != key]
+        if not deleted:
+            notifications.setdefault(row["user_id"], []).append(notification_from_row(row))
+        if deleted:
+            cancel_notification(key)
+        else:
+            schedule_notification(row["user_id"], notifications[row["user_id"]][-1])
+
+    elif change.table == "daily_notifications":
+        if deleted:
+            daily_notifications.pop(key, None)
+        else:
+            daily_notifications[key] = daily_from_row(row)
+        schedule_daily_todo(key)
+
+    elif change.table == "sleep_check_times":
+        if deleted:
+            sleep_check_times.pop(key, None)
+        else:
+            sleep_check_times[key] = {"hour": row["hour"], "minute": row["minute"]}
+        schedule_user_sleep_check(key)
+
+    elif change.table == "chat_targets":
+        uid = str(key)
+        if deleted and uid in chat_targets:
+            chat_targets.remove(uid)
+        elif not deleted and uid not in chat_targets:
+            chat_targets.append(uid)
+
+async def resync_remote_changes():
+    """Realtime に繋ぎ直したとき、購読している4テーブルだけ取り直して手元と違う行だけ反映する"""
+    await write_queue.flush_all()  # 未保存の変更を先に書き込む
+    await supabase.replay()
+    await asyncio.gather(*(supabase.refresh(table) for table in SYNC_REPOS))
+    fresh_notifications, fresh_daily, fresh_sleep, fresh_targets = await asyncio.gather(
+        load_notifications(),
+        load_daily_notifications(),
+        load_sleep_check_times(),
+        load_chat_targets()
+    )
+
+    # テーブルごとに {キー: 行} にそろえて比べる
+    before = {
+        "notifications": {
+            info["id"]: notification_row(user_id, info)
+            for user_id, items in notifications.items() for info in items
+        },
+        "daily_notifications": {user_id: daily_row(user_id, val) for user_id, val in daily_notifications.items()},
+        "sleep_check_times": {user_id: sleep_check_row(user_id, val) for user_id, val in sleep_check_times.items()},
+        "chat_targets": {user_id: {"user_id": user_id} for user_id in chat_targets},
+    }
+    after = {
+        "notifications": {
+            info["id"]: notification_row(user_id, info)
+            for user_id, items in fresh_notifications.items() for info in items
+        },
+        "daily_notifications": {user_id: daily_row(user_id, val) for user_id, val in fresh_daily.items()},
+        "sleep_check_times": {user_id: sleep_check_row(user_id, val) for user_id, val in fresh_sleep.items()},
+        "chat_targets": {user_id: {"user_id": user_id} for user_id in fresh_targets},
+    }
+
+    changed = 0
+    for table, repo in SYNC_REPOS.items():
+        old_rows, new_rows = before[table], after[table]
+        for key in old_rows.keys() - new_rows.keys():
+            if not repo.is_pending(key):
+                reflect_change(Change(table, "DELETE", old_record=old_rows[key]), key, old_rows[key])
+                changed += 1
+        for key, row in new_rows.items():
+            if old_rows.get(key) != row and not repo.is_pending(key):
+                reflect_change(Change(table, "UPDATE", record=row), key, row)
+                changed += 1
+    logger.info(f"🔄 Realtime 再接続: {changed} 件の差分を反映しました")
 
 async def reload_all_data():
-    global notifications, daily_notifications, conversation_logs, sleep_check_times
     logger.error("データを再読み込みします...")
-    notifications = load_notifications()
-    daily_notifications = load_daily_notifications()
-    conversation_logs = load_conversation_logs()
-    sleep_check_times = load_sleep_check_times() 
+    await write_queue.flush_all()  # 未保存の変更を先に書き込む
+    await supabase.replay()
+    await asyncio.gather(*(supabase.refresh(table) for table in CACHED_TABLES))
+    await hydrate_all_data()
     
     # スケジュールも再設定
     schedule_notifications()
     schedule_daily_todos()
     schedule_sleep_check() 
-    schedule_random_chats()
+    await schedule_random_chats()
     logger.error("データの再読み込みが完了しました")
 
+async def send_dm_with_retry(user_id, content, attempts=3):
+    """DMを1通送る。レート制限(429)にかかったら少し待ってやり直す"""
+    user = bot.get_user(int(user_id)) or await bot.fetch_user(int(user_id))
+    for attempt in range(attempts):
+        try:
+            await user.send(content)
+            return
+        except discord.HTTPException as e:
+            if e.status != 429 or attempt == attempts - 1:
+                raise
+            await asyncio.sleep(2 ** attempt + random.random())
+
 async def send_user_todo(user_id: int):
+    """1人分のTodoを送る。送ったら True"""
     try:
         user_data = daily_notifications.get(str(user_id), {})
         todos = user_data.get("todos", [])
-        logger.error(f"ユーザー {user_id} のTodo送信: {todos}")
-        if todos:
-            user = await bot.fetch_user(user_id)
-            msg = "おはよ～ハニー！今日のToDoリストだよ～！\n" + "\n".join([f"- {todo}" for todo in todos])
-            await user.send(msg)
-            logger.error(f"ユーザー {user_id} にTodoを送信しました")
+        if not todos:
+            return False
+        msg = "おはよ～ハニー！今日のToDoリストだよ～！\n" + "\n".join([f"- {todo}" for todo in todos])
+        await send_dm_with_retry(user_id, msg)
+        return True
     except Exception as e:
         logger.error(f"Todo送信エラー (ユーザー {user_id}): {e}")
+        return False
+
+async def send_todo_bucket(hour: int, minute: int):
+    """その時刻に登録しているユーザー全員へTodoを配る（同時送信数は TODO_SEND_CONCURRENCY まで）"""
+    user_ids = list(todo_buckets.get((hour, minute), ()))
+    started = time.perf_counter()
+    semaphore = asyncio.Semaphore(TODO_SEND_CONCURRENCY)
+
+    async def send_one(user_id):
+        async with semaphore:
+            return await send_user_todo(int(user_id))
+
+    results = await asyncio.gather(*(send_one(user_id) for user_id in user_ids))
+    elapsed = time.perf_counter() - started
+    sent = sum(1 for ok in results if ok)
+    todo_metrics[f"{hour:02d}:{minute:02d}"] = {
+        "users": len(user_ids),
+        "sent": sent,
+        "skipped_or_failed": len(user_ids) - sent,
+        "seconds": round(elapsed, 3),
+        "finished_at": utc_now_iso()
+    }
+    logger.info(f"📬 Todo {hour:02d}:{minute:02d}: {len(user_ids)} 人中 {sent} 人に送信 ({elapsed:.1f}s)")
+
+async def check_sleep_bucket():
+    """前回見た分の次から今の分までに、睡眠チェックを登録しているユーザーだけを見る
+
+    ジョブは遅れると1回にまとめて実行されるので、実行された時刻の分だけを見ると
+    その間の分を取りこぼす。1分より早く呼ばれたときは、その分は次の回に見る。
+    """
+    global sleep_check_last_minute
+    this_minute = datetime.datetime.now(JST).replace(second=0, microsecond=0)
+    if sleep_check_last_minute is None:
+        start = this_minute
+    else:
+        start = max(
+            sleep_check_last_minute + datetime.timedelta(minutes=1),
+            this_minute - datetime.timedelta(minutes=SLEEP_CHECK_CATCHUP_MINUTES)
+        )
+    if start > this_minute:
+        return
+    sleep_check_last_minute = this_minute
+
+    user_ids = set()
+    minute = start
+    while minute <= this_minute:
+        user_ids.update(sleep_buckets.get((minute.hour, minute.minute), ()))
+        minute += datetime.timedelta(minutes=1)
+    if not user_ids:
+        return
+    semaphore = asyncio.Semaphore(TODO_SEND_CONCURRENCY)
 
-async def check_user_sleep_status(user_id: str):
-    try:
+    async def check_one(user_id):
+        async with semaphore:
+            try:
+                # 会話ログに足すので、そのユーザーの会話と同じキューで順番に
+                await chat_actors.call(user_id, lambda: check_user_sleep_status(user_id))
+            except QueueFull:
+                logger.warning(f"⚠️ {user_id} の会話キューがいっぱいなので睡眠チェックをとばしました")
 
-        guild = bot.get_guild(GUILD_ID)
-        if not guild:
-            logger.warning("❌ ギルドが取得できません。GUILD_IDが正しいか確認してね")
-            return
+    await asyncio.gather(*(check_one(user_id) for user_id in user_ids))
 
-        member = guild.get_member(int(user_id))
-        if member is None:
-            logger.warning(f"⚠️ ユーザー {user_id} はこのサーバーにいないよ")
+async def check_user_sleep_status(user_id: str):
+    try:
+        status = presence_status.get(user_id)
+        if status is None:
+            logger.warning(f"⚠️ ユーザー {user_id} のオンライン状態が分からないよ（同じサーバーにいるか確認してね）")
             return
 
-        if member.status == discord.Status.online:
+        if status == discord.Status.online:
             message_text = "もうこんな時間だよ〜！はやくねたほうがいいよー💤"
-            user = await bot.fetch_user(int(user_id))
-            await user.send(message_text)  
+            await send_dm_with_retry(user_id, message_text)
 
             now = datetime.datetime.now(JST)
             if user_id not in conversation_logs:
                 conversation_logs[user_id] = []
-            conversation_logs[user_id].append({
+            entry = {
                 "role": "model",
                 "parts": [{"text": message_text}],
-                "timestamp": now.strftime("%Y-%m-%d %H:%M:%S")
-            })
+                "timestamp": now.strftime("%Y-%m-%d %H:%M:%S"),
+                "created_at": utc_now_iso()
+            }
+            conversation_logs[user_id].append(entry)
             conversation_logs[user_id] = conversation_logs[user_id][-7:]
-            save_conversation_logs(conversation_logs)
+            conversation_store.append(user_id, entry)
+            schedule_save()
 
             logger.info(f"✅ {user_id} に夜ふかし通知をDMで送信しました")
         else:
-            logger.info(f"🛌 ユーザー {user_id} はオンラインではありません（status: {member.status}）")
+            logger.info(f"🛌 ユーザー {user_id} はオンラインではありません（status: {status}）")
 
     except Exception as e:
         logger.error(f"⚠️ {user_id} への睡眠チェック中にエラー: {e}")
@@ -1352,7 +2090,8 @@ async def add_chat_target(interaction: discord.Interaction, user: discord.User):
 
     if uid not in chat_targets:
         chat_targets.append(uid)
-        save_chat_targets(chat_targets)
+        chat_target_repo.mark_upsert({"user_id": uid})
+        schedule_save()
         await interaction.followup.send(f"✅ {user.name} を会話対象に追加したよ！", ephemeral=True)
     else:
         await interaction.followup.send(f"ℹ️ {user.name} はすでに登録されてるよ！", ephemeral=True)
@@ -1367,7 +2106,8 @@ async def remove_chat_target(interaction: discord.Interaction, user: discord.Use
 
     if uid in chat_targets:
         chat_targets.remove(uid)
-        save_chat_targets(chat_targets)
+        chat_target_repo.mark_delete(uid)
+        schedule_save()
         await interaction.followup.send(f"✅ {user.name} を会話対象から外したよ！", ephemeral=True)
     else:
         await interaction.followup.send(f"ℹ️ {user.name} は登録されてないよ！", ephemeral=True)
@@ -1407,18 +2147,25 @@ async def test_random_chat(interaction: discord.Interaction):
             await interaction.followup.send(f"⚠️ ユーザー {user_id} が見つからなかったよ！", ephemeral=True)
             return
 
-        prompt = "ハニーに話しかけるための、かわいくて短い会話のきっかけをひとつ作って。例:「おはなししようよ～」"
-        message = await get_gemini_response(user_id, prompt)
-
-        await user.send(message)
+        await chat_actors.call(user_id, lambda: send_chat_starter(user_id, user))
         await interaction.followup.send(f"✅ {user.name} にテストメッセージを送ったよ！", ephemeral=True)
 
+    except QueueFull:
+        await interaction.followup.send("⏳ そのユーザーとのお話が混んでるみたい。あとでもう一回ためしてね！", ephemeral=True)
+
     except discord.Forbidden:
         await interaction.followup.send("❌ DMが拒否されてるみたい。送れなかったよ！", ephemeral=True)
 
     except Exception as e:
         await interaction.followup.send(f"⚠️ エラーが起きたよ: {e}", ephemeral=True)
 
+async def send_chat_starter(user_id, user):
+    """Geminiに「短い会話のきっかけ」を作らせて送る（そのユーザーの会話キューから呼ぶ）"""
+    prompt = "ハニーに話しかけるための、かわいくて短い会話のきっかけをひとつ作って。例:「おはなししようよ～」"
+    message = await get_gemini_response(user_id, prompt)
+    await user.send(message)
+    return message
+
 async def send_random_chat():
     try:
         if not chat_targets:
@@ -1431,23 +2178,21 @@ async def send_random_chat():
             logger.warning(f"⚠️ ユーザー {user_id} が見つからないよ")
             return
 
-        # Geminiに「短い会話のきっかけ」を作らせる
-        prompt = "ハニーに話しかけるための、かわいくて短い会話のきっかけをひとつ作って。例:「おはなししようよ～」"
-        message = await get_gemini_response(user_id, prompt)
-
-        await user.send(message)
+        message = await chat_actors.call(user_id, lambda: send_chat_starter(user_id, user))
         logger.info(f"✅ ランダム会話を {user.name} に送信: {message}")
 
+    except QueueFull:
+        logger.warning(f"⚠️ {user_id} の会話キューがいっぱいなのでランダム会話をとばしました")
     except Exception as e:
         logger.error(f"ランダム会話送信エラー: {e}")
 
-def schedule_random_chats():
+async def schedule_random_chats():
     logger.info("🔁 schedule_random_chats が呼ばれました。")
     jobs = {job.id for job in scheduler.get_jobs()}
 
     # 午前のランダム会話
     if "random_chat_morning" not in jobs:
-        run_time = get_schedule("random_chat_morning")
+        run_time = await get_schedule("random_chat_morning")
 
         if not run_time:
             # Supabaseにまだ無い → 新しくランダム設定
@@ -1459,7 +2204,7 @@ def schedule_random_chats():
             if run_time <= now:
                 run_time += datetime.timedelta(days=1)
 
-            save_schedule("random_chat_morning", run_time)
+            await save_schedule("random_chat_morning", run_time)
 
         scheduler.add_job(send_random_chat, "date", run_date=run_time, id="random_chat_morning")
         logger.info(f"🌟 午前のランダム会話を {run_time} に設定しました")
@@ -1468,34 +2213,36 @@ def schedule_random_chats():
 
     # 翌日0時にリセット
     if "reset_random_chats" not in jobs:
-        scheduler.add_job(reset_schedule, "cron", hour=0, minute=0, id="reset_random_chats")
+        add_reset_random_chats_job()
         logger.info("🌟 reset_random_chats を登録しました")
 
 
-def reset_schedule():
+def add_reset_random_chats_job():
+    scheduler.add_job(reset_schedule, "cron", hour=0, minute=0, id="reset_random_chats", replace_existing=True)
+
+async def reset_schedule():
     logger.info("🔄 reset_schedule が呼ばれました")
-    delete_schedule("random_chat_morning")
-    schedule_random_chats()
+    await delete_schedule("random_chat_morning")
+    await schedule_random_chats()
 
 async def check_and_notify_resin(user: discord.User | None = None):
     """樹脂をチェックして、190以上なら指定ユーザーにDM通知（1日最大3回まで）"""
     global bot, logger, DISCORD_NOTIFY_USER_ID
 
     try:
-        resin, max_resin, recover_time = get_resin_status()
+        resin, max_resin, recover_time = await get_resin_status()
         logger.info(f"🌿現在の樹脂は{resin}/{max_resin}")
 
         today = datetime.datetime.now(JST).date()
 
         # --- Supabaseから通知履歴を取得 ---
-        url = f"{SUPABASE_URL}/rest/v1/resin_notify_count?select=*"
-        response = requests.get(url, headers=SUPABASE_HEADERS)
+        rows = await supabase.select("resin_notify_count")
 
         notify_count = 0
         last_date = None
 
-        if response.status_code == 200 and response.json():
-            record = response.json()[0]
+        if rows:
+            record = rows[0]
             last_date_str = record.get("date")
             if last_date_str:
                 last_date = datetime.date.fromisoformat(last_date_str)
@@ -1528,14 +2275,12 @@ async def check_and_notify_resin(user: discord.User | None = None):
                         "date": today.isoformat(),
                         "count": new_count
                     }]
-                    save_url = f"{SUPABASE_URL}/rest/v1/resin_notify_count"
-                    params = {"on_conflict": "id"}
-                    save_response = requests.post(save_url, headers=SUPABASE_HEADERS, json=payload, params=params)
+                    save_response = await supabase.upsert("resin_notify_count", payload, on_conflict="id")
 
-                    if save_response.status_code in (200, 201, 204):
+                    if save_response.ok:
                         logger.info(f"✅ {user.name} に樹脂通知を送信しました ({today}, {new_count}回目)")
                     else:
-                        logger.error(f"⚠️ Supabase更新失敗: {save_response.status_code} {save_response.text}")
+                        logger.error(f"⚠️ Supabase更新失敗: {save_response.status} {save_response.data}")
             else:
                 logger.info("📭 今日の通知上限（3回）に達しています。スキップ。")
         else:
@@ -1559,7 +2304,7 @@ def schedule_resin_check():
     #)
     logger.info("⏰ 原神の樹脂チェックを15分ごとにスケジュールしました")
 
-def get_resin_status():
+async def get_resin_status():
     headers = {
         "Cookie": f"ltoken_v2={HOYOLAB_LTOKEN}; ltuid_v2={HOYOLAB_LTUID};",
         "x-rpc-app_version": "2.34.1",
@@ -1572,9 +2317,9 @@ def get_resin_status():
         "schedule_type": 1,
     }
 
-    response = requests.get(HOYOLAB_API, headers=headers, params=params)
-    response.raise_for_status()
-    data = response.json()
+    async with session.get(HOYOLAB_API, headers=headers, params=params, timeout=aiohttp.ClientTimeout(total=10)) as response:
+        response.raise_for_status()
+        data = await response.json(content_type=None)
 
     if not data or "data" not in data or data["data"] is None:
         raise Exception(f"HoYoLAB API returned invalid data: {data}")
@@ -1617,8 +2362,8 @@ async def tv_power(interaction: discord.Interaction):
 
     try:
         # SwitchBot API呼び出し
-        res = requests.post(f"{API_URL}/{SWITCHBOT_TV_ID}/commands", json=payload, headers=headers, timeout=10)
-        data = res.json()
+        async with session.post(f"{API_URL}/{SWITCHBOT_TV_ID}/commands", json=payload, headers=headers, timeout=aiohttp.ClientTimeout(total=10)) as res:
+            data = await res.json(content_type=None)
 
         if data.get("statusCode") == 100:
             await interaction.followup.send("📺 テレビの電源を切り替えたよ！", ephemeral=True)
@@ -1644,8 +2389,8 @@ async def light_on(interaction: discord.Interaction):
     await interaction.response.defer(ephemeral=True)
 
     try:
-        res = requests.post(f"{API_URL}/{SWITCHBOT_LIGHT_ID}/commands", json=payload, headers=headers, timeout=10)
-        data = res.json()
+        async with session.post(f"{API_URL}/{SWITCHBOT_LIGHT_ID}/commands", json=payload, headers=headers, timeout=aiohttp.ClientTimeout(total=10)) as res:
+            data = await res.json(content_type=None)
 
         if data.get("statusCode") == 100:
             await interaction.followup.send("💡 部屋の電気をONにしたよ！", ephemeral=True)
@@ -1671,8 +2416,8 @@ async def light_off(interaction: discord.Interaction):
     await interaction.response.defer(ephemeral=True)
 
     try:
-        res = requests.post(f"{API_URL}/{SWITCHBOT_LIGHT_ID}/commands", json=payload, headers=headers, timeout=10)
-        data = res.json()
+        async with session.post(f"{API_URL}/{SWITCHBOT_LIGHT_ID}/commands", json=payload, headers=headers, timeout=aiohttp.ClientTimeout(total=10)) as res:
+            data = await res.json(content_type=None)
 
         if data.get("statusCode") == 100:
             await interaction.followup.send("💡 部屋の電気をOFFにしたよ！", ephemeral=True)
@@ -1682,7 +2427,8 @@ async def light_off(interaction: discord.Interaction):
     except Exception as e:
         await interaction.followup.send(f"❌ 通信中にエラーが発生したよ: {e}", ephemeral=True)
 
-# twitter_thread = threading.Thread(target=start_twitter_bot)
-# twitter_thread.start()
+if ENABLE_TWITTER_BOT:
+    twitter_thread = threading.Thread(target=start_twitter_bot, daemon=True)
+    twitter_thread.start()
 
 bot.run(TOKEN)
@@ -0,0 +1,161 @@
+import asyncio
+import json
+import logging
+import random
+
+import aiohttp
+
+logger = logging.getLogger(__name__)
+
+
+class Change:
+    """1件の変更イベント（INSERT / UPDATE / DELETE）"""
+
+    def __init__(self, table, type, record=None, old_record=None):
+        self.table = table
+        self.type = type
+        self.record = record or {}
+        self.old_record = old_record or {}
+
+    def __repr__(self):
+        return f"Change({self.table}, {self.type})"
+
+
+def realtime_url(supabase_url, key):
+    """Supabase Realtime の websocket URL を作る"""
+    base = supabase_url.replace("https://", "wss://").replace("http://", "ws://")
+    return f"{base}/realtime/v1/websocket?apikey={key}&vsn=1.0.0"
+
+
+class RealtimeChangeFeed:
+    """Supabase Realtime (postgres_changes) を購読して、変更を1件ずつ on_change に渡す
+
+    切断されたらバックオフしながら繋ぎ直す。購読が受け付けられる（phx_join に
+    ok が返る）たびに、切れていた間の変更を取りこぼしているかもしれないので
+    on_resync を呼ぶ。直前に全部読み込んだばかりなら start(resync_first=False) で
+    最初の1回だけ飛ばせる。
+    """
+
+    def __init__(self, url, key, tables, on_change, on_resync=None, heartbeat=25.0, join_timeout=10.0):
+        self.url = url
+        self.key = key
+        self.tables = tables
+        self.on_change = on_change
+        self.on_resync = on_resync
+        self.heartbeat = heartbeat
+        self.join_timeout = join_timeout
+        self._task = None
+        self._ref = 0
+        self.connected = False
+        self.events_received = 0
+
+    def _next_ref(self):
+        self._ref += 1
+        return str(self._ref)
+
+    def start(self, resync_first=True):
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run(resync_first))
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _run(self, resync_first=True):
+        delay = 1.0
+        resync = resync_first
+        while True:
+            try:
+                async with aiohttp.ClientSession() as session:
+                    async with session.ws_connect(self.url, heartbeat=None) as ws:
+                        await self._wait_joined(ws, await self._join(ws))
+                        self.connected = True
+                        delay = 1.0  # 購読が通ってから戻す（すぐ弾かれる接続で連打しない）
+                        logger.info(f"🔌 Realtime に接続しました（{', '.join(self.tables)}）")
+                        # 購読してから取り直すので、その間の変更もイベントで届く
+                        if resync and self.on_resync:
+                            await self.on_resync()
+                        await self._listen(ws)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.warning(f"⚠️ Realtime 接続エラー: {e!r}")
+            self.connected = False
+            resync = True  # 飛ばすのは最初の1回の接続だけ（失敗して待った分は取り直す）
+            await asyncio.sleep(delay + random.uniform(0, delay / 2))
+            delay = min(delay * 2, 60.0)
+
+    async def _join(self, ws):
+        """購読を申し込んで、その ref を返す"""
+        ref = self._next_ref()
+        await ws.send_json({
+            "topic": "realtime:dorothy-sync",
+            "event": "phx_join",
+            "payload": {
+                "config": {
+                    "postgres_changes": [
+                        {"event": "*", "schema": "public", "table": table} for table in self.tables
+                    ]
+                },
+                "access_token": self.key
+            },
+            "ref": ref
+        })
+        return ref
+
+    async def _wait_joined(self, ws, ref):
+        """phx_join への返事を待つ。ok 以外や返事が来ないときは ConnectionError"""
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.join_timeout
+        while True:
+            try:
+                msg = await ws.receive(timeout=max(0.0, deadline - loop.time()))
+            except asyncio.TimeoutError:
+                raise ConnectionError("phx_join timed out")
+            if msg.type in (aiohttp.WSMsgType.CLOSED, aiohttp.WSMsgType.CLOSING, aiohttp.WSMsgType.ERROR):
+                raise ConnectionError("websocket closed")
+            if msg.type != aiohttp.WSMsgType.TEXT:
+                continue
+            message = json.loads(msg.data)
+            if message.get("event") == "phx_reply" and message.get("ref") == ref:
+                payload = message.get("payload") or {}
+                if payload.get("status") != "ok":
+                    raise ConnectionError(f"phx_join rejected: {payload.get('response')}")
+                return
+
+    async def _listen(self, ws):
+        loop = asyncio.get_running_loop()
+        next_heartbeat = loop.time() + self.heartbeat
+        while True:
+            timeout = max(0.0, next_heartbeat - loop.time())
+            try:
+                msg = await ws.receive(timeout=timeout)
+            except asyncio.TimeoutError:
+                await ws.send_json({"topic": "phoenix", "event": "heartbeat", "payload": {}, "ref": self._next_ref()})
+                next_heartbeat = loop.time() + self.heartbeat
+                continue
+            if msg.type in (aiohttp.WSMsgType.CLOSED, aiohttp.WSMsgType.CLOSING, aiohttp.WSMsgType.ERROR):
+                raise ConnectionError("websocket closed")
+            if msg.type != aiohttp.WSMsgType.TEXT:
+                continue
+            change = self._parse(json.loads(msg.data))
+            if change is not None:
+                self.events_received += 1
+                try:
+                    await self.on_change(change)
+                except Exception as e:
+                    logger.error(f"⚠️ 変更イベントの反映に失敗: {change} {e}")
+
+    def _parse(self, message):
+        if message.get("event") != "postgres_changes":
+            return None
+        data = (message.get("payload") or {}).get("data") or {}
+        table = data.get("table")
+        if table not in self.tables:
+            return None
+        return Change(table, data.get("type"), data.get("record"), data.get("old_record"))
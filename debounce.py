@@ -0,0 +1,59 @@
+import asyncio
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class BurstDebouncer:
+    """短い間に続けて届いたものを、キーごとに1つにまとめて callback に渡す
+
+    add() のたびに quiet 秒待ち直し、その間に次が来なければ
+    callback(key, [item, ...]) を呼ぶ。ずっと届き続けても、
+    最初の1件から max_wait 秒たったらそこで区切る。
+    """
+
+    def __init__(self, callback, quiet=1.5, max_wait=6.0):
+        self.callback = callback
+        self.quiet = quiet
+        self.max_wait = max_wait
+        self._pending = {}  # key -> (最初に届いた時刻, [item, ...])
+        self._timers = {}   # key -> 待っている Task
+        self.metrics = {"items": 0, "bursts": 0, "merged": 0}
+
+    def __len__(self):
+        return len(self._pending)
+
+    def add(self, key, item):
+        self.metrics["items"] += 1
+        first_at, items = self._pending.setdefault(key, (time.monotonic(), []))
+        items.append(item)
+        timer = self._timers.get(key)
+        if timer is not None:
+            timer.cancel()
+        delay = min(self.quiet, max(0.0, first_at + self.max_wait - time.monotonic()))
+        self._timers[key] = asyncio.create_task(self._wait(key, delay))
+
+    async def _wait(self, key, delay):
+        await asyncio.sleep(delay)
+        await self.flush(key)
+
+    async def flush(self, key):
+        """待たずにすぐ callback に渡す（何も溜まっていなければ何もしない）"""
+        timer = self._timers.pop(key, None)
+        if timer is not None and timer is not asyncio.current_task():
+            timer.cancel()
+        entry = self._pending.pop(key, None)
+        if entry is None:
+            return
+        items = entry[1]
+        self.metrics["bursts"] += 1
+        self.metrics["merged"] += len(items) - 1
+        try:
+            await self.callback(key, items)
+        except Exception as e:
+            logger.error(f"❌ まとめた処理でエラー: {e}")
+
+    async def flush_all(self):
+        for key in list(self._pending):
+            await self.flush(key)
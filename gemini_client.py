@@ -0,0 +1,365 @@
+import asyncio
+import json
+import logging
+import random
+import re
+import time
+
+import aiohttp
+
+logger = logging.getLogger(__name__)
+
+GEMINI_BASE_URL = "https://generativelanguage.googleapis.com/v1beta/models"
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+SENTENCE_END = re.compile(r"[。\n]")
+
+
+class GeminiError(Exception):
+    """リトライしても返事がもらえなかったとき（ストリーミング用）"""
+
+    def __init__(self, status, body=""):
+        super().__init__(f"Gemini {status}: {body[:200]}")
+        self.status = status
+        self.body = body
+
+
+def candidate_text(data, default=""):
+    """レスポンス（またはストリームの1チャンク）の最初の候補のテキスト"""
+    if not isinstance(data, dict):
+        return default
+    parts = (data.get("candidates") or [{}])[0].get("content", {}).get("parts") or [{}]
+    return "".join(part.get("text", "") for part in parts) or default
+
+
+class GeminiResponse:
+    """Gemini のレスポンス（ステータス・JSON本体・リトライ回数・かかった時間）"""
+
+    def __init__(self, status, data=None, body="", retries=0, latency=0.0):
+        self.status = status
+        self.data = data
+        self.body = body
+        self.retries = retries
+        self.latency = latency
+
+    @property
+    def ok(self):
+        return self.status == 200
+
+    def text(self, default=""):
+        """最初の候補のテキスト"""
+        return candidate_text(self.data, default)
+
+
+def usage_of(data):
+    """usageMetadata の (入力トークン, キャッシュから読んだトークン, 出力トークン)"""
+    usage = data.get("usageMetadata") if isinstance(data, dict) else None
+    if not usage:
+        return None
+    return usage.get("promptTokenCount", 0), usage.get("cachedContentTokenCount", 0), usage.get("candidatesTokenCount", 0)
+
+
+class GeminiClient:
+    """Gemini API 用の非同期クライアント
+
+    ClientSession を1本だけ keep-alive で使い回し、同時に投げる数を絞る。
+    429 / 5xx / 通信エラーはジッター付きの指数バックオフでやり直す
+    （Retry-After が返ってきたらその秒数だけ待つ）。
+    """
+
+    def __init__(self, api_key, model="gemini-2.5-flash", max_concurrency=4, timeout=60.0,
+                 max_retries=3, backoff=1.0, max_backoff=30.0, pool_size=10, base_url=None):
+        self.api_key = api_key
+        self.model = model
+        self.base_url = base_url or GEMINI_BASE_URL
+        self.timeout = aiohttp.ClientTimeout(total=timeout)
+        # ストリーミングは全体の時間ではなく、チャンクの間隔で切る
+        self.stream_timeout = aiohttp.ClientTimeout(total=None, sock_connect=timeout, sock_read=timeout)
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.pool_size = pool_size
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self._session = None
+        self.metrics = {
+            "calls": 0,
+            "attempts": 0,
+            "retries": 0,
+            "rate_limited": 0,
+            "failures": 0,
+            "latency_ms_total": 0.0,
+            "last_latency_ms": 0.0,
+            "streams": 0,
+            "last_first_chunk_ms": 0.0,
+            "request_bytes": 0,
+            "prompt_tokens": 0,
+            "cached_tokens": 0,
+            "output_tokens": 0,
+        }
+
+    def _get_session(self):
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(limit=self.pool_size, keepalive_timeout=60)
+            self._session = aiohttp.ClientSession(connector=connector, timeout=self.timeout)
+        return self._session
+
+    def url(self, method="generateContent", model=None):
+        return f"{self.base_url}/{model or self.model}:{method}"
+
+    def _count_usage(self, usage):
+        if usage is None:
+            return
+        prompt, cached, output = usage
+        self.metrics["prompt_tokens"] += prompt
+        self.metrics["cached_tokens"] += cached
+        self.metrics["output_tokens"] += output
+
+    def _retry_delay(self, attempt, retry_after=None):
+        if retry_after:
+            try:
+                return min(float(retry_after), self.max_backoff)
+            except ValueError:
+                pass
+        delay = min(self.backoff * (2 ** attempt), self.max_backoff)
+        return delay / 2 + random.uniform(0, delay / 2)
+
+    async def _before_retry(self, status, attempt, retry_after):
+        """やり直すなら待って True、諦めるなら False"""
+        if status == 429:
+            self.metrics["rate_limited"] += 1
+        if status not in RETRY_STATUSES and status != 0:
+            return False
+        if attempt == self.max_retries:
+            return False
+        delay = self._retry_delay(attempt, retry_after)
+        logger.warning(f"⚠️ Gemini {status} のため {delay:.1f}s 後にやり直します（{attempt + 1}/{self.max_retries}）")
+        self.metrics["retries"] += 1
+        await asyncio.sleep(delay)
+        return True
+
+    def _finish(self, started, status, body):
+        latency = time.perf_counter() - started
+        self.metrics["latency_ms_total"] += latency * 1000
+        self.metrics["last_latency_ms"] = round(latency * 1000, 1)
+        if status != 200:
+            self.metrics["failures"] += 1
+            logger.error(f"⚠️ Gemini 失敗: {status} {body[:200]}")
+        return latency
+
+    async def generate(self, contents, model=None, **body):
+        """generateContent を呼ぶ。body には systemInstruction や generationConfig などをそのまま渡せる"""
+        payload = {"contents": contents}
+        payload.update(body)
+        return await self.post(self.url("generateContent", model), payload)
+
+    async def post(self, url, payload, method="POST"):
+        session = self._get_session()
+        started = time.perf_counter()
+        self.metrics["calls"] += 1
+        self.metrics["request_bytes"] += len(json.dumps(payload, ensure_ascii=False).encode("utf-8"))
+        retries = 0
+        for attempt in range(self.max_retries + 1):
+            status, data, body, retry_after = 0, None, "", None
+            async with self._semaphore:
+                self.metrics["attempts"] += 1
+                try:
+                    async with session.request(method, url, params={"key": self.api_key}, json=payload) as response:
+                        status = response.status
+                        if status == 200:
+                            data = await response.json()
+                        else:
+                            body = await response.text()
+                            retry_after = response.headers.get("Retry-After")
+                except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                    body = repr(e)
+            if status == 200 or not await self._before_retry(status, attempt, retry_after):
+                break
+            retries += 1
+
+        latency = self._finish(started, status, body)
+        self._count_usage(usage_of(data))
+        return GeminiResponse(status, data, body, retries, latency)
+
+    async def stream(self, contents, model=None, **body):
+        """streamGenerateContent (SSE) で、届いたテキストを少しずつ返す
+
+        最初のチャンクが届く前の失敗はリトライする。それでもだめなら GeminiError。
+        途中で切れたときは、そこまでで終わる。
+        受信は別タスクでキューに溜めるので、受け取る側が Discord への送信で
+        待っていても、同時実行数の枠は Gemini から受け取っている間しか使わない。
+        """
+        payload = {"contents": contents}
+        payload.update(body)
+        queue = asyncio.Queue()
+        pump = asyncio.create_task(self._pump(self.url("streamGenerateContent", model), payload, queue))
+        try:
+            while True:
+                item = await queue.get()
+                if item is None:
+                    return
+                if isinstance(item, GeminiError):
+                    raise item
+                yield item
+        finally:
+            if not pump.done():
+                pump.cancel()  # 途中でやめたら受信も止めて接続を閉じる
+
+    async def _pump(self, url, payload, queue):
+        # 受け取ったチャンクを queue に入れる。最後に None（終わり）か GeminiError を入れる
+        session = self._get_session()
+        started = time.perf_counter()
+        self.metrics["calls"] += 1
+        self.metrics["streams"] += 1
+        self.metrics["request_bytes"] += len(json.dumps(payload, ensure_ascii=False).encode("utf-8"))
+        usage = None
+        status, text = 0, ""
+        try:
+            for attempt in range(self.max_retries + 1):
+                status, text, retry_after = 0, "", None
+                async with self._semaphore:
+                    self.metrics["attempts"] += 1
+                    try:
+                        async with session.post(
+                            url,
+                            params={"key": self.api_key, "alt": "sse"},
+                            json=payload,
+                            timeout=self.stream_timeout
+                        ) as response:
+                            status = response.status
+                            if status == 200:
+                                first = True
+                                async for line in response.content:
+                                    if not line.startswith(b"data:"):
+                                        continue
+                                    data = json.loads(line[5:])
+                                    # 使ったトークン数は最後のチャンクにまとめて入ってくる
+                                    usage = usage_of(data) or usage
+                                    chunk = candidate_text(data)
+                                    if not chunk:
+                                        continue
+                                    if first:
+                                        first = False
+                                        self.metrics["last_first_chunk_ms"] = round((time.perf_counter() - started) * 1000, 1)
+                                    queue.put_nowait(chunk)
+                                self._finish(started, status, "")
+                                self._count_usage(usage)
+                                queue.put_nowait(None)
+                                return
+                            text = await response.text()
+                            retry_after = response.headers.get("Retry-After")
+                    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                        if status == 200:
+                            # 途中まで送ってしまったのでやり直さない
+                            logger.warning(f"⚠️ Gemini ストリームが途中で切れました: {e!r}")
+                            self._finish(started, status, "")
+                            queue.put_nowait(None)
+                            return
+                        text = repr(e)
+                if not await self._before_retry(status, attempt, retry_after):
+                    break
+        except Exception as e:
+            text = repr(e)
+        self._finish(started, status, text)
+        queue.put_nowait(GeminiError(status, text))
+
+    async def stream_sentences(self, contents, max_sentences=None, **body):
+        """stream() のテキストを「。」や改行で区切って、1文ずつ返す"""
+        buffer = ""
+        count = 0
+        chunks = self.stream(contents, **body)
+        try:
+            async for chunk in chunks:
+                buffer += chunk
+                while True:
+                    match = SENTENCE_END.search(buffer)
+                    if match is None:
+                        break
+                    sentence, buffer = buffer[:match.end()], buffer[match.end():]
+                    if sentence.strip():
+                        yield sentence
+                        count += sentence.endswith("。")
+                        if max_sentences and count >= max_sentences:
+                            return
+            if buffer.strip():
+                yield buffer
+        finally:
+            await chunks.aclose()  # 途中でやめたら接続も閉じる
+
+    def cache_url(self, name=None):
+        root = self.base_url.rsplit("/models", 1)[0]
+        return f"{root}/{name}" if name else f"{root}/cachedContents"
+
+    async def close(self):
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+
+
+class SystemInstruction:
+    """毎回送る性格設定などを systemInstruction として付けるためのもの
+
+    use_cache=True なら一度 cachedContents に登録して名前だけ送り、
+    期限が近づいたら ttl を延ばす。登録できない・使えなくなったときは
+    そのまま systemInstruction を送る。
+    """
+
+    def __init__(self, client, text, use_cache=False, ttl=3600, refresh_margin=300, retry_after=600):
+        self.client = client
+        self.text = text.strip()
+        self.use_cache = use_cache
+        self.ttl = ttl
+        self.refresh_margin = refresh_margin
+        self.retry_after = retry_after    # 登録に失敗したら、しばらくは作り直さない
+        self.name = None
+        self.expires_at = 0.0
+        self._failed_at = None
+        self._lock = asyncio.Lock()
+        self.metrics = {"cache_created": 0, "cache_refreshed": 0, "cache_failures": 0, "cached_requests": 0, "inline_requests": 0}
+
+    def inline(self):
+        return {"systemInstruction": {"parts": [{"text": self.text}]}}
+
+    async def body(self):
+        """generate() / stream() に渡す追加のフィールド"""
+        if self.use_cache and await self._ensure_cache():
+            self.metrics["cached_requests"] += 1
+            return {"cachedContent": self.name}
+        self.metrics["inline_requests"] += 1
+        return self.inline()
+
+    def invalidate(self):
+        """キャッシュが使えなかった（期限切れ・削除された）ときに呼ぶ。次の呼び出しで作り直す"""
+        self.name = None
+        self.expires_at = 0.0
+
+    async def _ensure_cache(self):
+        if self.name and time.time() < self.expires_at - self.refresh_margin:
+            return True
+        if self._failed_at and time.time() - self._failed_at < self.retry_after:
+            return False
+        async with self._lock:
+            now = time.time()
+            if self.name and now < self.expires_at - self.refresh_margin:
+                return True
+            ttl = {"ttl": f"{int(self.ttl)}s"}
+            if self.name and now < self.expires_at:
+                response = await self.client.post(self.client.cache_url(self.name) + "?updateMask=ttl", ttl, method="PATCH")
+                if response.ok:
+                    self.metrics["cache_refreshed"] += 1
+                    self.expires_at = now + self.ttl
+                    return True
+            payload = {"model": f"models/{self.client.model}"}
+            payload.update(self.inline())
+            payload.update(ttl)
+            response = await self.client.post(self.client.cache_url(), payload)
+            if response.ok and isinstance(response.data, dict) and response.data.get("name"):
+                self.metrics["cache_created"] += 1
+                self.name = response.data["name"]
+                self.expires_at = now + self.ttl
+                self._failed_at = None
+                logger.info(f"✅ 性格設定をキャッシュしました: {self.name}")
+                return True
+            # 短すぎる（最小トークン数に届かない）などで登録できないときは、そのまま送る
+            self.metrics["cache_failures"] += 1
+            self._failed_at = now
+            self.invalidate()
+            logger.warning(f"⚠️ 性格設定をキャッシュできなかったので systemInstruction で送ります（{response.status}）")
+            return False
@@ -0,0 +1,598 @@
+import asyncio
+import functools
+import json
+import logging
+import sqlite3
+import threading
+import time
+import uuid
+
+from supabase_client import SupabaseError, SupabaseResponse
+
+logger = logging.getLogger(__name__)
+
+# DB でまだ採番されていない行（INSERT 直後で id が無い行）に付ける仮のキー
+PROVISIONAL = "local:"
+PROVISIONAL_END = "local;"  # pk >= PROVISIONAL AND pk < PROVISIONAL_END で主キーのインデックスを使って探す
+# 送れなかったときに outbox に残して再送するステータス（0 はつながらなかったとき。5xx も再送）
+RETRYABLE_STATUSES = {0, 401, 403, 404, 408, 429}
+
+
+def parse_filter(expr):
+    """PostgREST のフィルタ文字列（eq.x / in.("a","b") / lt.x など）を (演算子, 値) に分ける"""
+    op, _, value = expr.partition(".")
+    if op == "in":
+        inner = value.strip()[1:-1]
+        values = [v.strip().strip('"') for v in inner.split(",") if v.strip()]
+        return op, values
+    return op, value
+
+
+def _coerce(row_value, value):
+    if isinstance(row_value, bool):
+        return str(row_value).lower(), value.lower()
+    if isinstance(row_value, (int, float)):
+        try:
+            return row_value, float(value)
+        except ValueError:
+            return str(row_value), value
+    return ("" if row_value is None else str(row_value)), value
+
+
+def row_matches(row, filters):
+    """行がフィルタ（列名 -> PostgREST フィルタ）をすべて満たすか"""
+    for column, expr in (filters or {}).items():
+        op, value = parse_filter(expr)
+        row_value = row.get(column)
+        if op == "in":
+            if str(row_value) not in value:
+                return False
+            continue
+        left, right = _coerce(row_value, value)
+        if op == "eq" and not left == right:
+            return False
+        if op == "neq" and not left != right:
+            return False
+        if op == "lt" and not left < right:
+            return False
+        if op == "lte" and not left <= right:
+            return False
+        if op == "gt" and not left > right:
+            return False
+        if op == "gte" and not left >= right:
+            return False
+    return True
+
+
+def apply_order(rows, order):
+    """order=col.asc / col.desc を適用する"""
+    if not order:
+        return rows
+    column, _, direction = order.partition(".")
+    return sorted(rows, key=lambda r: (r.get(column) is None, r.get(column) or ""), reverse=direction.startswith("desc"))
+
+
+def _locked(method):
+    # LocalCache はイベントループとスレッド（asyncio.to_thread）の両方から使うので、1つずつ通す
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self._lock:
+            return method(self, *args, **kwargs)
+    return wrapper
+
+
+class LocalCache:
+    """Supabase の各テーブルを SQLite に写したローカルキャッシュと、送信待ちの outbox
+
+    行は (テーブル, 主キー) で持ち、owner_columns で指定した列（user_id など）は
+    インデックス付きの owner 列にも入れる。主キーと owner の eq / in は SQL で絞り込み、
+    残りの条件だけ row_matches で判定する。
+    """
+
+    def __init__(self, path, table_keys, table_columns=None, owner_columns=None):
+        self.table_keys = table_keys
+        self.table_columns = table_columns or {}
+        self.owner_columns = owner_columns or {}
+        self._lock = threading.RLock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        columns = {name for _, name, *_ in self.conn.execute("PRAGMA table_info(cache_rows)")}
+        if columns and "owner" not in columns:
+            # 古い形式の写しは捨てて取り直す（outbox はそのまま残す）
+            self.conn.executescript("DROP TABLE cache_rows; DROP TABLE IF EXISTS cache_meta;")
+        self.conn.executescript("""
+            CREATE TABLE IF NOT EXISTS cache_rows (
+                tbl TEXT NOT NULL,
+                pk TEXT NOT NULL,
+                owner TEXT,
+                data TEXT NOT NULL,
+                PRIMARY KEY (tbl, pk)
+            );
+            CREATE INDEX IF NOT EXISTS cache_rows_owner ON cache_rows (tbl, owner);
+            CREATE TABLE IF NOT EXISTS cache_meta (
+                tbl TEXT PRIMARY KEY,
+                synced_at REAL NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS outbox (
+                seq INTEGER PRIMARY KEY AUTOINCREMENT,
+                tbl TEXT NOT NULL,
+                payload TEXT NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS outbox_dead (
+                seq INTEGER PRIMARY KEY,
+                tbl TEXT NOT NULL,
+                payload TEXT NOT NULL,
+                status INTEGER NOT NULL,
+                error TEXT,
+                failed_at REAL NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS cache_keys (
+                tbl TEXT PRIMARY KEY,
+                keys TEXT NOT NULL
+            );
+        """)
+        self.conn.commit()
+        self._check_keys()
+
+    def _check_keys(self):
+        """主キーや owner 列の決め方が変わったテーブルは、写しを捨てて取り直させる"""
+        stored = dict(self.conn.execute("SELECT tbl, keys FROM cache_keys"))
+        with self.conn:
+            for table, keys in self.table_keys.items():
+                keys = json.dumps([list(keys), self.owner_columns.get(table)])
+                if stored.get(table) == keys:
+                    continue
+                if table in stored or self.is_hydrated(table):
+                    logger.info(f"🔑 {table}: キーが変わったのでキャッシュを作り直します")
+                self.conn.execute("DELETE FROM cache_rows WHERE tbl = ?", (table,))
+                self.conn.execute("DELETE FROM cache_meta WHERE tbl = ?", (table,))
+                self.conn.execute("INSERT OR REPLACE INTO cache_keys (tbl, keys) VALUES (?, ?)", (table, keys))
+
+    def _pk(self, table, row):
+        values = [row.get(k) for k in self.table_keys[table]]
+        if None in values:
+            # 同じ内容の行でも別々に持つ。DB から id 付きで届いたら置き換わる
+            return PROVISIONAL + uuid.uuid4().hex
+        return json.dumps(values, ensure_ascii=False)
+
+    def _owner(self, table, row):
+        column = self.owner_columns.get(table)
+        value = row.get(column) if column else None
+        return None if value is None else str(value)
+
+    def _record(self, table, pk, row):
+        return (table, pk, self._owner(table, row), json.dumps(row, ensure_ascii=False))
+
+    def _claim_provisional(self, table, row):
+        """id 付きで届いた行と同じ内容の仮の行を消す"""
+        keys = self.table_keys[table]
+        found = self.conn.execute(
+            "SELECT pk, data FROM cache_rows WHERE tbl = ? AND pk >= ? AND pk < ?",
+            (table, PROVISIONAL, PROVISIONAL_END)
+        )
+        for pk, data in found.fetchall():
+            data = json.loads(data)
+            if all(row.get(k) == v for k, v in data.items() if k not in keys):
+                self.conn.execute("DELETE FROM cache_rows WHERE tbl = ? AND pk = ?", (table, pk))
+                return
+
+    @_locked
+    def is_hydrated(self, table):
+        return self.conn.execute("SELECT 1 FROM cache_meta WHERE tbl = ?", (table,)).fetchone() is not None
+
+    @staticmethod
+    def _pk_candidates(values):
+        # 主キーは json.dumps([値]) で持っているので、フィルタの文字列から作り直して突き合わせる
+        candidates = []
+        for value in values:
+            candidates.append(json.dumps([value], ensure_ascii=False))
+            try:
+                candidates.append(json.dumps([int(value)]))
+            except ValueError:
+                pass
+        return candidates
+
+    def _where(self, table, filters):
+        """主キー・owner 列の eq / in を、インデックスの効く SQL の条件にする（残りは row_matches で判定する）"""
+        where = "tbl = ?"
+        args = [table]
+        keys = self.table_keys[table]
+        owner = self.owner_columns.get(table)
+        for column, expr in (filters or {}).items():
+            op, value = parse_filter(expr)
+            if op not in ("eq", "in"):
+                continue
+            values = value if op == "in" else [value]
+            if not values:
+                return "0", []
+            if len(keys) == 1 and column == keys[0]:
+                values = self._pk_candidates(values)
+                target = "pk"
+            elif column == owner:
+                target = "owner"
+            else:
+                continue
+            where += f" AND {target} IN ({','.join('?' * len(values))})"
+            args += values
+        return where, args
+
+    def rows(self, table, filters=None):
+        return [row for chunk in self.iter_rows(table, filters=filters) for row in chunk]
+
+    def _matching(self, table, filters):
+        """フィルタに合う行を (キャッシュ上のキー, 行) で返す"""
+        where, args = self._where(table, filters)
+        found = []
+        for pk, data in self.conn.execute(f"SELECT pk, data FROM cache_rows WHERE {where}", args):
+            row = json.loads(data)
+            if row_matches(row, filters):
+                found.append((pk, row))
+        return found
+
+    @_locked
+    def page_rows(self, table, filters=None, after=0, limit=1000):
+        """rowid が after より後の行を limit 件まで読み、(次の after, フィルタに合う行) を返す。終わりなら次は None"""
+        where, args = self._where(table, filters)
+        found = self.conn.execute(
+            f"SELECT rowid, data FROM cache_rows WHERE {where} AND rowid > ? ORDER BY rowid LIMIT ?",
+            args + [after, limit]
+        ).fetchall()
+        rows = [json.loads(data) for _, data in found]
+        if filters:
+            rows = [r for r in rows if row_matches(r, filters)]
+        return (found[-1][0] if len(found) == limit else None), rows
+
+    def iter_rows(self, table, chunk_size=1000, filters=None):
+        """フィルタに合う行を chunk_size 件ずつ読み出す"""
+        after = 0
+        while after is not None:
+            after, rows = self.page_rows(table, filters, after, chunk_size)
+            if rows:
+                yield rows
+
+    @_locked
+    def store_page(self, table, rows):
+        """取り直し中のページを書き込み、書いた行の主キーを返す"""
+        pks = [self._pk(table, r) for r in rows]
+        with self.conn:
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO cache_rows (tbl, pk, owner, data) VALUES (?, ?, ?, ?)",
+                [self._record(table, pk, r) for pk, r in zip(pks, rows)]
+            )
+        return pks
+
+    @_locked
+    def finish_refresh(self, table, seen_pks):
+        """取り直しで見つからなかった行を消して、同期済みにする"""
+        stale = [
+            (table, pk) for (pk,) in self.conn.execute("SELECT pk FROM cache_rows WHERE tbl = ?", (table,))
+            if pk not in seen_pks
+        ]
+        with self.conn:
+            self.conn.executemany("DELETE FROM cache_rows WHERE tbl = ? AND pk = ?", stale)
+            self.conn.execute(
+                "INSERT OR REPLACE INTO cache_meta (tbl, synced_at) VALUES (?, ?)",
+                (table, time.time())
+            )
+
+    @_locked
+    def upsert_rows(self, table, rows, merge=True):
+        with self.conn:
+            for row in rows:
+                pk = self._pk(table, row)
+                if not pk.startswith(PROVISIONAL):
+                    self._claim_provisional(table, row)
+                if merge:
+                    found = self.conn.execute(
+                        "SELECT data FROM cache_rows WHERE tbl = ? AND pk = ?", (table, pk)
+                    ).fetchone()
+                    if found:
+                        row = {**json.loads(found[0]), **row}
+                self.conn.execute(
+                    "INSERT OR REPLACE INTO cache_rows (tbl, pk, owner, data) VALUES (?, ?, ?, ?)",
+                    self._record(table, pk, row)
+                )
+
+    @_locked
+    def delete_rows(self, table, filters):
+        targets = [pk for pk, _ in self._matching(table, filters)]
+        with self.conn:
+            self.conn.executemany(
+                "DELETE FROM cache_rows WHERE tbl = ? AND pk = ?",
+                [(table, pk) for pk in targets]
+            )
+
+    @_locked
+    def update_rows(self, table, filters, values):
+        updated = [(pk, {**r, **values}) for pk, r in self._matching(table, filters)]
+        with self.conn:
+            self.conn.executemany(
+                "UPDATE cache_rows SET owner = ?, data = ? WHERE tbl = ? AND pk = ?",
+                [(self._owner(table, r), json.dumps(r, ensure_ascii=False), table, pk) for pk, r in updated]
+            )
+
+    # --- outbox ---
+    @_locked
+    def enqueue(self, table, payload):
+        with self.conn:
+            self.conn.execute(
+                "INSERT INTO outbox (tbl, payload) VALUES (?, ?)",
+                (table, json.dumps(payload, ensure_ascii=False))
+            )
+
+    @_locked
+    def outbox_entries(self):
+        cur = self.conn.execute("SELECT seq, tbl, payload FROM outbox ORDER BY seq")
+        return [(seq, tbl, json.loads(payload)) for seq, tbl, payload in cur]
+
+    @_locked
+    def outbox_tables(self):
+        return {tbl for (tbl,) in self.conn.execute("SELECT DISTINCT tbl FROM outbox")}
+
+    @_locked
+    def ack(self, seq):
+        with self.conn:
+            self.conn.execute("DELETE FROM outbox WHERE seq = ?", (seq,))
+
+    @_locked
+    def bury(self, seq, status, error):
+        """送っても通らない変更を outbox から outbox_dead に移す（消さずに残しておく）"""
+        with self.conn:
+            self.conn.execute(
+                "INSERT INTO outbox_dead (seq, tbl, payload, status, error, failed_at) "
+                "SELECT seq, tbl, payload, ?, ?, ? FROM outbox WHERE seq = ?",
+                (status, error, time.time(), seq)
+            )
+            self.conn.execute("DELETE FROM outbox WHERE seq = ?", (seq,))
+
+    @_locked
+    def dead_letters(self, limit=20):
+        """新しい順に (seq, tbl, payload, status, error, failed_at)"""
+        cur = self.conn.execute(
+            "SELECT seq, tbl, payload, status, error, failed_at FROM outbox_dead ORDER BY seq DESC LIMIT ?",
+            (limit,)
+        )
+        return [(seq, tbl, json.loads(payload), status, error, failed_at) for seq, tbl, payload, status, error, failed_at in cur]
+
+    @property
+    @_locked
+    def outbox_size(self):
+        return self.conn.execute("SELECT COUNT(*) FROM outbox").fetchone()[0]
+
+    @property
+    @_locked
+    def dead_size(self):
+        return self.conn.execute("SELECT COUNT(*) FROM outbox_dead").fetchone()[0]
+
+
+class CachedSupabase:
+    """読み込みはローカルキャッシュから、書き込みは outbox 経由で Supabase に流すクライアント
+
+    SupabaseClient と同じ select / insert / upsert / update / delete を持つ。
+    書き込みはまず outbox とローカルに反映してから送信を試み、
+    失敗したものは replay() で Supabase に届くまで再送する。
+    SQLite の読み書きは asyncio.to_thread で別スレッドに回し、イベントループを止めない。
+    optional_columns（テーブル -> 列名のタプル）に挙げた列が Supabase にまだ無いときは、
+    その列を外して読み書きする（マイグレーション前の DB でも動くように）。
+    """
+
+    def __init__(self, client, cache, optional_columns=None):
+        self.client = client
+        self.cache = cache
+        self.optional_columns = optional_columns or {}
+        self.missing_columns = {}  # テーブル -> Supabase に無かった列
+        self._replay_lock = asyncio.Lock()
+        self.metrics = {"local_calls": 0, "local_ms_total": 0.0, "local_ms_max": 0.0}
+        dead = cache.dead_size
+        if dead:
+            logger.warning(f"🪦 outbox_dead に送れなかった変更が {dead} 件残っています")
+
+    def _cached(self, table):
+        return table in self.cache.table_keys
+
+    async def _local(self, method, *args):
+        def timed():
+            started = time.perf_counter()
+            try:
+                return method(*args)
+            finally:
+                elapsed = (time.perf_counter() - started) * 1000
+                self.metrics["local_calls"] += 1
+                self.metrics["local_ms_total"] += elapsed
+                self.metrics["local_ms_max"] = max(self.metrics["local_ms_max"], round(elapsed, 1))
+        return await asyncio.to_thread(timed)
+
+    async def select(self, table, params=None, columns="*"):
+        if not self._cached(table):
+            return await self.client.select(table, params, columns)
+        if not await self._local(self.cache.is_hydrated, table):
+            if not await self.refresh(table):
+                return None
+        rows = []
+        async for page in self.select_pages(table, params, columns):
+            rows.extend(page)
+        return rows
+
+    async def select_pages(self, table, params=None, columns="*", page_size=1000):
+        """ページごとに行を返す。呼び出し側は届いた順に組み立てていける"""
+        if not self._cached(table):
+            try:
+                async for page in self.client.select_pages(table, params, columns, page_size):
+                    yield page
+            except SupabaseError as e:
+                logger.error(f"⚠️ {e}")
+            return
+        if not await self._local(self.cache.is_hydrated, table):
+            if not await self.refresh(table):
+                return
+        params = dict(params or {})
+        order = params.pop("order", None)
+        names = None if columns == "*" else [c.strip() for c in columns.split(",")]
+
+        def project(rows):
+            if names:
+                rows = [{c: r.get(c) for c in names} for r in rows]
+            return rows
+
+        if order:
+            # 並べ替えは全件そろってからでないとできない
+            rows = await self._local(lambda: apply_order(project(self.cache.rows(table, params)), order))
+            for i in range(0, len(rows), page_size):
+                yield rows[i:i + page_size]
+            return
+        after = 0
+        while after is not None:
+            after, chunk = await self._local(self.cache.page_rows, table, params, after, page_size)
+            page = project(chunk)
+            if page:
+                yield page
+
+    async def refresh(self, table):
+        """Supabase からページごとに取り直してキャッシュを置き換える。未送信の変更があるテーブルはそのまま"""
+        if table in await self._local(self.cache.outbox_tables):
+            logger.info(f"📦 {table}: 未送信の変更があるのでキャッシュを維持します")
+            return await self._local(self.cache.is_hydrated, table)
+        columns = self._columns(table)
+        order = ",".join(f"{k}.asc" for k in self.cache.table_keys[table])
+        seen = set()
+        try:
+            async for page in self.client.select_pages(table, columns=columns, order=order):
+                seen.update(await self._local(self.cache.store_page, table, page))
+        except SupabaseError as e:
+            if await self._probe_columns(table):
+                return await self.refresh(table)
+            logger.warning(f"⚠️ {e}。キャッシュを使います")
+            return await self._local(self.cache.is_hydrated, table)
+        if table in await self._local(self.cache.outbox_tables):
+            # 取り直しの途中で書き込まれた行は消さない
+            return True
+        await self._local(self.cache.finish_refresh, table, seen)
+        return True
+
+    async def apply_change(self, change):
+        """他から来た変更（Realtime イベント）をキャッシュにだけ反映する"""
+        if not self._cached(change.table):
+            return
+        if change.type == "DELETE":
+            keys = self.cache.table_keys[change.table]
+            old = change.old_record
+            if all(old.get(k) is not None for k in keys):
+                await self._local(self.cache.delete_rows, change.table, {k: f"eq.{old[k]}" for k in keys})
+        elif change.record:
+            await self._local(self.cache.upsert_rows, change.table, [change.record])
+
+    async def _write(self, table, payload):
+        if not self._cached(table):
+            return await self._send(table, payload)
+        await self._local(self.cache.enqueue, table, payload)
+        await self.replay()
+        return SupabaseResponse(202)
+
+    async def insert(self, table, rows):
+        rows = rows if isinstance(rows, list) else [rows]
+        if self._cached(table):
+            await self._local(self.cache.upsert_rows, table, rows, False)
+        return await self._write(table, {"op": "insert", "rows": rows})
+
+    async def upsert(self, table, rows, on_conflict=None):
+        rows = rows if isinstance(rows, list) else [rows]
+        if self._cached(table):
+            await self._local(self.cache.upsert_rows, table, rows)
+        return await self._write(table, {"op": "upsert", "rows": rows, "on_conflict": on_conflict})
+
+    async def update(self, table, filters, values):
+        if self._cached(table):
+            await self._local(self.cache.update_rows, table, filters, values)
+        return await self._write(table, {"op": "update", "filters": filters, "values": values})
+
+    async def delete(self, table, filters=None):
+        if self._cached(table):
+            await self._local(self.cache.delete_rows, table, filters)
+        return await self._write(table, {"op": "delete", "filters": filters})
+
+    def _columns(self, table):
+        columns = self.cache.table_columns.get(table, "*")
+        missing = self.missing_columns.get(table)
+        if columns == "*" or not missing:
+            return columns
+        return ",".join(c for c in columns.split(",") if c.strip() not in missing)
+
+    def _without_missing(self, table, payload):
+        missing = self.missing_columns.get(table)
+        if not missing:
+            return payload
+        payload = dict(payload)
+        if "rows" in payload:
+            payload["rows"] = [{k: v for k, v in row.items() if k not in missing} for row in payload["rows"]]
+        if "values" in payload:
+            payload["values"] = {k: v for k, v in payload["values"].items() if k not in missing}
+        return payload
+
+    async def _probe_columns(self, table):
+        """400 が返ったときに、optional_columns の列が Supabase にあるかを1列ずつ確かめる。
+        新しく無いと分かった列があれば True"""
+        missing = self.missing_columns.setdefault(table, set())
+        found = False
+        for column in self.optional_columns.get(table, ()):
+            if column in missing:
+                continue
+            response = await self.client.request("GET", table, params={"select": column, "limit": "0"})
+            if response.status == 400:
+                missing.add(column)
+                found = True
+                logger.warning(
+                    f"⚠️ Supabase の {table} に {column} 列がありません。この列は保存されないので、"
+                    f"migrations/ のマイグレーションを適用して再起動してください"
+                )
+        return found
+
+    async def _send(self, table, payload):
+        response = await self._send_once(table, self._without_missing(table, payload))
+        if response.status == 400 and await self._probe_columns(table):
+            response = await self._send_once(table, self._without_missing(table, payload))
+        return response
+
+    async def _send_once(self, table, payload):
+        op = payload["op"]
+        if op == "insert":
+            return await self.client.insert(table, payload["rows"])
+        if op == "upsert":
+            return await self.client.upsert(table, payload["rows"], on_conflict=payload.get("on_conflict"))
+        if op == "update":
+            return await self.client.update(table, payload["filters"], payload["values"])
+        return await self.client.delete(table, payload["filters"])
+
+    async def replay(self):
+        """outbox を古い順に Supabase へ送る。つながらなければ次回に回す"""
+        async with self._replay_lock:
+            for seq, table, payload in await self._local(self.cache.outbox_entries):
+                response = await self._send(table, payload)
+                if response.ok:
+                    await self._local(self.cache.ack, seq)
+                elif response.status in RETRYABLE_STATUSES or response.status >= 500:
+                    # キーの期限切れ・権限の設定ミス・テーブル未作成などは直れば通るので、順番を守って待つ
+                    logger.warning(
+                        f"📦 Supabase に届かないので outbox を保留します"
+                        f"（{response.status} / 残り {await self._local(lambda: self.cache.outbox_size)} 件）"
+                    )
+                    return False
+                else:
+                    # 何度送っても通らない変更は outbox_dead に移す（後ろが詰まらないように。中身は残す）
+                    logger.error(f"⚠️ outbox の {table} {payload['op']} を outbox_dead に移しました: {response.status} {response.data}")
+                    await self._local(self.cache.bury, seq, response.status, json.dumps(response.data, ensure_ascii=False, default=str))
+            return True
+
+    def stats(self):
+        """/metrics 用（Flask のスレッドから呼ばれるので SQLite は直接読む）"""
+        return {
+            **self.metrics,
+            "outbox": self.cache.outbox_size,
+            "dead_letters": self.cache.dead_size,
+            "recent_dead_letters": [
+                {"seq": seq, "table": tbl, "op": payload.get("op"), "status": status, "error": error, "failed_at": failed_at}
+                for seq, tbl, payload, status, error, failed_at in self.cache.dead_letters(5)
+            ],
+        }
+
+    async def close(self):
+        await self.client.close()
@@ -0,0 +1,3 @@
+-- 通知の繰り返しルール（recurrence.make_rule の文字列: yearly / monthly / weekly:0 / weekdays / every:3:2026-01-01）
+-- NULL のままの行は、今まで通り repeat=true なら毎年・false なら1回として扱われる
+alter table public.notifications add column if not exists recurrence text;
@@ -0,0 +1,128 @@
+import calendar
+import datetime
+
+# 繰り返しルール（notifications.recurrence 列に入れる文字列）
+#   None / ""              … 1回だけ（次に来る date の日）
+#   "yearly"               … 毎年 date の日
+#   "monthly"              … 毎月 date の「日」（date の月は使わない。無い月は月末）
+#   "weekly:<0-6>"         … 毎週その曜日（0=月曜。登録時に、今日以降で次に来る date の曜日から決める）
+#   "weekdays"             … 平日（月〜金）。date は使わない
+#   "every:<N>:<YYYY-MM-DD>" … 開始日から N 日ごと（開始日は登録時に、今日以降で次に来る date の日）
+# 次回の日時はいつもこのルールと date / time だけから決まる（登録時も読み直し後も同じ）
+YEARLY = "yearly"
+MONTHLY = "monthly"
+WEEKLY = "weekly"
+WEEKDAYS = "weekdays"
+EVERY = "every"
+
+
+def rule_of(info):
+    """通知の繰り返しルール。recurrence が無い古いデータは repeat=True を毎年とみなす"""
+    rule = info.get("recurrence")
+    if rule:
+        return rule
+    return YEARLY if info.get("repeat") else None
+
+
+def make_rule(kind, anchor, interval_days=1):
+    """コマンドで選ばれた種類と、次に来る date の日時（anchor）からルール文字列を作る"""
+    if not kind:
+        return None
+    if kind in (YEARLY, MONTHLY, WEEKDAYS):
+        return kind
+    if kind == WEEKLY:
+        return f"{WEEKLY}:{anchor.weekday()}"
+    if kind == EVERY:
+        if interval_days < 1:
+            raise ValueError("interval_days must be >= 1")
+        return f"{EVERY}:{interval_days}:{anchor.strftime('%Y-%m-%d')}"
+    raise ValueError(f"unknown recurrence: {kind}")
+
+
+def describe(rule):
+    """一覧表示用の短い説明"""
+    if not rule:
+        return "1回"
+    kind, _, arg = rule.partition(":")
+    if kind == YEARLY:
+        return "毎年"
+    if kind == MONTHLY:
+        return "毎月"
+    if kind == WEEKLY:
+        return f"毎週{'月火水木金土日'[int(arg)]}曜"
+    if kind == WEEKDAYS:
+        return "平日"
+    if kind == EVERY:
+        return f"{arg.split(':')[0]}日ごと"
+    return rule
+
+
+def _clamped(year, month, day):
+    # 2/29 や 31日が無い年・月は、その月の末日にする
+    return datetime.date(year, month, min(day, calendar.monthrange(year, month)[1]))
+
+
+def next_occurrence(info, after, tz):
+    """after（分単位に切り捨て、その分を含む）以降で最初に通知する日時
+
+    info は date ("MM-DD") / time ("HH:MM") / recurrence を持つ通知。
+    形式がおかしいときは ValueError。
+    """
+    after = after.astimezone(tz).replace(second=0, microsecond=0)
+    month, day = (int(x) for x in info["date"].split("-"))
+    hour, minute = (int(x) for x in info["time"].split(":"))
+    at = datetime.time(hour, minute)
+    rule = rule_of(info)
+    kind, _, arg = (rule or "").partition(":")
+
+    def fire(date):
+        return tz.localize(datetime.datetime.combine(date, at))
+
+    start = after.date()
+
+    if not rule or kind == YEARLY:
+        candidate = fire(_clamped(start.year, month, day))
+        if candidate < after:
+            candidate = fire(_clamped(start.year + 1, month, day))
+        return candidate
+
+    if kind == MONTHLY:
+        candidate = fire(_clamped(start.year, start.month, day))
+        if candidate < after:
+            year, month_ = (start.year + 1, 1) if start.month == 12 else (start.year, start.month + 1)
+            candidate = fire(_clamped(year, month_, day))
+        return candidate
+
+    if kind == WEEKLY:
+        date = start + datetime.timedelta(days=(int(arg) - start.weekday()) % 7)
+        candidate = fire(date)
+        if candidate < after:
+            candidate = fire(date + datetime.timedelta(days=7))
+        return candidate
+
+    if kind == WEEKDAYS:
+        date = start
+        while date.weekday() >= 5 or fire(date) < after:
+            date += datetime.timedelta(days=1)
+        return fire(date)
+
+    if kind == EVERY:
+        interval, _, first = arg.partition(":")
+        interval = int(interval)
+        first = datetime.datetime.strptime(first, "%Y-%m-%d").date()
+        if start <= first:
+            date = first
+        else:
+            date = first + datetime.timedelta(days=(start - first).days // interval * interval)
+        if fire(date) < after:
+            date += datetime.timedelta(days=interval)
+        return fire(date)
+
+    raise ValueError(f"unknown recurrence: {rule}")
+
+
+def following_occurrence(info, fired_at, tz):
+    """fired_at に通知した後の次の日時。1回だけの通知なら None"""
+    if not rule_of(info):
+        return None
+    return next_occurrence(info, fired_at + datetime.timedelta(minutes=1), tz)
@@ -0,0 +1,328 @@
+import asyncio
+import heapq
+import itertools
+import json
+import logging
+import sqlite3
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class ReminderStore:
+    """タイマーに積んだリマインダーを SQLite に残しておく（再起動しても消えない）"""
+
+    def __init__(self, path):
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS reminder_jobs (
+                key TEXT PRIMARY KEY,
+                fire_at REAL NOT NULL,
+                payload TEXT NOT NULL
+            )
+        """)
+        self.conn.commit()
+
+    def save(self, key, fire_at, payload):
+        self.conn.execute(
+            "INSERT OR REPLACE INTO reminder_jobs (key, fire_at, payload) VALUES (?, ?, ?)",
+            (key, fire_at, json.dumps(payload, ensure_ascii=False))
+        )
+        self.conn.commit()
+
+    def save_many(self, entries):
+        self.conn.executemany(
+            "INSERT OR REPLACE INTO reminder_jobs (key, fire_at, payload) VALUES (?, ?, ?)",
+            [(key, fire_at, json.dumps(payload, ensure_ascii=False)) for key, fire_at, payload in entries]
+        )
+        self.conn.commit()
+
+    def delete(self, key, fire_at=None):
+        """key を消す。fire_at を渡したときは、その時刻のままのときだけ消す"""
+        if fire_at is None:
+            self.conn.execute("DELETE FROM reminder_jobs WHERE key = ?", (key,))
+        else:
+            self.conn.execute("DELETE FROM reminder_jobs WHERE key = ? AND fire_at = ?", (key, fire_at))
+        self.conn.commit()
+
+    def clear(self):
+        self.conn.execute("DELETE FROM reminder_jobs")
+        self.conn.commit()
+
+    def load(self):
+        rows = self.conn.execute("SELECT key, fire_at, payload FROM reminder_jobs")
+        return [(key, fire_at, json.loads(payload)) for key, fire_at, payload in rows]
+
+
+class ReminderDispatcher:
+    """単発リマインダー用のタイマー（最小ヒープ1本とタイマータスク1本）
+
+    (発火時刻, 連番, キー) をヒープに積み、一番近い時刻まで眠る。
+    取り消しや置き換えはヒープを触らずに印だけ付け（遅延削除）、
+    取り出すときに読み捨てる。追加・取り消しは O(log n) 以下で、
+    期限が来たものはまとめて取り出して callback(*payload) に渡す。
+
+    store を渡すと積んだものを SQLite に残し、restore() で読み戻す。
+    止まっている間に時刻を過ぎたものは misfire_grace 秒以内なら遅れて送る。
+    1つのキーには1件しか積まないので、何回分取りこぼしても送るのは1回だけ。
+
+    group_by を渡すと、同じグループ（ユーザーなど）で group_window 秒以内に
+    期限が来たものをまとめて callback(group, [(fire_at, payload), ...]) に1回で渡す。
+    """
+
+    def __init__(self, callback, store=None, misfire_grace=3600.0, max_sleep=60.0, group_by=None, group_window=0.0):
+        self.callback = callback
+        self.store = store
+        self.misfire_grace = misfire_grace
+        self.group_by = group_by
+        self.group_window = group_window
+        self._groups = {}  # group -> [送る時刻, [(key, fire_at, 連番, payload), ...]]
+        self._held = {}    # まとめ待ちの key -> 連番
+        self.max_sleep = max_sleep  # 時計のずれに備えて、長くてもこの秒数で起きて見直す
+        self._heap = []
+        self._entries = {}  # key -> (発火時刻, 連番, payload)
+        self._counter = itertools.count()
+        self._wake = asyncio.Event()
+        self._task = None
+        self._running = set()
+        self.fired = 0
+        self.restored = False
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def keys(self):
+        return self._entries.keys()
+
+    def get(self, key):
+        """積んである (fire_at, payload)。無ければ None"""
+        entry = self._entries.get(key)
+        return (entry[0], entry[2]) if entry else None
+
+    def schedule(self, key, fire_at, payload=()):
+        """key のリマインダーを fire_at（UNIX秒）に追加する。同じ key があれば置き換え"""
+        if self.store is not None:
+            self.store.save(key, fire_at, payload)
+        self._push(key, fire_at, payload)
+
+    def schedule_many(self, items):
+        """[(key, fire_at, payload), ...] をまとめて追加する（store への書き込みは1回）"""
+        items = list(items)
+        if self.store is not None and items:
+            self.store.save_many(items)
+        for key, fire_at, payload in items:
+            self._push(key, fire_at, payload)
+
+    def restore(self, now=None):
+        """store から読み戻す。猶予を過ぎて取りこぼしたものは積まずに返す [(key, fire_at, payload), ...]"""
+        self.restored = True
+        if self.store is None:
+            return []
+        now = time.time() if now is None else now
+        expired = []
+        for key, fire_at, payload in self.store.load():
+            if fire_at < now - self.misfire_grace:
+                expired.append((key, fire_at, payload))
+                self.store.delete(key, fire_at)
+            else:
+                self._push(key, fire_at, payload)
+        late = sum(1 for fire_at, _, _ in self._entries.values() if fire_at <= now)
+        logger.info(f"⏰ リマインダー {len(self._entries)} 件を復元（遅れて送る {late} 件 / 猶予切れ {len(expired)} 件）")
+        return expired
+
+    def _push(self, key, fire_at, payload):
+        seq = next(self._counter)
+        self._entries[key] = (fire_at, seq, payload)
+        if not self._heap or fire_at < self._heap[0][0]:
+            self._wake.set()  # 今眠っているより早いので起こす
+        heapq.heappush(self._heap, (fire_at, seq, key))
+        self._compact()
+
+    def cancel(self, key):
+        """key のリマインダーを取り消す。無ければ何もしない"""
+        if self._entries.pop(key, None) is None:
+            return False
+        if self.store is not None:
+            self.store.delete(key)
+        self._compact()
+        return True
+
+    def clear(self):
+        self._heap.clear()
+        self._entries.clear()
+        self._groups.clear()
+        self._held.clear()
+        if self.store is not None:
+            self.store.clear()
+        self._wake.set()
+
+    def next_fire_time(self):
+        self._drop_stale()
+        return self._heap[0][0] if self._heap else None
+
+    def pop_due(self, now=None):
+        """期限が来たものを全部取り出す [(key, fire_at, payload), ...]"""
+        due = []
+        for key, fire_at, _, payload in self._take_due(now):
+            del self._entries[key]
+            due.append((key, fire_at, payload))
+        return due
+
+    def _take_due(self, now=None):
+        # ヒープからは外すが、_entries には残したまま返す [(key, fire_at, seq, payload), ...]
+        now = time.time() if now is None else now
+        due = []
+        while self._heap and self._heap[0][0] <= now:
+            fire_at, seq, key = heapq.heappop(self._heap)
+            entry = self._entries.get(key)
+            if entry is None or entry[1] != seq:
+                continue  # 取り消し済み・置き換え済み
+            due.append((key, fire_at, seq, entry[2]))
+        return due
+
+    def upcoming(self, until):
+        """until（UNIX秒）までに期限が来るものを時刻順に返す [(key, fire_at, payload), ...]
+
+        ヒープを根からたどり、until より後の枝は見ないので、該当する件数分しか触らない。
+        """
+        found = []
+        stack = [0] if self._heap else []
+        while stack:
+            i = stack.pop()
+            fire_at, seq, key = self._heap[i]
+            if fire_at > until:
+                continue
+            entry = self._entries.get(key)
+            if entry is not None and entry[1] == seq:
+                found.append((fire_at, seq, key, entry[2]))
+            stack.extend(j for j in (2 * i + 1, 2 * i + 2) if j < len(self._heap))
+        found.sort(key=lambda item: item[:2])
+        return [(key, fire_at, payload) for fire_at, _, key, payload in found]
+
+    def upcoming_groups(self, until, now=None):
+        """until までに期限が来るものを、送るときと同じまとめ方で返す [(group, [(key, fire_at, payload), ...]), ...]
+
+        最初の1件の時刻（過ぎていれば now）から group_window 秒以内に来る同じグループの分が
+        1つにまとまる。すでにまとめ待ちのグループは、その続きとして数える。
+        group_by が無ければ1件ずつ（group は key）。
+        """
+        now = time.time() if now is None else now
+        groups = []
+        open_groups = {}  # group -> (締め切り, [(key, fire_at, payload), ...])
+        for group, (send_at, held) in self._groups.items():
+            items = [
+                (key, fire_at, payload) for key, fire_at, seq, payload in held
+                if self._held.get(key) == seq and (self._entries.get(key) or (None, None))[1] == seq
+            ]
+            open_groups[group] = (send_at, items)
+            groups.append((group, items))
+        for key, fire_at, payload in self.upcoming(until):
+            group = self.group_by(payload) if self.group_by is not None else key
+            current = open_groups.get(group)
+            if current is None or fire_at > current[0]:
+                current = (max(fire_at, now) + self.group_window, [])
+                open_groups[group] = current
+                groups.append((group, current[1]))
+            current[1].append((key, fire_at, payload))
+        return [(group, items) for group, items in groups if items]
+
+    def _drop_stale(self):
+        while self._heap:
+            fire_at, seq, key = self._heap[0]
+            entry = self._entries.get(key)
+            if entry is not None and entry[1] == seq:
+                return
+            heapq.heappop(self._heap)
+
+    def _compact(self):
+        # 読み捨て待ちが半分を超えたら作り直して、メモリを実件数に合わせる
+        if len(self._heap) > 64 and len(self._heap) > 2 * len(self._entries):
+            self._heap = [
+                (fire_at, seq, key) for key, (fire_at, seq, _) in self._entries.items()
+                if self._held.get(key) != seq  # まとめ待ちの分はもうヒープに戻さない
+            ]
+            heapq.heapify(self._heap)
+
+    def start(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _run(self):
+        while True:
+            self._wake.clear()
+            now = time.time()
+            if self.group_by is None:
+                for key, fire_at, payload in self.pop_due(now):
+                    self._dispatch(key, [(key, fire_at, payload)])
+            else:
+                for key, fire_at, seq, payload in self._take_due(now):
+                    # 最初の1件から group_window 秒だけ待って、同じグループの分を集める。
+                    # 待っている間も _entries に残すので、get() で見えるし cancel() も効く
+                    self._held[key] = seq
+                    group = self.group_by(payload)
+                    self._groups.setdefault(group, [now + self.group_window, []])[1].append((key, fire_at, seq, payload))
+                for group in [g for g, (send_at, _) in self._groups.items() if send_at <= now]:
+                    _, held = self._groups.pop(group)
+                    items = self._release(held)
+                    if items:
+                        self._dispatch(group, items)
+
+            wake_at = [send_at for send_at, _ in self._groups.values()]
+            next_at = self.next_fire_time()
+            if next_at is not None:
+                wake_at.append(next_at)
+            timeout = min([self.max_sleep] + [max(0.0, t - time.time()) for t in wake_at])
+            # wait_for は起こされたのと同時に来た cancel() を握りつぶすことがある（3.11）ので、
+            # 待つのは別タスクにして asyncio.wait で待つ
+            waiter = asyncio.ensure_future(self._wake.wait())
+            try:
+                await asyncio.wait([waiter], timeout=timeout)
+            finally:
+                waiter.cancel()
+
+    def _release(self, held):
+        """まとめ待ちから外す。取り消し・置き換えされていないものだけ返す"""
+        items = []
+        for key, fire_at, seq, payload in held:
+            if self._held.get(key) == seq:
+                del self._held[key]
+            entry = self._entries.get(key)
+            if entry is None or entry[1] != seq:
+                continue
+            del self._entries[key]
+            items.append((key, fire_at, payload))
+        return items
+
+    def _dispatch(self, group, items):
+        self.fired += len(items)
+        task = asyncio.create_task(self._deliver(group, items))
+        self._running.add(task)
+        task.add_done_callback(self._running.discard)
+
+    async def _deliver(self, group, items):
+        try:
+            if self.group_by is None:
+                await self.callback(*items[0][2])
+            else:
+                await self.callback(group, [(fire_at, payload) for _, fire_at, payload in items])
+        except Exception as e:
+            logger.error(f"⚠️ リマインダー {group} の送信に失敗: {e}")
+        finally:
+            # 送り終わってから消す（途中で落ちたら次の起動で送り直す）。
+            # callback の中で次回分が積み直されていたら fire_at が違うので消えない
+            if self.store is not None:
+                for key, fire_at, _ in items:
+                    self.store.delete(key, fire_at)
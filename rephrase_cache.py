@@ -0,0 +1,123 @@
+import hashlib
+import json
+import logging
+import random
+import re
+import sqlite3
+import time
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+
+def prompt_key(prompt):
+    """空白の違いを無視したプロンプトのハッシュ"""
+    normalized = re.sub(r"\s+", " ", prompt).strip()
+    return hashlib.sha256(normalized.encode("utf-8")).hexdigest()
+
+
+class RephraseCache:
+    """Gemini に言い換えてもらった文章のキャッシュ（LRU + 有効期限）
+
+    キーはプロンプトのハッシュで、1つのキーに最大 variants 個の言い回しを溜める。
+    1つでもあればそこからランダムに返し（Gemini は呼ばない）、
+    まだ足りないキーは needs_variant() が True を返すので、裏で1つ足せばよい。
+    path を渡すと SQLite にも書いて、再起動後も使う。
+    """
+
+    def __init__(self, max_entries=1000, ttl=7 * 24 * 3600, variants=3, path=None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.variants = variants
+        self._entries = OrderedDict()  # key -> (作った時刻, [言い回し, ...])
+        self.metrics = {"hits": 0, "misses": 0, "expired": 0, "evictions": 0}
+        self.conn = None
+        if path:
+            self.conn = sqlite3.connect(path, check_same_thread=False)
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.execute("""
+                CREATE TABLE IF NOT EXISTS rephrase_cache (
+                    key TEXT PRIMARY KEY,
+                    created_at REAL NOT NULL,
+                    variants TEXT NOT NULL
+                )
+            """)
+            self.conn.commit()
+            self._load()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _load(self):
+        rows = self.conn.execute(
+            "SELECT key, created_at, variants FROM rephrase_cache ORDER BY created_at DESC LIMIT ?",
+            (self.max_entries,)
+        ).fetchall()
+        for key, created_at, variants in reversed(rows):
+            self._entries[key] = (created_at, json.loads(variants))
+
+    def _save(self, key, created_at, variants):
+        if self.conn is None:
+            return
+        self.conn.execute(
+            "INSERT OR REPLACE INTO rephrase_cache (key, created_at, variants) VALUES (?, ?, ?)",
+            (key, created_at, json.dumps(variants, ensure_ascii=False))
+        )
+        self.conn.commit()
+
+    def _forget(self, key):
+        self._entries.pop(key, None)
+        if self.conn is not None:
+            self.conn.execute("DELETE FROM rephrase_cache WHERE key = ?", (key,))
+            self.conn.commit()
+
+    def _fresh(self, key):
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if time.time() - entry[0] > self.ttl:
+            self.metrics["expired"] += 1
+            self._forget(key)
+            return None
+        return entry
+
+    def get(self, prompt):
+        """キャッシュにあれば言い回しを1つ返す。無ければ None"""
+        key = prompt_key(prompt)
+        entry = self._fresh(key)
+        if entry is None:
+            self.metrics["misses"] += 1
+            return None
+        self._entries.move_to_end(key)
+        self.metrics["hits"] += 1
+        return random.choice(entry[1])
+
+    def contains(self, prompt):
+        """ヒット・ミスに数えずに、キャッシュにあるかだけを見る"""
+        return self._fresh(prompt_key(prompt)) is not None
+
+    def needs_variant(self, prompt):
+        """言い回しがまだ variants 個に足りていないか"""
+        entry = self._fresh(prompt_key(prompt))
+        return entry is not None and len(entry[1]) < self.variants
+
+    def add(self, prompt, text):
+        """言い回しを1つ足す（同じものは足さない）"""
+        key = prompt_key(prompt)
+        entry = self._fresh(key)
+        created_at, variants = entry if entry else (time.time(), [])
+        if text not in variants and len(variants) < self.variants:
+            variants = variants + [text]
+        self._entries[key] = (created_at, variants)
+        self._entries.move_to_end(key)
+        self._save(key, created_at, variants)
+        while len(self._entries) > self.max_entries:
+            oldest, _ = self._entries.popitem(last=False)
+            self.metrics["evictions"] += 1
+            if self.conn is not None:
+                self.conn.execute("DELETE FROM rephrase_cache WHERE key = ?", (oldest,))
+                self.conn.commit()
+
+    def stats(self):
+        lookups = self.metrics["hits"] + self.metrics["misses"]
+        return dict(self.metrics, size=len(self._entries), hit_rate=round(self.metrics["hits"] / lookups, 3) if lookups else None)
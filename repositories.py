@@ -0,0 +1,203 @@
+import asyncio
+import logging
+
+from supabase_client import in_filter
+
+logger = logging.getLogger(__name__)
+
+
+class TableRepository:
+    """1テーブル分の変更（追加・更新・削除）をレコード単位で記録して、差分だけ書き込む
+
+    同じキーへの変更は最後のものだけが残るので、flush のコストは
+    テーブル全体の行数ではなく「変わった行数」に比例する。
+    """
+
+    def __init__(self, client, table, key="id"):
+        self.client = client
+        self.table = table
+        self.key = key
+        self._upserts = {}   # key -> 書き込む行
+        self._deletes = set()
+        self._lock = asyncio.Lock()
+
+    def mark_upsert(self, row):
+        """追加・更新された行を記録"""
+        key = row[self.key]
+        self._deletes.discard(key)
+        self._upserts[key] = row
+
+    def mark_delete(self, key):
+        """削除された行を記録"""
+        self._upserts.pop(key, None)
+        self._deletes.add(key)
+
+    def discard(self, keys):
+        """まだ書き込んでいない変更を取り消す（別経路で直接書き込んだとき用）"""
+        for key in keys:
+            self._upserts.pop(key, None)
+            self._deletes.discard(key)
+
+    def is_pending(self, key):
+        """まだ書き込んでいない変更があるキーか"""
+        return key in self._upserts or key in self._deletes
+
+    @property
+    def pending(self):
+        return len(self._upserts) + len(self._deletes)
+
+    async def flush(self):
+        """溜まっている差分を書き込む。失敗した分は次回に持ち越す"""
+        async with self._lock:
+            if not self._upserts and not self._deletes:
+                return True
+
+            upserts, self._upserts = self._upserts, {}
+            deletes, self._deletes = self._deletes, set()
+            ok = True
+
+            if deletes:
+                response = await self.client.delete(self.table, {self.key: in_filter(deletes)})
+                if not response.ok:
+                    ok = False
+                    for key in deletes:
+                        if key not in self._upserts:
+                            self._deletes.add(key)
+
+            if upserts:
+                response = await self.client.upsert(self.table, list(upserts.values()), on_conflict=self.key)
+                if not response.ok:
+                    ok = False
+                    for key, row in upserts.items():
+                        if key not in self._upserts and key not in self._deletes:
+                            self._upserts[key] = row
+
+            if ok:
+                logger.info(f"💾 {self.table}: 更新 {len(upserts)} 件 / 削除 {len(deletes)} 件を保存")
+            else:
+                logger.error(f"⚠️ {self.table}: 保存に失敗した変更を次回に持ち越します")
+            return ok
+
+
+class ConversationStore:
+    """会話ログを追記だけで保存し、古いターンは定期的にまとめて削る
+
+    1ターンあたりの書き込みは INSERT 1回だけ。古い行の削除は
+    trim() で「メモリに残っている一番古いターンより前」を消す。
+    """
+
+    def __init__(self, client, table="conversation_logs"):
+        self.client = client
+        self.table = table
+        self._pending = []       # まだ書き込んでいない行
+        self._trim_users = set() # 前回の trim 以降に変化があったユーザー
+        self._lock = asyncio.Lock()
+
+    def append(self, user_id, entry):
+        """メモリ上の1ターン（role / parts / created_at）を追記予約する"""
+        self._pending.append({
+            "user_id": user_id,
+            "role": entry["role"],
+            "content": entry["parts"][0]["text"],
+            "created_at": entry["created_at"]
+        })
+        self._trim_users.add(user_id)
+
+    def mark_trim(self, user_id):
+        """次の trim でこのユーザーのログを見直す"""
+        self._trim_users.add(user_id)
+
+    @property
+    def pending(self):
+        return len(self._pending)
+
+    async def flush(self):
+        async with self._lock:
+            if not self._pending:
+                return True
+            rows, self._pending = self._pending, []
+            response = await self.client.insert(self.table, rows)
+            if not response.ok:
+                self._pending = rows + self._pending
+                logger.error(f"⚠️ {self.table}: {len(rows)} 件の追記に失敗、次回に持ち越します")
+                return False
+            return True
+
+    async def trim(self, logs):
+        """メモリ上のログより古い行をユーザーごとに削除する"""
+        await self.flush()
+        users, self._trim_users = self._trim_users, set()
+        for user_id in users:
+            entries = logs.get(user_id) or []
+            if not entries:
+                # メモリ上で空にされたユーザーは全部消す
+                filters = {"user_id": f"eq.{user_id}"}
+            else:
+                cutoff = entries[0].get("created_at")
+                if not cutoff:
+                    continue
+                filters = {"user_id": f"eq.{user_id}", "created_at": f"lt.{cutoff}"}
+            response = await self.client.delete(self.table, filters)
+            if not response.ok:
+                self._trim_users.add(user_id)
+        if users:
+            logger.info(f"✂️ {self.table}: {len(users)} 人分の古い会話ログを整理しました")
+
+
+class WriteBehindQueue:
+    """複数のリポジトリの変更を溜めて、一定間隔か一定件数ごとにまとめて書き込む
+
+    同じレコードへの変更は各リポジトリ側で1件にまとまるので、
+    連続した編集でもテーブルごとに1回のリクエストで済む。
+    """
+
+    def __init__(self, stores, interval=5.0, max_pending=50):
+        self.stores = stores
+        self.interval = interval
+        self.max_pending = max_pending
+        self._wake = asyncio.Event()
+        self._task = None
+
+    @property
+    def pending(self):
+        return sum(store.pending for store in self.stores)
+
+    def touch(self):
+        """変更があったことを知らせる。件数が多ければすぐに書き込む"""
+        if self.pending >= self.max_pending:
+            self._wake.set()
+
+    def start(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    async def _run(self):
+        while True:
+            # wait_for は起こされたのと同時に来た cancel() を握りつぶすことがある（3.11）ので、
+            # 待つのは別タスクにして asyncio.wait で待つ
+            waiter = asyncio.ensure_future(self._wake.wait())
+            try:
+                await asyncio.wait([waiter], timeout=self.interval)
+            finally:
+                waiter.cancel()
+            self._wake.clear()
+            try:
+                await self.flush_all()
+            except Exception as e:
+                logger.error(f"⚠️ 書き込みキューの保存中にエラー: {e}")
+
+    async def flush_all(self):
+        """溜まっている変更を全部書き込む"""
+        results = await asyncio.gather(*(store.flush() for store in self.stores))
+        return all(results)
+
+    async def stop(self):
+        """バックグラウンドの書き込みを止めて、残りを全部書き込む"""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush_all()
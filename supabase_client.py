@@ -0,0 +1,143 @@
+import asyncio
+import json
+import logging
+
+import aiohttp
+
+logger = logging.getLogger(__name__)
+
+
+class SupabaseError(Exception):
+    """ページ取得の途中で失敗したとき"""
+
+
+class SupabaseResponse:
+    """PostgREST のレスポンス（ステータスとJSON本体）"""
+
+    def __init__(self, status, data=None, headers=None):
+        self.status = status
+        self.data = data
+        self.headers = headers or {}
+
+    @property
+    def ok(self):
+        return 200 <= self.status < 300
+
+
+class SupabaseClient:
+    """Supabase(PostgREST) 用の非同期クライアント
+
+    aiohttp.ClientSession を1本だけ作って keep-alive で使い回し、
+    リクエストごとのタイムアウトと同時実行数の上限をかける。
+    """
+
+    def __init__(self, url, key, max_concurrency=10, timeout=10.0, pool_size=20):
+        self.base_url = f"{url}/rest/v1"
+        self.headers = {
+            "apikey": key,
+            "Authorization": f"Bearer {key}",
+            "Content-Type": "application/json"
+        }
+        self.timeout = aiohttp.ClientTimeout(total=timeout)
+        self.pool_size = pool_size
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self._session = None
+
+    def _get_session(self):
+        # イベントループ上で初めて使われたときにセッションを作る
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(limit=self.pool_size, keepalive_timeout=60)
+            self._session = aiohttp.ClientSession(
+                connector=connector,
+                headers=self.headers,
+                timeout=self.timeout
+            )
+        return self._session
+
+    async def request(self, method, table, params=None, json_body=None, headers=None, timeout=None):
+        session = self._get_session()
+        url = f"{self.base_url}/{table}"
+        options = {}
+        if timeout:
+            # None を渡すと「タイムアウト無し」になってしまうので、指定があるときだけ渡す
+            options["timeout"] = aiohttp.ClientTimeout(total=timeout)
+        async with self._semaphore:
+            try:
+                async with session.request(
+                    method,
+                    url,
+                    params=params,
+                    json=json_body,
+                    headers=headers,
+                    **options
+                ) as response:
+                    body = await response.text()
+                    try:
+                        data = json.loads(body) if body else None
+                    except ValueError:
+                        data = body
+                    if response.status >= 400 and response.status != 416:
+                        logger.error(f"⚠️ Supabase {method} {table} 失敗: {response.status} {body[:200]}")
+                    return SupabaseResponse(response.status, data, response.headers)
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                logger.error(f"⚠️ Supabase {method} {table} 通信エラー: {e!r}")
+                return SupabaseResponse(0)
+
+    async def select(self, table, params=None, columns="*"):
+        """SELECT。失敗したときは None を返す"""
+        query = {"select": columns}
+        query.update(params or {})
+        response = await self.request("GET", table, params=query)
+        if response.status == 200:
+            return response.data or []
+        return None
+
+    async def select_pages(self, table, params=None, columns="*", page_size=1000, order=None):
+        """Range ヘッダで1ページずつ取得して返す（PostgREST の件数上限で切れないように）
+
+        page_size は PostgREST の max-rows（Supabase は既定で1000）以下にすること。
+        途中で失敗したら SupabaseError を投げる。
+        """
+        query = {"select": columns}
+        if order:
+            query["order"] = order  # ページの境目がずれないように並び順を固定
+        query.update(params or {})
+        offset = 0
+        while True:
+            headers = {"Range-Unit": "items", "Range": f"{offset}-{offset + page_size - 1}"}
+            response = await self.request("GET", table, params=query, headers=headers)
+            if response.status == 416:
+                return
+            if response.status not in (200, 206):
+                raise SupabaseError(f"{table} の取得に失敗しました ({response.status})")
+            rows = response.data or []
+            if rows:
+                yield rows
+            if len(rows) < page_size:
+                return
+            offset += len(rows)
+
+    async def insert(self, table, rows):
+        headers = {"Prefer": "return=minimal"}
+        return await self.request("POST", table, json_body=rows, headers=headers)
+
+    async def upsert(self, table, rows, on_conflict=None):
+        headers = {"Prefer": "resolution=merge-duplicates,return=minimal"}
+        params = {"on_conflict": on_conflict} if on_conflict else None
+        return await self.request("POST", table, params=params, json_body=rows, headers=headers)
+
+    async def update(self, table, filters, values):
+        headers = {"Prefer": "return=minimal"}
+        return await self.request("PATCH", table, params=filters, json_body=values, headers=headers)
+
+    async def delete(self, table, filters=None):
+        return await self.request("DELETE", table, params=filters)
+
+    async def close(self):
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+
+
+def in_filter(values):
+    """PostgREST の in.(...) フィルタ文字列を作る"""
+    return "in.(" + ",".join(f'"{v}"' for v in values) + ")"